@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+""" Micro-benchmark of the matrix products of fgbuster.algebra
+
+Compare plain einsum (``fgbuster.algebra.DISPATCH = False``, the default)
+with the shape-based dispatch (``DISPATCH = True``) on stacks of small
+matrices with the shapes that are typical in component separation.
+The array namespace of the algebra kernels can be chosen with ``--backend``
+(see ``fgbuster.algebra.set_array_backend``).
+
+Usage::
+
+    python benchmarks/algebra_products.py [--n-pix N] [--repeat R]
+                                          [--backend jax.numpy]
+"""
+import argparse
+import importlib
+import timeit
+import numpy as np
+import fgbuster.algebra as alg
+
+
+def _cases(n_pix, n_freq=15, n_comp=3):
+    np.random.seed(0)
+    A = np.random.normal(size=(n_pix, n_freq, n_comp))
+    A_fix = np.random.normal(size=(n_freq, n_comp))
+    invN = np.random.normal(size=(n_pix, n_freq, n_freq))
+    d = np.random.normal(size=(n_pix, n_freq))
+    s = np.random.normal(size=(n_pix, n_comp))
+    M = np.random.normal(size=(n_pix, n_comp, n_comp))
+    A, A_fix, invN, d, s, M = [alg.xp.asarray(a)
+                               for a in (A, A_fix, invN, d, s, M)]
+    return [
+        ('_mv  (pix, f, c) (pix, c)', alg._mv, (A, s)),
+        ('_mtv (pix, f, c) (pix, f)', alg._mtv, (A, d)),
+        ('_mv  (f, c) (pix, c)', alg._mv, (A_fix, s)),
+        ('_mm  (pix, c, c) (pix, c, f)', alg._mm, (M, alg._T(A))),
+        ('_mtm (pix, f, c) (pix, f, c)', alg._mtm, (A, A)),
+        ('_mtm (pix, f, f) (pix, f, c)', alg._mtm, (invN, A)),
+        ('_utmv (pix, f) (pix, f, f) (pix, f)', alg._utmv, (d, invN, d)),
+        ('_mtmv (pix, f, c) (pix, f, f) (pix, f)', alg._mtmv, (A, invN, d)),
+        ('_mmm (pix, c, f) (pix, f, f) (pix, f, c)', alg._mmm,
+         (alg._T(A), invN, A)),
+        ('_mtmm (pix, f, c) (pix, f, f) (pix, f, c)', alg._mtmm,
+         (A, invN, A)),
+    ]
+
+
+def _time(func, args, repeat):
+    number = max(1, int(0.05 / _best(func, args, 1, 1)))
+    return _best(func, args, number, repeat)
+
+
+def _best(func, args, number, repeat):
+    # np.asarray waits for the result also for asynchronous backends
+    return min(timeit.repeat(lambda: np.asarray(func(*args)),
+                             number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--n-pix', type=int, nargs='+',
+                        default=[1, 100, 10000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--backend', default='numpy',
+                        help='Array namespace, e.g. numpy or jax.numpy')
+    args = parser.parse_args()
+
+    dispatch = alg.DISPATCH
+    backend = alg.set_array_backend(importlib.import_module(args.backend))
+    print('%-44s %8s %12s %12s %8s' % (
+        'product', 'n_pix', 'einsum [s]', 'dispatch [s]', 'speedup'))
+    try:
+        for n_pix in args.n_pix:
+            for name, func, operands in _cases(n_pix):
+                alg.DISPATCH = False
+                t_einsum = _time(func, operands, args.repeat)
+                alg.DISPATCH = True
+                t_dispatch = _time(func, operands, args.repeat)
+                print('%-44s %8i %12.3e %12.3e %8.2f' % (
+                    name, n_pix, t_einsum, t_dispatch, t_einsum / t_dispatch))
+    finally:
+        alg.DISPATCH = dispatch
+        alg.set_array_backend(backend)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+""" Benchmarks of the component separation hot paths
+
+All the inputs are synthetic (white-noise amplitudes with the default SEDs
+plus white instrumental noise): no network access and no PySM template is
+required.
+
+The classes follow the asv conventions (``setup``, ``params``,
+``param_names`` and ``time_*``/``peakmem_*`` methods), so this directory can
+be used as an asv benchmark suite. They can also be run without asv: time is
+the best of *repeat* runs, peak memory is the peak of the memory traced by
+`tracemalloc` during one run. Results can be saved and compared against a
+previous run, the exit status is 1 if any of them regressed by more than
+*tolerance*.
+
+Usage::
+
+    python benchmarks/separation.py [--filter ILC] [--repeat R]
+                                    [--save new.json] [--compare old.json]
+                                    [--tolerance 0.2]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import json
+import re
+import sys
+import timeit
+import tracemalloc
+import numpy as np
+import healpy as hp
+import fgbuster.component_model as cm
+from fgbuster.mixingmatrix import MixingMatrix
+from fgbuster.observation_helpers import standardize_instrument
+from fgbuster.separation_recipes import (basic_comp_sep, multi_res_comp_sep,
+                                         ilc, harmonic_ilc_alm)
+from fgbuster.cosmology import xForecast
+
+
+def _components(n_param):
+    # CMB and foregrounds with n_param free parameters in total
+    if n_param == 1:
+        return [cm.CMB(), cm.Synchrotron(70.)]
+    if n_param == 2:
+        return [cm.CMB(), cm.Dust(150.)]
+    if n_param == 3:
+        return [cm.CMB(), cm.Dust(150.), cm.Synchrotron(70.)]
+    if n_param == 4:
+        return [cm.CMB(), cm.Dust(150.),
+                cm.Synchrotron(70., nu_pivot=70., running=None)]
+    raise ValueError(n_param)
+
+
+def _instrument(n_freq):
+    depth_p = np.full(n_freq, 10.)
+    return {'frequency': np.geomspace(30., 400., n_freq),
+            'depth_i': depth_p / 2**0.5,
+            'depth_p': depth_p}
+
+
+def _sky(nside, n_freq, n_param=3, n_stokes=2, cmb=True, noise=True):
+    """ Synthetic frequency maps, shape *(n_freq, n_stokes, n_pix)*
+
+    Return also the components and the instrument.
+    """
+    np.random.seed(0)
+    components = _components(n_param)
+    instrument = _instrument(n_freq)
+    mm = MixingMatrix(*components)
+    A = mm.eval(instrument['frequency'], *mm.defaults)
+    amp = np.random.normal(
+        size=(len(components), n_stokes, hp.nside2npix(nside)))
+    amp[1:] *= 10.
+    if not cmb:
+        amp[0] = 0.
+    data = np.einsum('fc,csp->fsp', A, amp)
+    if noise:
+        sigma = instrument['depth_p'] / hp.nside2resol(nside, arcmin=True)
+        data += (sigma[:, np.newaxis, np.newaxis]
+                 * np.random.normal(size=data.shape))
+    return components, instrument, data
+
+
+class CompSep(object):
+    params = ([16, 64, 128], [5, 15])
+    param_names = ['nside', 'n_freq']
+
+    def setup(self, nside, n_freq):
+        self.components, self.instrument, self.data = _sky(nside, n_freq)
+
+    def time_basic_comp_sep(self, nside, n_freq):
+        basic_comp_sep(self.components, self.instrument, self.data)
+
+    def peakmem_basic_comp_sep(self, nside, n_freq):
+        basic_comp_sep(self.components, self.instrument, self.data)
+
+
+class MultiCompSep(object):
+    params = ([1, 2, 4, 8],)
+    param_names = ['patch_nside']
+
+    def setup(self, patch_nside):
+        self.components, self.instrument, self.data = _sky(32, 15)
+
+    def time_basic_comp_sep(self, patch_nside):
+        basic_comp_sep(self.components, self.instrument, self.data,
+                       nside=patch_nside)
+
+    def peakmem_basic_comp_sep(self, patch_nside):
+        basic_comp_sep(self.components, self.instrument, self.data,
+                       nside=patch_nside)
+
+
+class MultiResCompSep(object):
+    params = ([(0, 1, 0), (1, 2, 1), (2, 4, 2)],)
+    param_names = ['nsides']
+
+    def setup(self, nsides):
+        self.components, self.instrument, self.data = _sky(16, 15)
+
+    def time_multi_res_comp_sep(self, nsides):
+        multi_res_comp_sep(self.components, self.instrument, self.data,
+                           nsides)
+
+    def peakmem_multi_res_comp_sep(self, nsides):
+        multi_res_comp_sep(self.components, self.instrument, self.data,
+                           nsides)
+
+
+class ILC(object):
+    params = ([64, 256], [1, 4])
+    param_names = ['nside', 'patch_nside']
+
+    def setup(self, nside, patch_nside):
+        _, self.instrument, self.data = _sky(nside, 15, n_stokes=3)
+        self.patch_ids = hp.ud_grade(
+            np.arange(hp.nside2npix(patch_nside)), nside).astype(int)
+
+    def time_ilc(self, nside, patch_nside):
+        ilc([cm.CMB()], self.instrument, self.data, self.patch_ids)
+
+    def peakmem_ilc(self, nside, patch_nside):
+        ilc([cm.CMB()], self.instrument, self.data, self.patch_ids)
+
+
+class HarmonicILCAlm(object):
+    params = ([128, 512],)
+    param_names = ['lmax']
+
+    def setup(self, lmax):
+        np.random.seed(0)
+        # Unlike the other recipes, harmonic_ilc_alm takes only standardized
+        # instruments
+        self.instrument = standardize_instrument(_instrument(15))
+        sed = cm.CMB().eval(self.instrument.frequency)
+        n_alm = hp.Alm.getsize(lmax)
+        cmb, noise = [
+            np.random.normal(size=shape) + 1j * np.random.normal(size=shape)
+            for shape in [(3, n_alm), (15, 3, n_alm)]]
+        self.alms = sed[:, np.newaxis, np.newaxis] * cmb + 0.1 * noise
+        self.lbins = np.arange(0, lmax + 2, 20)
+
+    def time_harmonic_ilc_alm(self, lmax):
+        harmonic_ilc_alm([cm.CMB()], self.instrument, self.alms, self.lbins)
+
+    def peakmem_harmonic_ilc_alm(self, lmax):
+        harmonic_ilc_alm([cm.CMB()], self.instrument, self.alms, self.lbins)
+
+
+class XForecast(object):
+    params = ([16, 32],)
+    param_names = ['nside']
+
+    def setup(self, nside):
+        self.components, self.instrument, self.d_fgs = _sky(
+            nside, 15, cmb=False, noise=False)
+
+    def _xforecast(self, nside):
+        with contextlib.redirect_stdout(io.StringIO()):
+            xForecast(self.components, self.instrument, self.d_fgs,
+                      2, 2 * nside - 1)
+
+    def time_xforecast(self, nside):
+        self._xforecast(nside)
+
+    def peakmem_xforecast(self, nside):
+        self._xforecast(nside)
+
+
+class MixingMatrixEvaluation(object):
+    params = ([16, 64, 256], [5, 15], [1, 2, 3, 4])
+    param_names = ['nside', 'n_freq', 'n_param']
+
+    def setup(self, nside, n_freq, n_param):
+        np.random.seed(0)
+        self.mm = MixingMatrix(*_components(n_param))
+        self.nu = _instrument(n_freq)['frequency']
+        n_pix = hp.nside2npix(nside)
+        self.x = [d * np.random.uniform(0.9, 1.1, n_pix)
+                  for d in self.mm.defaults]
+
+    def time_eval(self, nside, n_freq, n_param):
+        self.mm.eval(self.nu, *self.x)
+
+    def time_diff(self, nside, n_freq, n_param):
+        self.mm.diff(self.nu, *self.x)
+
+    def time_diff_diff(self, nside, n_freq, n_param):
+        self.mm.diff_diff(self.nu, *self.x)
+
+    def peakmem_eval(self, nside, n_freq, n_param):
+        self.mm.eval(self.nu, *self.x)
+
+
+def _benchmarks(pattern):
+    # Yield name, bound method and parameters of the benchmarks
+    classes = [CompSep, MultiCompSep, MultiResCompSep, ILC, HarmonicILCAlm,
+               XForecast, MixingMatrixEvaluation]
+    for cls in classes:
+        methods = sorted(m for m in dir(cls)
+                         if m.startswith('time_') or m.startswith('peakmem_'))
+        for params in itertools.product(*cls.params):
+            label = ', '.join('%s=%s' % (name, value)
+                              for name, value in zip(cls.param_names, params))
+            benchmark = None
+            for method in methods:
+                name = '%s.%s(%s)' % (cls.__name__, method, label)
+                if not re.search(pattern, name):
+                    continue
+                if benchmark is None:
+                    benchmark = cls()
+                    benchmark.setup(*params)
+                yield name, getattr(benchmark, method), params
+
+
+def _time(func, params, repeat):
+    return min(timeit.repeat(lambda: func(*params), number=1, repeat=repeat))
+
+
+def _peakmem(func, params):
+    tracemalloc.start()
+    try:
+        func(*params)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--filter', default='',
+                        help='Run only the benchmarks matching this regex')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--save', help='Store the results in this json file')
+    parser.add_argument('--compare',
+                        help='Compare with the results in this json file')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Relative increase regarded as a regression')
+    args = parser.parse_args()
+
+    reference = {}
+    if args.compare:
+        with open(args.compare) as f:
+            reference = json.load(f)
+
+    results = {}
+    regressions = []
+    print('%-72s %12s %10s' % ('benchmark', 'result', 'ratio'))
+    for name, func, params in _benchmarks(args.filter):
+        if '.time_' in name:
+            results[name] = _time(func, params, args.repeat)
+            result = '%10.3e s' % results[name]
+        else:
+            results[name] = _peakmem(func, params)
+            result = '%9.1f MB' % (results[name] / 2.**20)
+        ratio = ''
+        if name in reference:
+            ratio = results[name] / reference[name]
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+            ratio = '%10.2f' % ratio
+        print('%-72s %12s %10s' % (name, result, ratio))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if regressions:
+        print('\nRegressions (more than %i%%):' % (100 * args.tolerance))
+        print('\n'.join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -37,7 +37,9 @@ In that case, you have two options
 #    (J, L, M/K, N/K).
 # 3) Suppose that the blocks are equal for the same index in J and different
 #    index in L, the matrix can be passed as a (K, 1, M/K, M/K) ndarray, without
-#    repeating equal blocks.
+#    repeating equal blocks. Keep this form as long as possible: the products
+#    broadcast it and _cholesky_invN factorizes each distinct block once (also
+#    when the blocks are repeated with a zero stride, e.g. by np.broadcast_to)
 # 4) Vectors are just like matrices, without the domain dimension
 # 5) Many functions come in pairs foo(A, invN, ...) and _foo_svd(u_e_v, ...).
 #    _foo_svd does what foo is supposed to, but:
@@ -46,20 +48,33 @@ In that case, you have two options
 #       sqrt(invN)
 #     - _foo_svd doesn't perform all the checks that foo is required to do
 #     - foo can return the SVD, which can then be reused in _bar_svd(...)
-
+# 6) The _foo_svd functions and the matrix-product helpers use the array
+#    namespace `xp` instead of `np` (see set_array_backend). They must work with
+#    any namespace that mimics the numpy API (e.g. numpy, cupy, jax.numpy):
+#    no in-place operations on their arrays, numpy only for index arithmetic
+# 7) The maps returned by comp_sep (s and chi) have the precision of the data
+#    (at least single). Everything else, in particular the spectral
+#    likelihood and the SVD of A, is computed in the precision of A
+
+import os
+import glob
 import inspect
-from time import time
+import pickle
+from contextlib import contextmanager
+from time import time, perf_counter
 import six
 import numpy as np
 import scipy as sp
 import numdifftools
-from functools import reduce
+from .fileio import atomic_write, remove_if_exists
 
 
 __all__ = [
     'comp_sep',
     'multi_comp_sep',
     'logL',
+    'logL_grid',
+    'sample_logL',
     'logL_dB',
     'invAtNA',
     'P',
@@ -70,11 +85,65 @@ __all__ = [
     'W_dBdB',
     'Wd',
     'fisher_logL_dB_dB',
+    'PatchIndex',
+    'PatchResults',
+    'Profiler',
+    'Checkpoint',
+    'set_array_backend',
 ]
 
 
 OPTIMIZE = False
+# If True, the matrix products below dispatch on the operands: they use
+# np.matmul, which is much faster than einsum for stacks of small matrices,
+# (three-operand products are split in the cheapest order). When np.matmul is
+# not equivalent to einsum (e.g. einsum broadcasts also matrix dimensions of
+# size 1), three-operand products use an einsum contraction path that is
+# computed once for each set of operand shapes and then cached.
+# If False, plain einsum (with optimize=OPTIMIZE) is used. Can be switched at
+# any time.
+DISPATCH = False
 _EPSILON_LOGL_DB = 1e-6
+_EINSUM_PATHS = {}
+_EINSUM_PATHS_MAX_SIZE = 256
+# Array namespace of the likelihood kernels. Change it with set_array_backend
+xp = np
+
+
+def set_array_backend(namespace=None):
+    """ Set the array namespace used by the likelihood kernels
+
+    The SVD, Cholesky and matrix products at the core of the likelihood, its
+    gradient and of *W*, *P*, *D* and their derivatives are computed with the
+    functions of *namespace*. The high-level routines (e.g. :func:`comp_sep`)
+    convert back to `numpy` what they return and what they pass to
+    `scipy.optimize.minimize`.
+
+    Parameters
+    ----------
+    namespace: module or None
+        A module that mimics the `numpy` API, such as `numpy` (default),
+        `cupy` or `jax.numpy`. Computations are executed eagerly. If None,
+        restore `numpy`.
+
+    Returns
+    -------
+    namespace: module
+        The namespace that was in use before the call
+    """
+    global xp
+    old_namespace = xp
+    xp = np if namespace is None else namespace
+    return old_namespace
+
+
+def _to_numpy(x):
+    # Convert to numpy an array of the current array namespace
+    if xp is np:
+        return x
+    if hasattr(xp, 'asnumpy'):  # cupy
+        return xp.asnumpy(x)
+    return np.asarray(x)
 
 
 def _inv(m):
@@ -82,51 +151,172 @@ def _inv(m):
     return result.reshape(m.shape)
 
 
+def _matmul(m, n):
+    # np.matmul, if it is equivalent to einsum('...ij,...jk->...ik', m, n)
+    # Otherwise (e.g. einsum broadcasts also the matrix dimensions of size 1)
+    # return None
+    m, n = xp.asarray(m), xp.asarray(n)
+    if m.ndim < 2 or n.ndim < 2:
+        return None
+    try:
+        return xp.matmul(m, n)
+    except (ValueError, TypeError):
+        return None
+
+
+def _einsum(subscripts, *operands):
+    if not DISPATCH or len(operands) < 3:
+        return xp.einsum(subscripts, *operands, optimize=OPTIMIZE)
+    operands = [xp.asarray(o) for o in operands]
+    key = (subscripts,) + tuple(o.shape for o in operands)
+    try:
+        path = _EINSUM_PATHS[key]
+    except KeyError:
+        if len(_EINSUM_PATHS) >= _EINSUM_PATHS_MAX_SIZE:
+            _EINSUM_PATHS.clear()
+        # The path depends only on the shapes: use zero-stride placeholders
+        placeholders = [np.broadcast_to(0., o.shape) for o in operands]
+        path = np.einsum_path(subscripts, *placeholders, optimize='greedy')[0]
+        _EINSUM_PATHS[key] = path
+    return xp.einsum(subscripts, *operands, optimize=path)
+
+
+def _matmul_chain(m, w, n):
+    # m @ w @ n with np.matmul, starting from the product that requires fewer
+    # operations. None if np.matmul is not equivalent to einsum (see _matmul)
+    m, w, n = xp.asarray(m), xp.asarray(w), xp.asarray(n)
+    if m.ndim < 2 or w.ndim < 2 or n.ndim < 2:
+        return None
+    i, j = m.shape[-2:]
+    k, h = n.shape[-2:]
+    if i * j * k + i * k * h <= j * k * h + i * j * h:
+        res = _matmul(m, w)
+        return None if res is None else _matmul(res, n)
+    res = _matmul(w, n)
+    return None if res is None else _matmul(m, res)
+
+
 def _mv(m, v):
-    return np.einsum('...ij,...j->...i', m, v, optimize=OPTIMIZE)
+    if DISPATCH:
+        res = _matmul(m, xp.asarray(v)[..., np.newaxis])
+        if res is not None:
+            return res[..., 0]
+    return _einsum('...ij,...j->...i', m, v)
 
 
 def _utmv(u, m, v):
-    return np.einsum('...i,...ij,...j', u, m, v, optimize=OPTIMIZE)
+    if DISPATCH:
+        return xp.einsum('...i,...i', u, _mv(m, v))
+    return _einsum('...i,...ij,...j', u, m, v)
 
 
 def _mtv(m, v):
-    return np.einsum('...ji,...j->...i', m, v, optimize=OPTIMIZE)
+    if DISPATCH:
+        res = _matmul(_T(m), xp.asarray(v)[..., np.newaxis])
+        if res is not None:
+            return res[..., 0]
+    return _einsum('...ji,...j->...i', m, v)
 
 
 def _mm(m, n):
-    return np.einsum('...ij,...jk->...ik', m, n, optimize=OPTIMIZE)
+    if DISPATCH:
+        res = _matmul(m, n)
+        if res is not None:
+            return res
+    return _einsum('...ij,...jk->...ik', m, n)
 
 
 def _mtm(m, n):
-    return np.einsum('...ji,...jk->...ik', m, n, optimize=OPTIMIZE)
+    if DISPATCH:
+        res = _matmul(_T(m), n)
+        if res is not None:
+            return res
+    return _einsum('...ji,...jk->...ik', m, n)
 
 
 def _mmv(m, w, v):
-    return np.einsum('...ij,...jk,...k->...i', m, w, v, optimize=OPTIMIZE)
+    if DISPATCH:
+        return _mv(m, _mv(w, v))
+    return _einsum('...ij,...jk,...k->...i', m, w, v)
 
 
 def _mtmv(m, w, v):
-    return np.einsum('...ji,...jk,...k->...i', m, w, v, optimize=OPTIMIZE)
+    if DISPATCH:
+        return _mtv(m, _mv(w, v))
+    return _einsum('...ji,...jk,...k->...i', m, w, v)
 
 
 def _mmm(m, w, n):
-    return np.einsum('...ij,...jk,...kh->...ih', m, w, n, optimize=OPTIMIZE)
+    if DISPATCH:
+        res = _matmul_chain(m, w, n)
+        if res is not None:
+            return res
+    return _einsum('...ij,...jk,...kh->...ih', m, w, n)
 
 
 def _mtmm(m, w, n):
-    return np.einsum('...ji,...jk,...kh->...ih', m, w, n, optimize=OPTIMIZE)
+    if DISPATCH:
+        res = _matmul_chain(_T(m), w, n)
+        if res is not None:
+            return res
+    return _einsum('...ji,...jk,...kh->...ih', m, w, n)
 
 
 def _T(x):
     # Indexes < -2 are assumed to count diagonal blocks. Therefore the transpose
     # has to swap the last two axis, not reverse the order of all the axis
     try:
-        return np.swapaxes(x, -1, -2)
+        return xp.swapaxes(x, -1, -2)
     except ValueError:
         return x
 
 
+def _unbroadcast(a, n_core=2):
+    # View of a in which the block dimensions (all but the last n_core) with
+    # zero stride, i.e. repeated by broadcasting, have length one
+    strides = getattr(a, 'strides', None)
+    if strides is None:  # Not a numpy array
+        return a
+    return a[tuple(slice(None, 1) if stride == 0 else slice(None)
+                   for stride in strides[:a.ndim - n_core])]
+
+
+def _cholesky_invN(invN):
+    # Cholesky factor of invN. The rows and the columns of the channels with
+    # null diagonal element are zero: the blocks with the same channels
+    # observed are grouped and factorized at once, in their reduced size.
+    # Repeated blocks are factorized once, L broadcasts against the others.
+    # The coverage is checked explicitly and L is assembled without in-place
+    # assignments, as some array namespaces (e.g. JAX) return NaN instead of
+    # raising on failed factorizations and have immutable arrays
+    invN = _unbroadcast(invN)
+    n_freq = invN.shape[-1]
+    invN_blocks = invN.reshape(-1, n_freq, n_freq)
+    coverage = _to_numpy(xp.diagonal(invN_blocks, axis1=-1, axis2=-2) != 0)
+    if coverage.all():
+        return xp.linalg.cholesky(invN)
+    patterns, group = np.unique(coverage, axis=0, return_inverse=True)
+    group = group.ravel()
+    L_groups = []
+    blocks_of_groups = []
+    for i_pattern, pattern in enumerate(patterns):
+        blocks = np.flatnonzero(group == i_pattern)
+        observed = np.flatnonzero(pattern)
+        if observed.size:
+            L_reduced = xp.linalg.cholesky(
+                invN_blocks[np.ix_(blocks, observed, observed)])
+            # Embed in the full size: E^T L_reduced E, E selects the observed
+            embedding = xp.asarray(np.eye(n_freq)[observed], dtype=invN.dtype)
+            L_groups.append(_mtm(embedding, _mm(L_reduced, embedding)))
+        else:
+            L_groups.append(xp.zeros((blocks.size, n_freq, n_freq),
+                                     invN.dtype))
+        blocks_of_groups.append(blocks)
+    L_blocks = xp.concatenate(L_groups)
+    L_blocks = L_blocks[np.argsort(np.concatenate(blocks_of_groups))]
+    return L_blocks.reshape(invN.shape)
+
+
 def _svd_sqrt_invN_A(A, invN=None, L=None):
     """ SVD of A and Cholesky factor of invN
 
@@ -136,27 +326,17 @@ def _svd_sqrt_invN_A(A, invN=None, L=None):
     It correctly handles blocks for invN equal to zero
     """
     if L is None and invN is not None:
-        try:
-            L = np.linalg.cholesky(invN)
-        except np.linalg.LinAlgError:
-            # Cholesky of the blocks that contain a non-zero diagonal element
-            L = np.zeros_like(invN)
-            good_idx = np.where(np.all(np.diagonal(invN, axis1=-1, axis2=-2),
-                                       axis=-1))
-            if invN.ndim > 2:
-                L[good_idx] = np.linalg.cholesky(invN[good_idx])
-            elif good_idx[0].size:
-                L = np.linalg.cholesky(invN)
+        L = _cholesky_invN(invN)
 
     if L is not None:
         A = _mtm(L, A)
 
-    u_e_v = np.linalg.svd(A, full_matrices=False)
+    u_e_v = xp.linalg.svd(A, full_matrices=False)
     return u_e_v, L
 
 
 def _logL_svd(u_e_v, d):
-    return 0.5 * np.linalg.norm(_mtv(u_e_v[0], d))**2
+    return 0.5 * xp.linalg.norm(_mtv(u_e_v[0], d))**2
 
 
 def logL(A, d, invN=None, return_svd=False):
@@ -175,6 +355,207 @@ def logL(A, d, invN=None, return_svd=False):
     return res
 
 
+def _grid_blocks(d, invN):
+    # Cholesky factors of the distinct blocks of invN and the prewhitened data
+    # of each of them, compressed (see _compress_pixels and _group_by_coverage)
+    # Shapes (n_block, n_freq, n_freq) and (n_block, n_row, n_freq)
+    n_freq = d.shape[-1]
+    if invN is not None:
+        invN = _unbroadcast(invN)
+    if invN is None or invN.size == n_freq**2:
+        if invN is None:
+            L = np.eye(n_freq)[np.newaxis]
+        else:
+            L = _cholesky_invN(invN.reshape(1, n_freq, n_freq))
+        blocks_d = _compress_pixels(d.reshape(-1, n_freq))[np.newaxis]
+    else:
+        shape = np.broadcast_shapes(d.shape[:-1], invN.shape[:-2])
+        d = np.broadcast_to(d, shape + (n_freq,)).reshape(-1, n_freq)
+        invN = np.broadcast_to(invN, shape + (n_freq, n_freq)).reshape(
+            -1, n_freq, n_freq)
+        groups = _group_by_coverage(d, invN)
+        if groups is None:  # Every entry of d is a block
+            blocks_d, blocks_invN = d[:, np.newaxis], invN
+        else:
+            blocks_d, blocks_invN = groups[0], groups[1][:, 0]
+        L = _cholesky_invN(blocks_invN)
+    return xp.asarray(L), _mtv(xp.asarray(L)[:, np.newaxis],
+                               xp.asarray(blocks_d))
+
+
+def logL_grid(A_ev, d, invN, x_grid, batch_size=None):
+    """ Spectral likelihood on a grid of parameters
+
+    The mixing matrices of many parameter vectors are evaluated with a single
+    call of *A_ev*. Since the mixing matrix is assumed to be the same for all
+    the pixels, the data are compressed beforehand (see `_compress_pixels`):
+    the cost of each grid point does not depend on the number of pixels.
+
+    Parameters
+    ----------
+    A_ev: function
+        Evaluator of the mixing matrix for a stack of parameter vectors. It
+        takes an array with shape *(n_batch, n_param)* and returns the mixing
+        matrices, shape *(n_batch, n_freq, n_comp)*. For example,
+        ``MixingMatrix.evaluator(nu, unpack=lambda x: x.T)``.
+    d: ndarray
+        The data vector. Shape *(..., n_freq)*.
+    invN: ndarray or None
+        The inverse noise matrix. Shape *(..., n_freq, n_freq)*. It can
+        change across the pixels, but it is much cheaper if it takes only a
+        few distinct values (e.g. the same noise with different frequencies
+        observed, see :func:`comp_sep`).
+    x_grid: ndarray
+        The parameter vectors. Shape *(..., n_param)*, the *...* can be any
+        grid shape.
+    batch_size: int
+        Maximum number of parameter vectors per call to *A_ev*. By default,
+        all of them. Reduce it to limit the memory footprint.
+
+    Returns
+    -------
+    inv_logL: ndarray
+        -logL for each parameter vector in *x_grid*. Shape *(...)*.
+    x_best: ndarray
+        The parameter vector with the highest likelihood, it can be used as
+        starting point of :func:`comp_sep`.
+    """
+    x_grid = np.asarray(x_grid, dtype=float)
+    x_stack = x_grid.reshape(-1, x_grid.shape[-1])
+    if batch_size is None:
+        batch_size = len(x_stack)
+    L, pw_d = _grid_blocks(d, invN)
+
+    inv_logL = np.concatenate([
+        _inv_logL_stack(A_ev, L, pw_d, x_stack[start:start+batch_size])
+        for start in range(0, len(x_stack), batch_size)])
+    x_best = x_stack[np.argmin(inv_logL)]
+    return inv_logL.reshape(x_grid.shape[:-1]), x_best
+
+
+def _inv_logL_stack(A_ev, L, pw_d, x_stack):
+    # -logL of each entry of x_stack, L and pw_d are computed by _grid_blocks
+    A = xp.asarray(A_ev(x_stack))
+    # Shape (n_batch, n_block, n_freq, n_comp)
+    u = xp.linalg.svd(_mtm(L, A[:, np.newaxis]), full_matrices=False)[0]
+    u_t_d = _mtv(u[:, :, np.newaxis], pw_d)
+    return - 0.5 * _to_numpy(
+        xp.sum(u_t_d**2, axis=tuple(range(1, u_t_d.ndim))))
+
+
+def sample_logL(A_ev, d, invN, x0, n_step, n_walker=None, Sigma=None,
+                log_prior=None, stretch=2., rng=None):
+    """ Sample the spectral likelihood with an ensemble MCMC
+
+    Affine-invariant ensemble sampler with stretch moves (Goodman & Weare,
+    2010). At each step, the walkers are updated in two halves, each moving
+    with respect to the other: the mixing matrices of all the walkers of a
+    half are evaluated with a single call to *A_ev*. As in
+    :func:`logL_grid`, the mixing matrix is assumed to be the same for all the
+    pixels and the data are compressed beforehand: the cost of a step does
+    not depend on the number of pixels.
+
+    Parameters
+    ----------
+    A_ev: function
+        Evaluator of the mixing matrix for a stack of parameter vectors (see
+        :func:`logL_grid`).
+    d: ndarray
+        The data vector. Shape *(..., n_freq)*.
+    invN: ndarray or None
+        The inverse noise matrix. Shape *(..., n_freq, n_freq)*.
+    x0: ndarray
+        Either the center of the initial ensemble, shape *(n_param,)*, or
+        the initial position of the walkers, shape *(n_walker, n_param)*.
+    n_step: int
+        Number of steps. The burn-in is not discarded.
+    n_walker: int
+        Number of walkers, even. By default, four times the number of
+        parameters (at least 8). Ignored if *x0* provides the walkers.
+    Sigma: ndarray
+        Covariance of the Gaussian scatter of the initial walkers around *x0*,
+        e.g. the *Sigma* returned by :func:`comp_sep`. By default, the
+        standard deviation is 0.1% of each parameter.
+    log_prior: function
+        Logarithm of the prior (up to a constant). It takes an array of
+        parameter vectors, shape *(n, n_param)*, and returns an array with
+        shape *(n,)*, ``-np.inf`` outside of the support. By default, the
+        prior is flat.
+    stretch: float
+        Scale parameter of the stretch moves.
+    rng: numpy.random.Generator, int or None
+        Source of the random numbers, or a seed for
+        `numpy.random.default_rng`. The global state of `numpy.random` is not
+        used: runs with the same seed give the same chain.
+
+    Returns
+    -------
+    result: scipy.optimze.OptimizeResult (dict)
+        It includes
+
+        - **chain**: *(ndarray)* - Position of the walkers at each step.
+          Shape *(n_step, n_walker, n_param)*
+        - **inv_logL**: *(ndarray)* - -logL of the walkers at each step.
+          Shape *(n_step, n_walker)*
+        - **acceptance_fraction**: *(ndarray)* - Fraction of the moves that
+          were accepted, for each walker.
+    """
+    rng = np.random.default_rng(rng)
+    x0 = np.asarray(x0, dtype=float)
+    if x0.ndim == 2:
+        walkers = x0.copy()
+    else:
+        if n_walker is None:
+            n_walker = max(8, 4 * len(x0))
+        if Sigma is None:
+            Sigma = np.diag((1e-3 * np.where(x0 == 0, 1., x0))**2)
+        walkers = rng.multivariate_normal(x0, Sigma, n_walker)
+    n_walker, n_param = walkers.shape
+    if n_walker % 2 or n_walker < 2 * n_param:
+        raise ValueError('The number of walkers must be even and at least '
+                         'twice the number of parameters')
+    if log_prior is None:
+        log_prior = lambda x: np.zeros(len(x))
+    L, pw_d = _grid_blocks(d, invN)
+
+    def log_posterior(x):
+        res = log_prior(x)
+        inside = np.isfinite(res)
+        if np.any(inside):
+            res[inside] -= _inv_logL_stack(A_ev, L, pw_d, x[inside])
+        return res
+
+    log_p = log_posterior(walkers)
+    halves = np.arange(n_walker).reshape(2, -1)
+    chain = np.empty((n_step, n_walker, n_param))
+    chain_log_p = np.empty((n_step, n_walker))
+    n_accepted = np.zeros(n_walker, dtype=int)
+    for step in range(n_step):
+        for moving, fixed in (halves, halves[::-1]):
+            z = ((stretch - 1.) * rng.uniform(size=len(moving)) + 1)**2
+            z /= stretch
+            partners = walkers[rng.choice(fixed, len(moving))]
+            proposal = partners + z[:, np.newaxis] * (
+                walkers[moving] - partners)
+            proposal_log_p = log_posterior(proposal)
+            with np.errstate(invalid='ignore'):
+                log_ratio = ((n_param - 1) * np.log(z)
+                             + proposal_log_p - log_p[moving])
+            accepted = np.log(rng.uniform(size=len(moving))) < log_ratio
+            walkers[moving[accepted]] = proposal[accepted]
+            log_p[moving[accepted]] = proposal_log_p[accepted]
+            n_accepted[moving[accepted]] += 1
+        chain[step] = walkers
+        chain_log_p[step] = log_p
+
+    res = sp.optimize.OptimizeResult()
+    res.chain = chain
+    res.inv_logL = - chain_log_p + log_prior(
+        chain.reshape(-1, n_param)).reshape(n_step, n_walker)
+    res.acceptance_fraction = n_accepted / n_step
+    return res
+
+
 def _invAtNA_svd(u_e_v):
     _, e, v = u_e_v
     return _mtm(v, v / e[..., np.newaxis]**2)
@@ -207,6 +588,46 @@ def _Wd_svd(u_e_v, d):
     return _mtv(v, utd / e)
 
 
+def _map_dtype(d):
+    # Floating point type of the maps obtained from the data d
+    return np.promote_types(d.dtype, np.float32)
+
+
+def _s_chi_svd(u_e_v, d, dtype, return_chi=True):
+    # Separated components and residuals, computed and stored with dtype
+    u, e, v = u_e_v
+    if np.promote_types(u.dtype, dtype) == dtype:
+        s = _Wd_svd(u_e_v, d)
+        if not return_chi:
+            return s, None
+        return s, d - _As_svd(u_e_v, s)
+    # Lower precision than A: cast the (small) operators, not the maps
+    W = _W_svd(u_e_v).astype(dtype)
+    d = xp.asarray(d, dtype=dtype)
+    s = _mv(W, d)
+    if not return_chi:
+        return s, None
+    A = _mm(u * e[..., np.newaxis, :], v).astype(dtype)
+    return s, d - _mv(A, s)
+
+
+_OUTPUTS = ('s', 'invAtNA', 'chi', 'chi_dB')
+
+
+def _check_outputs(outputs):
+    # Validate the outputs argument of comp_sep, all the outputs by default
+    if outputs is None:
+        return _OUTPUTS
+    if isinstance(outputs, six.string_types):
+        outputs = (outputs,)
+    outputs = tuple(outputs)
+    unknown = [o for o in outputs if o not in _OUTPUTS]
+    if unknown:
+        raise ValueError("Unknown outputs %s, the available ones are %s"
+                         % (unknown, _OUTPUTS))
+    return outputs
+
+
 def Wd(A, d, invN=None, return_svd=False):
     u_e_v, L = _svd_sqrt_invN_A(A, invN)
     if L is not None:
@@ -265,7 +686,7 @@ def P(A, invN=None, return_svd=False):
 
 def _D_svd(u_e_v):
     u, e, v = u_e_v
-    return np.eye(u.shape[-2]) - _mm(u, _T(u))
+    return xp.eye(u.shape[-2]) - _mm(u, _T(u))
 
 
 def D(A, invN=None, return_svd=False):
@@ -287,17 +708,81 @@ def D(A, invN=None, return_svd=False):
 def _W_dB_svd(u_e_v, A_dB, comp_of_dB):
     _raise_if_not_simple_comp_of_dB(comp_of_dB)
     u, e, v = u_e_v
+    # res = v^t e^-2 v A_dB (1 - u u^t) - v^t e^-1 u^t A_dB v^t e^-1 u^t
+    # All the parameters are stacked along the first axis of A_dB
+    A_dB, cols = _stack_A_dB(A_dB, comp_of_dB, v.shape[-1], u.ndim - 2)
+    inve_v = v / e[..., np.newaxis]
+    slice_inve_v = xp.moveaxis(inve_v[..., cols], -2, 0)
+    # Align the `...` of slice_inve_v with the (possibly more) ones of A_dB
+    slice_inve_v = slice_inve_v.reshape(
+        slice_inve_v.shape[:1] + (1,) * (A_dB.ndim - slice_inve_v.ndim)
+        + slice_inve_v.shape[1:])
+    res = _mm(_mtm(inve_v, slice_inve_v), _T(A_dB))
+    res = res - _mm(_mm(res, u), _T(u))
+    res = res - _mm(_mm(_mm(_T(inve_v), _mtm(u, A_dB)), _T(slice_inve_v)),
+                    _T(u))
+    return res
+
+
+def _stack_A_dB(A_dB, comp_of_dB, n_comp, n_extra_dim=0):
+    """ Stack the (compressed) derivatives of A along a new first axis
+
+    Parameters
+    ----------
+    A_dB : list of ndarray
+        Derivatives of the mixing matrix. ``A_dB[i]`` has shape
+        *(..., n_freq, k_i)* and contains only the columns of *A* selected by
+        ``comp_of_dB[i][0]``
+    comp_of_dB: list of tuples
+        As in :func:`logL_dB`. Only the first element of each tuple is used.
+    n_comp: int
+        Number of components
+    n_extra_dim: int
+        Minimum number of *...* dimensions of the output. Use the number of
+        *...* dimensions of the arrays that will be combined with the output,
+        so that its first axis does not broadcast against them.
+
+    Returns
+    -------
+    A_dB: ndarray
+        Shape *(n_dB, ..., n_freq, k)*, where *k* is the largest *k_i* and
+        *...* is the broadcast of the *...* of the inputs (prepended with
+        ones up to *n_extra_dim* dimensions). Derivatives with fewer columns
+        are padded with zeros.
+    cols: ndarray
+        Integer array of shape *(n_dB, k)*. ``cols[i]`` contains the index of
+        the components affected by ``A_dB[i]``. Padding columns point to the
+        first component, their contribution is zero anyway.
+
+    Note
+    ----
+    Every derivative is broadcast and padded to the common shape
+    *(..., n_freq, k)* and then copied in the output. If even one of them is
+    pixel-dependent, the output stores all of them for every pixel (and with
+    *k* columns), which can take much more memory than the inputs.
+    """
+    cols = [np.arange(n_comp)[c[0]] for c in comp_of_dB]
+    n_col = max(len(c) for c in cols)
+    shape = np.broadcast_shapes(*[A_dB_i.shape[:-1] for A_dB_i in A_dB])
+    shape = (1,) * (n_extra_dim + 1 - len(shape)) + shape
     res = []
-    for comp_of_dB_i, A_dB_i in zip(comp_of_dB, A_dB):
-        # res = v^t e^-2 v A_dB (1 - u u^t) - v^t e^-1 u^t A_dB v^t e^-1 u^t
-        inve_v = v / e[..., np.newaxis]
-        slice_inve_v = inve_v[(Ellipsis,)+comp_of_dB_i]
-        res_i = _mm(_mtm(inve_v, slice_inve_v), _T(A_dB_i))
-        res_i -= _mmm(res_i, u, _T(u))
-        res_i -= _mmm(_mmm(_T(inve_v), _T(u), A_dB_i),
-                      _T(slice_inve_v), _T(u))
-        res.append(res_i)
-    return np.array(res)
+    res_cols = np.zeros((len(A_dB), n_col), dtype=int)
+    for i, (A_dB_i, cols_i) in enumerate(zip(A_dB, cols)):
+        A_dB_i = xp.broadcast_to(A_dB_i, shape + (len(cols_i),))
+        if len(cols_i) < n_col:
+            padding = xp.zeros(shape + (n_col - len(cols_i),),
+                               dtype=A_dB_i.dtype)
+            A_dB_i = xp.concatenate([A_dB_i, padding], axis=-1)
+        res.append(A_dB_i)
+        res_cols[i, :len(cols_i)] = cols_i
+    return xp.stack(res), res_cols
+
+
+def _A_dB_s(A_dB, cols, s):
+    # A_dB and cols as returned by _stack_A_dB, s has shape (..., n_comp),
+    # whose `...` has at most as many dimensions as the ones of A_dB.
+    # Output: A_dB[i] s[..., cols[i]] for every i, shape (n_dB, ..., n_freq)
+    return _mv(A_dB, xp.moveaxis(s[..., cols], -2, 0))
 
 
 def W_dB(A, A_dB, comp_of_dB, invN=None, return_svd=False):
@@ -349,37 +834,65 @@ def _P_dBdB_svd(u_e_v, A_dB, A_dBdB, comp_of_dB):
     u, e, v = u_e_v
     n_dB = len(A_dB)
 
-    # Expand A_dB and A_dBdB to full shape
-    A_dB_full = np.zeros((n_dB,)+u.shape)
-    A_dBdB_full = np.zeros((n_dB, n_dB)+u.shape)
-    for i in range(n_dB):
-        A_dB_full[(i, Ellipsis) + comp_of_dB[i]] = A_dB[i]
-        for j in range(n_dB):
-            A_dBdB_full[(i, j, Ellipsis)+comp_of_dB[i]] = A_dBdB[i][j]
-
-    # Apply diag(e^(-1)) * v to the domain of the components
-    # In this basis A' = u and (A'^t A') = 1
-    inve_v = v / e[..., np.newaxis]
-    A_dB = _mm(A_dB_full, _T(inve_v))
-    A_dBdB = _mm(A_dBdB_full, _T(inve_v))
+    # Move to the basis in which A' = u and (A'^t A') = 1. A_dB and A_dBdB are
+    # compressed (they contain only the columns in comp_of_dB): multiply them
+    # only by the corresponding rows of diag(e^(-1)) * v
+    A_dB = _whiten_A_dB(u_e_v, A_dB, comp_of_dB)
 
     # Aliases that improve readability
     A = u
-    A_dBj = A_dB
-    A_dBi = A_dBj[:, np.newaxis, ...]
-    mm = lambda *args: reduce(np.matmul, args)
     D = _D_svd(u_e_v)
+    D_A_dB = [_mm(D, A_dB_i) for A_dB_i in A_dB]
+    At_A_dB = [_mtm(A, A_dB_i) for A_dB_i in A_dB]
+
+    # P_dBdB is symmetric in the parameters: compute only the upper triangle
+    P_dBdB = [[None] * n_dB for i in range(n_dB)]
+    for i in range(n_dB):
+        for j in range(i, n_dB):
+            # Derivative of P_dB_j with respect to the i-th parameter
+            # The terms that start with A are collected (and multiplied by A)
+            # at the end, so that the contractions are over the components
+            At_res = (+ _mm(_T(At_A_dB[j]), _T(D_A_dB[i]))
+                      + _mm(_T(At_A_dB[i]), _T(D_A_dB[j]))
+                      + _mm(_mtm(D_A_dB[i], A_dB[j]), _T(A)))
+            A_dBdB_ij = _whiten_A_dBdB(u_e_v, A_dBdB[i][j], comp_of_dB[i])
+            if A_dBdB_ij is not None:
+                At_res = At_res - _mtm(A_dBdB_ij, D)
+            res = _mm(D_A_dB[j], _T(D_A_dB[i])) - _mm(A, At_res)
+            P_dBdB[i][j] = P_dBdB[j][i] = res + _T(res)
+
+    return _stack_nested(P_dBdB)
+
+
+def _stack_nested(arrays):
+    # Stack a list of lists of arrays, broadcasting them to the same shape
+    shape = np.broadcast_shapes(*[a.shape for row in arrays for a in row])
+    return xp.stack([xp.stack([xp.broadcast_to(a, shape) for a in row])
+                     for row in arrays])
+
+
+def _whiten_A_dB(u_e_v, A_dB, comp_of_dB):
+    """ Derivatives of A in the basis in which A = u
+
+    *A_dB* contains only the columns of A selected by *comp_of_dB*: it is
+    multiplied only by the corresponding rows of ``diag(e^(-1)) * v``. The
+    results are not compressed.
+    """
+    _, e, v = u_e_v
+    inve_v = v / e[..., np.newaxis]
+    return [_mm(A_dB_i, _T(inve_v[(Ellipsis,) + comp_of_dB_i]))
+            for comp_of_dB_i, A_dB_i in zip(comp_of_dB, A_dB)]
+
 
-    # Computation
-    P_dBdB = (+ mm(D, A_dBj, _T(A_dBi), D)
-              - mm(A, _T(A_dBj), A, _T(A_dBi), D)
-              + mm(A, _T(A_dBdB), D)
-              - mm(A, _T(A_dBi), A, _T(A_dBj), D)
-              - mm(A, _T(A_dBi), D, A_dBj, _T(A))
-             )
-    P_dBdB += _T(P_dBdB)
+def _whiten_A_dBdB(u_e_v, A_dBdB_ij, comp_of_dB_i):
+    """ As :func:`_whiten_A_dB` for a single second derivative
 
-    return P_dBdB
+    Return ``None`` if the second derivative is zero. It is typically the case
+    for parameters of different components
+    """
+    if not xp.any(A_dBdB_ij):
+        return None
+    return _whiten_A_dB(u_e_v, [A_dBdB_ij], [comp_of_dB_i])[0]
 
 
 def P_dBdB(A, A_dB, A_dBdB, comp_of_dB, invN=None, return_svd=False):
@@ -442,45 +955,41 @@ def _W_dBdB_svd(u_e_v, A_dB, A_dBdB, comp_of_dB):
     u, e, v = u_e_v
     n_dB = len(A_dB)
 
-    # Expand A_dB and A_dBdB to full shape
-    A_dB_full = np.zeros((n_dB,)+u.shape)
-    A_dBdB_full = np.zeros((n_dB, n_dB)+u.shape)
-    for i in range(n_dB):
-        A_dB_full[(i, Ellipsis) + comp_of_dB[i]] = A_dB[i]
-        for j in range(n_dB):
-            A_dBdB_full[(i, j, Ellipsis)+comp_of_dB[i]] = A_dBdB[i][j]
-
-    # Apply diag(e^(-1)) * v to the domain of the components
-    # In this basis A' = u and (A'^t A') = 1
+    # Move to the basis in which A' = u and (A'^t A') = 1. A_dB and A_dBdB are
+    # compressed (they contain only the columns in comp_of_dB): multiply them
+    # only by the corresponding rows of diag(e^(-1)) * v
     inve_v = v / e[..., np.newaxis]
-    A_dB = _mm(A_dB_full, _T(inve_v))
-    A_dBdB = _mm(A_dBdB_full, _T(inve_v))
+    A_dB = _whiten_A_dB(u_e_v, A_dB, comp_of_dB)
 
     # Aliases that improve readability
     A = u
-    A_dBj = A_dB
-    A_dBi = A_dBj[:, np.newaxis, ...]
 
     # Compute the derivatives of M = (A^t A)^(-1)
-    M_dBj = - _mtm(A_dBj, A)
-    M_dBj += _T(M_dBj)
-    M_dBi = M_dBj[:, np.newaxis, ...]
+    At_A_dB = [_mtm(A, A_dB_i) for A_dB_i in A_dB]
+    M_dB = [- At_A_dB_i - _T(At_A_dB_i) for At_A_dB_i in At_A_dB]
 
-    M_dBdB = (- _mmm(M_dBj, _T(A_dBi), A)
-              - _mtm(A_dBdB, A)
-              - _mtm(A_dBi, A_dBj)
-              - _mmm(_T(A_dBi), A, M_dBj))
-    M_dBdB += _T(M_dBdB)
+    # W_dBdB is symmetric in the parameters: compute only the upper triangle
+    W_dBdB = [[None] * n_dB for i in range(n_dB)]
+    for i in range(n_dB):
+        for j in range(i, n_dB):
+            A_dBdB_ij = _whiten_A_dBdB(u_e_v, A_dBdB[i][j], comp_of_dB[i])
+            M_dBdB_ij = (- _mm(M_dB[j], _T(At_A_dB[i]))
+                         - _mtm(A_dB[i], A_dB[j])
+                         - _mm(_T(At_A_dB[i]), M_dB[j]))
+            if A_dBdB_ij is not None:
+                M_dBdB_ij = M_dBdB_ij - _mtm(A_dBdB_ij, A)
+            M_dBdB_ij = M_dBdB_ij + _T(M_dBdB_ij)
 
-    W_dBdB = (_mm(M_dBdB, _T(A))
-              + _mm(M_dBi, _T(A_dBj))
-              + _mm(M_dBj, _T(A_dBi))
-              + _T(A_dBdB))
+            res = (_mm(M_dBdB_ij, _T(A))
+                   + _mm(M_dB[i], _T(A_dB[j]))
+                   + _mm(M_dB[j], _T(A_dB[i])))
+            if A_dBdB_ij is not None:
+                res = res + _T(A_dBdB_ij)
 
-    # Move back to the original basis
-    W_dBdB = _mtm(inve_v, W_dBdB)
+            # Move back to the original basis
+            W_dBdB[i][j] = W_dBdB[j][i] = _mtm(inve_v, res)
 
-    return W_dBdB
+    return _stack_nested(W_dBdB)
 
 
 def W_dBdB(A, A_dB, A_dBdB, comp_of_dB, invN=None, return_svd=False):
@@ -547,33 +1056,39 @@ def _logL_dB_svd(u_e_v, d, A_dB, comp_of_dB):
     Dd = d - _mv(u, utd)
     with np.errstate(divide='ignore'):
         s = _mtv(v, utd / e)
-    s[~np.isfinite(s)] = 0.
-
-    diff = []
-    # Iterate over the parameter types (i.e. over A_dB), compute log_dB
-    # and append it to diff        
-    for par_comp_of_dB, par_A_dB in zip(comp_of_dB, A_dB):
-        # A_dB is compressed: it contains only the column that acts
-        # on the following slice of s
-        s_comp = s[..., par_comp_of_dB[0]]
-        dt_D_A_dB_s = _mv(par_A_dB, s_comp) * Dd  # Only product, not sum
+    s = xp.where(xp.isfinite(s), s, 0.)
+
+    # Stack all the parameters along the first axis and compute
+    # d^t D A_dB s for all of them at once
+    A_dB, cols = _stack_A_dB(A_dB, comp_of_dB, s.shape[-1], s.ndim - 1)
+    dt_D_A_dB_s = _A_dB_s(A_dB, cols, s) * Dd  # Only product, not sum
+
+    if _is_simple_comp_of_dB(comp_of_dB):
+        # The `...` dimensions were not partitioned in sub-domains over
+        # which the parameters are fitted independently
+        # -> do the sum and produce only one value per parameter
+        return dt_D_A_dB_s.reshape(len(comp_of_dB), -1).sum(-1)
+
+    dt_D_A_dB_s = dt_D_A_dB_s.sum(-1)
+
+    # comp_of_dB specified the domains over which the sky is partitioned.
+    # They are indexed by ids. Accumulate dt_D_A_dB_s for the entries that
+    # share the same id. The size of the output vector for each parameter is
+    # the number of domains. The ids of different parameters are offset so
+    # that a single bincount produces all of them.
+    # NOTE: it assumes that ids doesn't have any missing values
+    all_ids = np.empty(dt_D_A_dB_s.shape, dtype=int)  # Index arithmetic
+    offset = 0
+    for par_comp_of_dB, par_ids in zip(comp_of_dB, all_ids):
         try:
-            ids = np.array(np.broadcast_to(par_comp_of_dB[1].T,
-                                           s.T[0].shape)).T
+            ids = np.broadcast_to(par_comp_of_dB[1].T, par_ids.T.shape).T
         except IndexError:
-            # The `...` dimensions were not partitioned in sub-domains over
-            # which the parameters are fitted independently
-            # -> do the sum and produce only one value
-            diff.append(np.array([dt_D_A_dB_s.sum()]))
-        else:
-            # comp_of_dB specified the domains over which the sky 
-            # is partitioned. They are indexed by ids.
-            # Accumulate dt_D_A_dB_s for the entries that share the same id.
-            # The size of the output vector is the number of domains.
-            # NOTE: it assumes that ids doesn't have any missing values
-            diff.append(np.bincount(
-                ids.ravel(), (_mv(par_A_dB, s_comp) * Dd).sum(-1).ravel()))
-    return np.concatenate(diff)
+            # Parameter not partitioned: all the entries share the same id
+            ids = 0
+        par_ids[...] = ids
+        par_ids += offset
+        offset = par_ids.max() + 1
+    return xp.bincount(xp.asarray(all_ids.ravel()), dt_D_A_dB_s.ravel())
 
 
 def logL_dB(A, d, invN, A_dB, comp_of_dB=np.s_[:], return_svd=False):
@@ -691,12 +1206,16 @@ def _fisher_logL_dB_dB_svd(u_e_v, s, A_dB, comp_of_dB):
     _raise_if_not_simple_comp_of_dB(comp_of_dB)
     u, _, _ = u_e_v
 
-    D_A_dB_s = []
-    for i in range(len(A_dB)):
-        A_dB_s = _mv(A_dB[i], s[(Ellipsis,) + comp_of_dB[i]])
-        D_A_dB_s.append(A_dB_s - _mv(u, _mtv(u, A_dB_s)))
+    # Stack all the parameters along the first axis and compute
+    # D A_dB s for all of them at once
+    A_dB, cols = _stack_A_dB(A_dB, comp_of_dB, s.shape[-1],
+                             max(s.ndim - 1, u.ndim - 2))
+    A_dB_s = _A_dB_s(A_dB, cols, s)
+    D_A_dB_s = A_dB_s - _mv(u, _mtv(u, A_dB_s))
 
-    return np.array([[np.sum(i*j) for i in D_A_dB_s] for j in D_A_dB_s])
+    # The fisher is the Gram matrix of the D A_dB s
+    D_A_dB_s = D_A_dB_s.reshape(len(D_A_dB_s), -1)
+    return xp.matmul(D_A_dB_s, D_A_dB_s.T)
 
 
 def fisher_logL_dB_dB(A, s, A_dB, comp_of_dB, invN=None, return_svd=False):
@@ -710,8 +1229,26 @@ def fisher_logL_dB_dB(A, s, A_dB, comp_of_dB, invN=None, return_svd=False):
     return res
 
 
+@contextmanager
+def _no_stage(name):
+    yield
+
+
+def _columns_of_x(comp_of_dB, n_x):
+    # Columns of A that depend on each entry of x (None if it is not known)
+    if comp_of_dB is None:
+        return None
+    if not isinstance(comp_of_dB, list):
+        comp_of_dB = [comp_of_dB] * n_x
+    comp_of_dB = [_turn_into_slice_if_integer(c) for c in comp_of_dB]
+    if len(comp_of_dB) != n_x or not _is_simple_comp_of_dB(comp_of_dB):
+        return None
+    return [c[0] for c in comp_of_dB]
+
+
 def _build_bound_inv_logL_and_logL_dB(A_ev, d, invN,
-                                      A_dB_ev=None, comp_of_dB=None):
+                                      A_dB_ev=None, comp_of_dB=None,
+                                      profiler=None, columns_of_x=None):
     # XXX: Turn this function into a class?
     """ Produce the functions -logL(x) and -logL_dB(x)
 
@@ -719,36 +1256,105 @@ def _build_bound_inv_logL_and_logL_dB(A_ev, d, invN,
     If x of the next call coincide with the last one, recycle the pre-computed
     quantities. It gives ~2x speedup if you often compute both -logL and
     -logL_dB for the same x.
+    If a :class:`Profiler` is provided, the evaluations are counted and timed.
+
+    If *columns_of_x* is provided (see `_columns_of_x`), -logL(x) is updated
+    incrementally when x differs from the last one only in entries that
+    affect a subset of the columns of A. The columns that did not change are
+    orthonormalized (and cached) once, the columns that changed are
+    orthogonalized against them and only this rank-k block is factorized.
     """
     L = [None]
     x_old = [None]
     u_e_v_old = [None]
     A_dB_old = [None]
     pw_d = [None]
+    pw_A_old = [None]  # Stored only for the incremental updates
+    fixed_bases = {}  # Columns that did not change -> their basis and -logL
+    stage = _no_stage if profiler is None else profiler.stage
 
     def _update_old(x):
         # If x is different from the last one, update the SVD
         if not np.all(x == x_old[0]):
-            u_e_v_old[0], L[0] = _svd_sqrt_invN_A(A_ev(x), invN, L[0])
+            with stage('sed'):
+                A = A_ev(x)
+            if invN is not None:
+                with stage('prewhiten'):
+                    if L[0] is None:
+                        L[0] = _cholesky_invN(invN)
+                    A = _mtm(L[0], A)
+            with stage('svd'):
+                u_e_v_old[0] = xp.linalg.svd(A, full_matrices=False)
+            if columns_of_x is not None:
+                pw_A_old[0] = A
+                fixed_bases.clear()
             if A_dB_ev is not None:
-                if L[0] is None:
-                    A_dB_old[0] = A_dB_ev(x)
-                else:
-                    A_dB_old[0] = [_mtm(L[0], A_dB_i) for A_dB_i in A_dB_ev(x)]
+                with stage('sed_dB'):
+                    A_dB = A_dB_ev(x)
+                if L[0] is not None:
+                    with stage('prewhiten'):
+                        A_dB = [_mtm(L[0], A_dB_i) for A_dB_i in A_dB]
+                A_dB_old[0] = A_dB
             x_old[0] = x
             if pw_d[0] is None:  # If this is the first call, prewhiten d
                 if L[0] is None:
                     pw_d[0] = d
                 else:
-                    pw_d[0] = _mtv(L[0], d)
+                    with stage('prewhiten'):
+                        pw_d[0] = _mtv(L[0], d)
+
+    def _moving_columns(x):
+        # Columns of A that change with respect to x_old, if they are only some
+        if columns_of_x is None or x_old[0] is None:
+            return None
+        n_comp = pw_A_old[0].shape[-1]
+        changed = np.flatnonzero(np.asarray(x) != x_old[0])
+        if not changed.size:
+            return None
+        columns = np.unique(np.concatenate(
+            [np.arange(n_comp)[columns_of_x[i]] for i in changed]))
+        if columns.size == n_comp:
+            return None
+        return columns
+
+    def _incremental_inv_logL(x, moving):
+        fixed = tuple(np.setdiff1d(np.arange(pw_A_old[0].shape[-1]), moving))
+        if fixed not in fixed_bases:
+            with stage('svd'):
+                q_fixed = xp.linalg.qr(pw_A_old[0][..., list(fixed)])[0]
+            with stage('logL'):
+                fixed_bases[fixed] = (q_fixed,
+                                      _logL_svd((q_fixed,), pw_d[0]))
+        q_fixed, logL_fixed = fixed_bases[fixed]
+        with stage('sed'):
+            A_moving = A_ev(x)[..., list(moving)]
+        if L[0] is not None:
+            with stage('prewhiten'):
+                A_moving = _mtm(L[0], A_moving)
+        with stage('svd'):
+            # Gram-Schmidt, twice for numerical stability
+            A_moving = A_moving - _mm(q_fixed, _mtm(q_fixed, A_moving))
+            A_moving = A_moving - _mm(q_fixed, _mtm(q_fixed, A_moving))
+            q_moving = xp.linalg.qr(A_moving)[0]
+        with stage('logL'):
+            return float(- logL_fixed - _logL_svd((q_moving,), pw_d[0]))
 
     def _inv_logL(x):
+        moving = _moving_columns(x)
         try:
-            _update_old(x)
+            if moving is None:
+                _update_old(x)
+            else:
+                res = _incremental_inv_logL(x, moving)
         except np.linalg.linalg.LinAlgError:
             print('SVD of A failed -> logL = -inf')
             return np.inf
-        return - _logL_svd(u_e_v_old[0], pw_d[0])
+        if moving is None:
+            with stage('logL'):
+                res = float(- _logL_svd(u_e_v_old[0], pw_d[0]))
+        if profiler is not None:
+            profiler._last_logL = (x, res)
+        return res
 
     if A_dB_ev is None:
         def _inv_logL_dB(x):
@@ -759,14 +1365,17 @@ def _build_bound_inv_logL_and_logL_dB(A_ev, d, invN,
                 _update_old(x)
             except np.linalg.linalg.LinAlgError:
                 print('SVD of A failed -> logL_dB not updated')
-            return - _logL_dB_svd(u_e_v_old[0], pw_d[0],
-                                  A_dB_old[0], comp_of_dB)
+            with stage('logL_dB'):
+                return _to_numpy(- _logL_dB_svd(u_e_v_old[0], pw_d[0],
+                                                A_dB_old[0], comp_of_dB))
 
-    return _inv_logL, _inv_logL_dB, (u_e_v_old, A_dB_old, x_old, pw_d)
+    return (_inv_logL, _inv_logL_dB,
+            (u_e_v_old, A_dB_old, x_old, pw_d, _update_old))
 
 
 def comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB,
-             *minimize_args, **minimize_kwargs):
+             *minimize_args, outputs=None, profiler=None, incremental=False,
+             group_by_coverage=False, **minimize_kwargs):
     """ Perform component separation
 
     Build the (inverse) spectral likelihood and minimize it to estimate the
@@ -780,9 +1389,14 @@ def comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB,
         argument and returns the mixing matrix, a ndarray with shape
         *(..., n_freq, n_comp)*
     d: ndarray
-        The data vector. Shape *(..., n_freq)*.
+        The data vector. Shape *(..., n_freq)*. If it is single precision,
+        *s* and *chi* are computed and returned in single precision. The
+        spectral likelihood is always evaluated in the precision of *A*.
     invN: ndarray or None
         The inverse noise matrix. Shape *(..., n_freq, n_freq)*.
+        The frequencies whose diagonal element is zero are not observed in
+        that block, which must observe at least *n_comp* frequencies (or
+        none).
     A_dB_ev : function
         The evaluator of the derivative of the mixing matrix.
         It returns a list, each entry is the derivative with respect to a
@@ -802,6 +1416,29 @@ def comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB,
         Positional arguments to be passed to `scipy.optimize.minimize`.
         At this moment it just contains *x0*, the initial guess for the spectral
         parameters
+    outputs: str or list of str
+        Per-pixel products to compute and return, among ``'s'``,
+        ``'invAtNA'``, ``'chi'`` and ``'chi_dB'``. By default, all of them.
+        The products that are not requested are neither computed nor stored.
+    profiler: Profiler
+        If provided, it counts and times the stages of the component
+        separation and records every iteration of the minimizer.
+    incremental: bool
+        If true, when *x* changes only in the parameters of some components,
+        the likelihood is computed by factorizing only their (rank-k) columns
+        of A against a cached basis of the other columns, instead of
+        recomputing the SVD of the full A. It speeds up numerical derivatives
+        (*A_dB_ev* is ``None``) and minimizers that move few parameters at the
+        time (e.g. ``method='Powell'``). It requires *comp_of_dB* with only
+        the component index.
+    group_by_coverage: bool
+        If true and the mixing matrix is the same in all the pixels (the
+        first dimension of *d* and *invN*), the spectral likelihood is
+        evaluated once for each group of pixels with the same block of *invN*
+        (e.g. the same frequencies observed and the same noise), on their
+        compressed data. It speeds up the fit of maps with few distinct
+        coverage patterns and noise levels. If the blocks of *invN* are all
+        different, checking the groups costs a full scan of *invN*.
     minimize_kwargs: dict
         Keyword arguments to be passed to `scipy.optimize.minimize`.
         A good choice for most cases is
@@ -824,20 +1461,37 @@ def comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB,
         - **s**: *(ndarray)* - Separated components, Shape *(..., n_comp)*
         - **invAtNA** : *(ndarray)* - Covariance of the separated components.
           Shape *(..., n_comp, n_comp)*
+        - **chi** : *(ndarray)* - Residuals of the fit, prewhitened.
+          Shape *(..., n_freq)*
+        - **chi_dB** : *(list)* - Projection of *chi* on the derivative of
+          the data model with respect to each parameter.
+        - **profile** : *(dict)* - Summary of the *profiler* (see
+          :meth:`Profiler.summary`), if provided.
 
     Note
     ----
     The *...* in the arguments denote any extra set of dimension. They have to
     be compatible among different arguments in the `numpy` broadcasting sense.
     """
+    map_dtype = _map_dtype(d)
+    outputs = _check_outputs(outputs)
+    stage = _no_stage if profiler is None else profiler.stage
+
     # If mixing matrix is fixed, separate and return
     if isinstance(A_ev, np.ndarray):
         res = sp.optimize.OptimizeResult()
-        res.s, (u_e_v, L) = Wd(A_ev, d, invN, True)
-        res.invAtNA = _invAtNA_svd(u_e_v)
-        if L is not None:
-            d = _mtv(L, d)
-        res.chi = d - _As_svd(u_e_v, res.s)
+        A = A_ev
+        if invN is not None:
+            with stage('prewhiten'):
+                L = _cholesky_invN(invN)
+                A = _mtm(L, A)
+                d = _mtv(L, d)
+        with stage('svd'):
+            u_e_v = _svd_sqrt_invN_A(A)[0]
+        with stage('maps'):
+            _gather_outputs(res, outputs, u_e_v, d, map_dtype)
+        if profiler is not None:
+            res.profile = profiler.summary()
         return res
     else:
         # Mixing matrix has free paramters: check that x0 was provided
@@ -845,59 +1499,116 @@ def comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB,
         assert len(minimize_args[0])
 
     # Check input
+    columns_of_x = _columns_of_x(comp_of_dB, len(minimize_args[0]))
     if A_dB_ev is not None:
         A_dB_ev, comp_of_dB = _A_dB_ev_and_comp_of_dB_as_compatible_list(
             A_dB_ev, comp_of_dB, minimize_args[0])
+    elif columns_of_x is not None:
+        # Numerical derivatives: comp_of_dB only locates the columns of x
+        comp_of_dB = [(c,) for c in columns_of_x]
+    else:
+        comp_of_dB = None
     if 'options' in minimize_kwargs and 'disp' in minimize_kwargs['options']:
         disp = minimize_kwargs['options']['disp']
     else:
         disp = False
 
+    return_profile = profiler is not None
+    if disp and profiler is None and 'callback' not in minimize_kwargs:
+        # Only for printing the iterations, its summary is not returned
+        profiler = Profiler(verbose_record_callback())
+        stage = profiler.stage
+
+    # Fit the compressed data of the pixels with the same coverage and noise
+    fit_d, fit_invN = d, invN
+    if (group_by_coverage and np.ndim(invN) > 2
+            and (comp_of_dB is None or _is_simple_comp_of_dB(comp_of_dB))):
+        groups = _group_by_coverage(d, invN)
+        if groups is not None:
+            with stage('sed'):
+                if np.ndim(A_ev(minimize_args[0])) == 2:
+                    fit_d, fit_invN = groups
+
     # Prepare functions for minimize
     fun, jac, last_values = _build_bound_inv_logL_and_logL_dB(
-        A_ev, d, invN, A_dB_ev, comp_of_dB)
+        A_ev, fit_d, fit_invN, A_dB_ev, comp_of_dB, profiler,
+        columns_of_x if incremental else None)
     minimize_kwargs['jac'] = jac
 
     # Gather minmize arguments
-    if disp and 'callback' not in minimize_kwargs:
-        minimize_kwargs['callback'] = verbose_callback()
+    if profiler is not None:
+        profiler._start()
+        minimize_kwargs['callback'] = profiler._callback(
+            minimize_kwargs.get('callback'))
 
     # Likelihood maximization
     res = sp.optimize.minimize(fun, *minimize_args, **minimize_kwargs)
 
     # Gather results
-    u_e_v_last, A_dB_last, x_last, pw_d = last_values
+    if fit_d is not d:  # The maps require all the pixels
+        last_values = _build_bound_inv_logL_and_logL_dB(
+            A_ev, d, invN, A_dB_ev, comp_of_dB, profiler)[2]
+    u_e_v_last, A_dB_last, x_last, pw_d, update_last = last_values
     if not np.all(x_last[0] == res.x):
-        fun(res.x) #  Make sure that last_values refer to the minimum
+        update_last(res.x) #  Make sure that last_values refer to the minimum
 
-    res.s = _Wd_svd(u_e_v_last[0], pw_d[0])
-    res.invAtNA = _invAtNA_svd(u_e_v_last[0])
-    res.chi = pw_d[0] - _As_svd(u_e_v_last[0], res.s)
-    
-    if _is_simple_comp_of_dB(comp_of_dB):
-        if A_dB_ev is None:
-            fisher = numdifftools.Hessian(fun)(res.x)  # TODO: something cheaper
-        else:
-            fisher = _fisher_logL_dB_dB_svd(u_e_v_last[0], res.s,
-                                            A_dB_last[0], comp_of_dB)
-            As_dB = (_mv(A_dB_i, res.s[(Ellipsis,) + comp_of_dB_i])
-                     for A_dB_i, comp_of_dB_i in zip(A_dB_last[0], comp_of_dB))
-            res.chi_dB = []
-            for comp_of_dB_i, As_dB_i in zip(comp_of_dB, As_dB):
-                with np.errstate(divide='ignore', invalid='ignore'):
-                    res.chi_dB.append(np.sum(res.chi * As_dB_i, -1)
-                                      / np.linalg.norm(As_dB_i, axis=-1))
+    with stage('maps'):
+        s, chi = _gather_outputs(res, outputs, u_e_v_last[0], pw_d[0],
+                                 map_dtype)
+
+    if comp_of_dB is not None and _is_simple_comp_of_dB(comp_of_dB):
+        with stage('fisher'):
+            if A_dB_ev is None:
+                # TODO: something cheaper
+                fisher = numdifftools.Hessian(fun)(res.x)
+            else:
+                if s is None:
+                    s = _s_chi_svd(u_e_v_last[0], pw_d[0], map_dtype,
+                                   False)[0]
+                fisher = _to_numpy(_fisher_logL_dB_dB_svd(
+                    u_e_v_last[0], s, A_dB_last[0], comp_of_dB))
+        if A_dB_ev is not None and 'chi_dB' in outputs:
+            with stage('maps'):
+                chi = _to_numpy(chi)
+                As_dB = (_to_numpy(_mv(A_dB_i, s[(Ellipsis,) + comp_of_dB_i]))
+                         for A_dB_i, comp_of_dB_i
+                         in zip(A_dB_last[0], comp_of_dB))
+                res.chi_dB = []
+                for comp_of_dB_i, As_dB_i in zip(comp_of_dB, As_dB):
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        res.chi_dB.append((np.sum(chi * As_dB_i, -1)
+                                           / np.linalg.norm(As_dB_i, axis=-1)
+                                           ).astype(map_dtype, copy=False))
         try:
             res.Sigma = np.linalg.inv(fisher)
         except np.linalg.LinAlgError:
             res.Sigma = fisher * np.nan
         res.Sigma_inv = fisher
 
+    if return_profile:
+        res.profile = profiler.summary()
     return res
 
 
+def _gather_outputs(res, outputs, u_e_v, d, dtype):
+    # Store in res the requested products that depend only on u_e_v and d
+    # Return s and chi (None if they are not needed by the requested products)
+    s = chi = None
+    if set(outputs) & {'s', 'chi', 'chi_dB'}:
+        s, chi = _s_chi_svd(u_e_v, d, dtype,
+                            'chi' in outputs or 'chi_dB' in outputs)
+    if 's' in outputs:
+        res.s = _to_numpy(s)
+    if 'invAtNA' in outputs:
+        res.invAtNA = _to_numpy(_invAtNA_svd(u_e_v))
+    if 'chi' in outputs:
+        res.chi = _to_numpy(chi)
+    return s, chi
+
+
 def multi_comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB, patch_ids,
-                   *minimize_args, **minimize_kargs):
+                   *minimize_args, outputs=None, checkpoint=None,
+                   **minimize_kargs):
     """ Perform component separation
 
     Run an independent :func:`comp_sep` for entries identified by *patch_ids*
@@ -928,13 +1639,22 @@ def multi_comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB, patch_ids,
         the component dimension of A (the last one) that is affected by the
         derivative: ``A_dB_ev(x)[i]`` is assumed to be the derivative of
         ``A[..., comp_of_dB[i]]``.
-    patch_ids : array
-        id of regions.
+    patch_ids : array or PatchIndex
+        id of regions. Provide a :class:`PatchIndex` to avoid rebuilding it
+        at every call.
     minimize_args : list
         Positional arguments to be passed to `scipy.optimize.minimize`.
         At this moment, it just contains *x0*, the initial guess for the
         spectral parameters. It is required if A_ev is a function and ignored
         otherwise.
+    outputs: str or list of str
+        Per-pixel products to compute and return. See :func:`comp_sep`. The
+        full-size maps of the products that are not requested are not
+        allocated.
+    checkpoint: Checkpoint
+        If provided, the result of each patch is stored as soon as it is
+        computed. The patches whose result is already stored (e.g. by a
+        previous, interrupted, run) are not fitted again.
     minimize_kwargs : dict
         Keyword arguments to be passed to `scipy.optimize.minimize`.
         A good choice for most cases is
@@ -943,6 +1663,7 @@ def multi_comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB, patch_ids,
         difference between the best fit -logL and the minimum is way less
         than 1, without exagerating (a difference of 1e-4 is useless).
         *disp* also triggers a verbose callback that monitors the convergence.
+        A :class:`Profiler` passed as *profiler* is shared by all the patches.
 
     Returns
     -------
@@ -957,9 +1678,16 @@ def multi_comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB, patch_ids,
           patch.  Shape *(n_patches, n_param, n_param)*
         - **s**: *(ndarray)* - Separated components, collected from all the
           patches.  Shape *(..., n_comp)*
-        - **patch_res**: *(list)* - the i-th entry is the result of
+        - **invAtNA**, **chi**, **chi_dB**: Same as **s**. If *invAtNA* is
+          the same for all the entries of each patch, it is stored once per
+          patch in ``patch_res.shared`` and **invAtNA** is a read-only view
+          that broadcasts it to the entries (see
+          :meth:`PatchResults.expand`). Use ``np.array(res.invAtNA)`` for a
+          writable, per-entry copy.
+        - **patch_res**: *(PatchResults)* - the i-th entry is the result of
           :func:`comp_sep` on ``patch_ids == i`` (with the exception of the
-          quantities collected from all the patches)
+          quantities collected from all the patches). The results are
+          stored by column (see :class:`PatchResults`).
 
     Note
     ----
@@ -967,8 +1695,10 @@ def multi_comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB, patch_ids,
     be compatible among different arguments in the `numpy` broadcasting sense.
     """
     # TODO: add the possibility of patch specific x0
-    assert np.all(patch_ids >= 0)
-    max_id = patch_ids.max()
+    if not isinstance(patch_ids, PatchIndex):
+        patch_ids = PatchIndex(patch_ids)
+    patch_index = patch_ids
+    outputs = _check_outputs(outputs)
 
     def patch_comp_sep(patch_id):
         if isinstance(A_ev, list):
@@ -986,81 +1716,348 @@ def multi_comp_sep(A_ev, d, invN, A_dB_ev, comp_of_dB, patch_ids,
             patch_A_dB_ev = A_dB_ev
             patch_comp_of_dB = comp_of_dB
 
-        patch_mask = patch_ids == patch_id
-        if not np.any(patch_mask):
+        if patch_index.is_empty(patch_id):
             return None
-        patch_d = d[patch_mask]
+        if checkpoint is not None:
+            patch_res = checkpoint.load('patch_%i' % patch_id)
+            if patch_res is not None:
+                return patch_res
+        patch_indexing = patch_index.indexing(patch_id)
+        patch_d = d[patch_indexing]
         if invN is None:
             patch_invN = None
         else:
-            patch_invN = _indexed_matrix(invN, d.shape, patch_mask)
-        return comp_sep(patch_A_ev, patch_d, patch_invN,
-                        patch_A_dB_ev, patch_comp_of_dB,
-                        *minimize_args, **minimize_kargs)
+            patch_invN = _indexed_matrix(invN, d.shape, patch_indexing)
+        patch_res = comp_sep(patch_A_ev, patch_d, patch_invN,
+                             patch_A_dB_ev, patch_comp_of_dB,
+                             *minimize_args, outputs=outputs, **minimize_kargs)
+        if checkpoint is not None:
+            checkpoint.store('patch_%i' % patch_id, patch_res)
+        return patch_res
 
     # Separation
+    # The patches are fitted one at the time and their result is immediately
+    # moved into the per-entry maps and the columns of patch_res
     res = sp.optimize.OptimizeResult()
-    res.patch_res = [patch_comp_sep(patch_id) for patch_id in range(max_id+1)]
-
-    # Collect results
-    n_comp = next(r for r in res.patch_res if r is not None).s.shape[-1]
-    res.s = np.full((d.shape[:-1]+(n_comp,)), np.NaN) # NaN for testing
-    res.invAtNA = np.full((d.shape[:-1]+(n_comp, n_comp)), np.NaN) # NaN for testing
-    res.chi = np.full(d.shape, np.NaN) # NaN for testing
-
-    for patch_id in range(max_id+1):
-        mask = patch_ids == patch_id
-        if np.any(mask):
-            res.s[mask] = res.patch_res[patch_id].s
-            del res.patch_res[patch_id].s
-            res.invAtNA[mask] = res.patch_res[patch_id].invAtNA
-            del res.patch_res[patch_id].invAtNA
-            res.chi[mask] = res.patch_res[patch_id].chi
-            del res.patch_res[patch_id].chi
+    res.patch_res = PatchResults(patch_index, d.shape[:-1])
+    map_dtype = _map_dtype(d)
+    shared_invAtNA = True
+    for patch_id in range(patch_index.n_patch):
+        patch_res = patch_comp_sep(patch_id)
+        if patch_res is None:
+            continue
+        patch_indexing = patch_index.indexing(patch_id)
+        for name in ('s', 'chi', 'invAtNA'):
+            if name not in outputs:
+                continue
+            value = patch_res[name]
+            if name == 'invAtNA' and shared_invAtNA:
+                if res.patch_res.store_shared(patch_id, name, value):
+                    continue
+                shared_invAtNA = False
+                if name in res.patch_res.shared:
+                    # Not shared in this patch: expand the previous ones
+                    res[name] = np.array(res.patch_res.expand(name))
+                    del res.patch_res.shared[name]
+            if name not in res:
+                # NaN for testing
+                if name == 'invAtNA':
+                    res[name] = np.full(d.shape[:-1] + value.shape[-2:],
+                                        np.NaN)
+                else:
+                    res[name] = np.full(d.shape[:-1] + value.shape[-1:],
+                                        np.NaN, map_dtype)
+            res[name][patch_indexing] = value
+        if 'chi_dB' in patch_res:
+            if 'chi_dB' not in res:
+                res.chi_dB = [np.full(d.shape[:-1], np.NaN, map_dtype)
+                              for _ in patch_res.chi_dB]
+            for chi_dB, patch_chi_dB in zip(res.chi_dB, patch_res.chi_dB):
+                chi_dB[patch_indexing] = patch_chi_dB
+        res.patch_res.store(patch_id, patch_res)
+
+    if 'invAtNA' in res.patch_res.shared:
+        # Broadcast view of the compact form, no per-entry copy
+        res.invAtNA = res.patch_res.expand('invAtNA')
+
+    if hasattr(res.patch_res, 'x'):
+        res.x = res.patch_res.x
+        res.Sigma = res.patch_res.Sigma
+
+    if minimize_kargs.get('profiler') is not None:
+        res.profile = minimize_kargs['profiler'].summary()
 
-    try:
-        res.x = np.array([minimize_args[0] * np.nan if r is None else
-                          r.x for r in res.patch_res])
-        res.Sigma = np.array([
-            minimize_args[0] * minimize_args[0][:, np.newaxis] * np.nan
-            if r is None else r.Sigma for r in res.patch_res])
-        for r in res.patch_res:
-            if r is not None:
-                del r.x
-                del r.Sigma
-    except (AttributeError, IndexError):
-        # No Sigma: constant mixing matrix or too too many parameters
-        pass
+    return res
 
-    try:
-        n_param = len(comp_of_dB)
-    except TypeError:
-        n_param = 0
 
-    #TODO: This multipatch chi_dB needs better definition (or should be removed)
+def _compress_pixels(d):
+    """ Equivalent data vector with at most n_freq pixels
+
+    If the mixing matrix and *invN* are the same for all the pixels (the first
+    dimension of *d*), the spectral likelihood, its derivatives and the Fisher
+    matrix depend on the data only through the sum over the pixels of
+    ``d d^t``. The data returned have the same sum (computed independently
+    for each index of the *...* dimensions) but the pixel dimension has
+    length ``min(n_pix, n_freq)``.
+
+    Parameters
+    ----------
+    d: ndarray
+        The data vector. Shape *(n_pix, ..., n_freq)*.
+
+    Returns
+    -------
+    compressed_d: ndarray
+        Shape *(min(n_pix, n_freq), ..., n_freq)*. At least double precision,
+        also for single precision *d*: the likelihood is computed from it.
     """
-    try:
-        # Does not work if patch_ids has more than one dimension
-        for i in range(n_param):
-            shape_chi_dB = patch_ids.shape+res.patch_res[0].chi_dB[i].shape[1:]
-            if i == 0:
-                res.chi_dB = []
-            res.chi_dB.append(np.full(shape_chi_dB, np.NaN)) # NaN for testing
-    except AttributeError:  # No chi_dB (no A_dB_ev)
-        pass
-    else:
-        for i in range(n_param):
-            for patch_id in range(max_id+1):
-                mask = patch_ids == patch_id
-                if np.any(mask):
-                    res.chi_dB[i][mask] = res.patch_res[patch_id].chi_dB[i]
-        if n_param:
-            for r in res.patch_res:
-                if r is not None:
-                    del r.chi_dB
+    # If d = QR, d^t d = R^t R
+    d = np.moveaxis(d, 0, -2)
+    r = np.linalg.qr(d.astype(np.promote_types(d.dtype, np.float64),
+                              copy=False), mode='r')
+    return np.moveaxis(r, -2, 0)
+
+
+def _group_by_coverage(d, invN):
+    """ Compress the pixels that share the same coverage and noise
+
+    The pixels (first dimension of *d* and *invN*) are grouped according to
+    the frequencies they observe, i.e. the non-zero diagonal elements of their
+    blocks of *invN*. If the blocks are the same within each group and the
+    mixing matrix is the same for all the pixels, the spectral likelihood, its
+    derivatives and the Fisher matrix depend on the data of a group only
+    through its compressed data vector (see `_compress_pixels`).
+
+    Parameters
+    ----------
+    d: ndarray
+        The data vector. Shape *(n_pix, ..., n_freq)*.
+    invN: ndarray
+        The inverse noise matrix. Shape *(n_pix, ..., n_freq, n_freq)*.
+
+    Returns
+    -------
+    d, invN: ndarray
+        The data and the inverse noise matrix of the groups. Shapes
+        *(n_group, n_freq, ..., n_freq)* and
+        *(n_group, 1, ..., n_freq, n_freq)*. ``None`` if the blocks differ
+        within a group or if the pixels would not be fewer.
     """
+    invN = _unbroadcast(invN)
+    n_pix, n_freq = d.shape[0], d.shape[-1]
+    if invN.ndim < 3 or invN.shape[0] != n_pix or n_pix == 1:
+        return None
+    coverage = np.diagonal(invN, axis1=-1, axis2=-2) != 0
+    _, first, group = np.unique(coverage.reshape(n_pix, -1), axis=0,
+                                return_index=True, return_inverse=True)
+    group = group.ravel()
+    if len(first) * n_freq >= n_pix or np.any(invN != invN[first][group]):
+        return None
+
+    group_d = []
+    for i_group, i_pix in enumerate(first):
+        # Zero the frequencies that are not observed (they can be UNSEEN)
+        pix_d = d[group == i_group] * coverage[i_pix].astype(invN.dtype)
+        pix_d = _compress_pixels(pix_d)
+        padding = np.zeros((n_freq - len(pix_d),) + pix_d.shape[1:],
+                           pix_d.dtype)
+        group_d.append(np.concatenate((pix_d, padding)))
+    return np.stack(group_d), invN[first][:, np.newaxis]
+
+
+class PatchIndex(object):
+    """ Entries belonging to each patch
+
+    The indices of the entries of each patch are stored contiguously in a
+    single array, in the compressed sparse row (CSR) format: the entries of the
+    *i*-th patch are ``pixels[offsets[i]:offsets[i+1]]``. It is built once,
+    in *O(n_pix log(n_pix))*, and afterwards gathering (or scattering) the
+    entries of all the patches costs *O(n_pix)* in total.
 
-    return res
+    Parameters
+    ----------
+    patch_ids : array
+        Non-negative integer id of the patch of each entry
+
+    Attributes
+    ----------
+    n_patch : int
+        Number of patches, i.e. the maximum id plus one. Some of the patches
+        may be empty.
+    offsets : ndarray
+        Shape *(n_patch + 1,)*
+    pixels : ndarray
+        Indices of the entries (in the flattened *patch_ids*), sorted by patch.
+        Within each patch, they are in increasing order.
+    """
+
+    def __init__(self, patch_ids):
+        patch_ids = np.asarray(patch_ids)
+        assert np.all(patch_ids >= 0)
+        self.shape = patch_ids.shape
+        flat_ids = patch_ids.ravel()
+        self.n_patch = int(flat_ids.max()) + 1
+        counts = np.bincount(flat_ids, minlength=self.n_patch)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.pixels = np.argsort(flat_ids, kind='stable')
+
+    def __len__(self):
+        return self.n_patch
+
+    def is_empty(self, patch_id):
+        return self.offsets[patch_id] == self.offsets[patch_id + 1]
+
+    def pixels_of(self, patch_id):
+        """ Indices of the entries of the patch in the flattened *patch_ids*
+        """
+        return self.pixels[self.offsets[patch_id]:self.offsets[patch_id+1]]
+
+    def patch_ids(self):
+        """ Patch id of each entry, i.e. the *patch_ids* used at construction
+        """
+        patch_ids = np.empty(len(self.pixels), dtype=int)
+        patch_ids[self.pixels] = np.repeat(np.arange(self.n_patch),
+                                           np.diff(self.offsets))
+        return patch_ids.reshape(self.shape)
+
+    def indexing(self, patch_id):
+        """ Index expression selecting the entries of a patch
+
+        ``array[patch_index.indexing(i)]`` is equivalent to
+        ``array[patch_ids == i]`` (for any *array* whose leading dimensions
+        have the shape of *patch_ids*), but it does not scan *patch_ids*.
+        """
+        pixels = self.pixels_of(patch_id)
+        if len(self.shape) == 1:
+            return pixels
+        return np.unravel_index(pixels, self.shape)
+
+
+class PatchResults(object):
+    """ Results of the fit of each patch, stored by column
+
+    Instead of keeping the `OptimizeResult` of each patch fitted by
+    :func:`multi_comp_sep`, the quantities of the fit are gathered in
+    contiguous arrays whose first dimension is the patch (see
+    :attr:`COLUMNS`). In the empty patches, the floating point columns are
+    NaN, the counters are 0, ``success`` is false, ``status`` is -1 and
+    ``message`` is empty.
+
+    The per-entry matrices that are the same for all the entries of a patch
+    (e.g. *invAtNA*, when neither the mixing matrix nor the noise change
+    within the patch) are stored once per patch in :attr:`shared`. They can
+    be expanded to all the entries with :meth:`expand`.
+
+    Indexing returns the result of a patch as an `OptimizeResult` (``None``
+    for empty patches), iterating yields them in order. It contains the
+    columns and the shared matrices, but not the per-entry products (*s*,
+    *chi*, *chi_dB* and the non-shared *invAtNA*, which are collected in
+    the result of :func:`multi_comp_sep`) nor *hess_inv*.
+
+    Parameters
+    ----------
+    patch_index : PatchIndex
+        Patches of the entries
+    entry_shape : tuple
+        Shape of the per-entry products, *d.shape[:-1]* in
+        :func:`multi_comp_sep`
+
+    Attributes
+    ----------
+    <column> : ndarray
+        One attribute for each of the :attr:`COLUMNS`: ``x[i]`` is the
+        best-fit of the i-th patch and so on. They are missing if the mixing
+        matrix has no free parameter (or if the minimizer does not return
+        them).
+    shared : dict
+        Matrices that are the same for all the entries of each patch.
+        Shape *(n_patch, ...)*, where *...* is the shape of the matrix in a
+        single entry (or a shape that broadcasts to it).
+    """
+
+    COLUMNS = ('x', 'Sigma', 'Sigma_inv', 'jac', 'fun', 'nit', 'nfev', 'njev',
+               'success', 'status', 'message')
+    _EMPTY = {'nit': 0, 'nfev': 0, 'njev': 0, 'success': False, 'status': -1,
+              'message': ''}
+
+    def __init__(self, patch_index, entry_shape):
+        self.patch_index = patch_index
+        self.entry_shape = tuple(entry_shape)
+        self.shared = {}
+
+    def __len__(self):
+        return self.patch_index.n_patch
+
+    def __getitem__(self, patch_id):
+        if not -len(self) <= patch_id < len(self):
+            raise IndexError(patch_id)
+        if self.patch_index.is_empty(patch_id % len(self)):
+            return None
+        res = sp.optimize.OptimizeResult()
+        for name in self.COLUMNS:
+            if hasattr(self, name):
+                res[name] = getattr(self, name)[patch_id]
+        for name, values in self.shared.items():
+            res[name] = values[patch_id]
+        return res
+
+    def store(self, patch_id, patch_res):
+        """ Store the columns of the result of a patch """
+        for name in self.COLUMNS:
+            if name not in patch_res:
+                continue
+            value = np.asarray(patch_res[name])
+            if not hasattr(self, name):
+                if name == 'message':
+                    column = np.full(len(self), '', dtype=object)
+                elif name in self._EMPTY:
+                    column = np.full((len(self),) + value.shape,
+                                     self._EMPTY[name], value.dtype)
+                else:
+                    column = np.full((len(self),) + value.shape, np.nan)
+                setattr(self, name, column)
+            getattr(self, name)[patch_id] = patch_res[name]
+
+    def store_shared(self, patch_id, name, value):
+        """ Store a matrix if it is the same for all the entries of a patch
+
+        Returns
+        -------
+        stored: bool
+            False if *value* changes across the entries of the patch
+        """
+        # Same for all the entries if the dimensions of the patch index are
+        # either missing or of length 1
+        n_entry_dims = value.ndim - (len(self.entry_shape) + 2
+                                     - len(self.patch_index.shape))
+        if n_entry_dims > 0:
+            if any(n != 1 for n in value.shape[:n_entry_dims]):
+                return False
+            value = value.reshape(value.shape[n_entry_dims:])
+        if name not in self.shared:
+            self.shared[name] = np.full((len(self),) + value.shape, np.nan)
+        self.shared[name][patch_id] = value
+        return True
+
+    def expand(self, name):
+        """ Shared matrix in each of the entries
+
+        Returns
+        -------
+        matrices : ndarray
+            Read-only array. Shape *entry_shape + (m, n)*, where *(m, n)* is
+            the shape of the matrix in a single entry. The values are
+            gathered once for each entry of the patch index and then
+            broadcast (without copies) to the other dimensions.
+        """
+        values = self.shared[name]
+        patch_ids = self.patch_index.patch_ids()
+        core_shape = values.shape[1:]
+        n_missing = len(self.entry_shape) + 2 - patch_ids.ndim - len(core_shape)
+        values = values[patch_ids].reshape(
+            patch_ids.shape + (1,) * n_missing + core_shape)
+        return np.broadcast_to(values,
+                               self.entry_shape + values.shape[-2:])
 
 
 def _indexed_matrix(matrix, data_shape, data_indexing):
@@ -1083,7 +2080,7 @@ def _indexed_matrix(matrix, data_shape, data_indexing):
         data_indexing = (data_indexing, )
     matrix_indexing = []
     data_extra_dims = len(data_shape) - len(matrix.shape) + 1
-    for i_dim, indexing in enumerate(data_indexing, data_extra_dims):
+    for i_dim, indexing in enumerate(data_indexing, -data_extra_dims):
         if i_dim >= 0:
             if matrix.shape[i_dim] == 1:
                 matrix_indexing.append(slice(None))
@@ -1092,48 +2089,238 @@ def _indexed_matrix(matrix, data_shape, data_indexing):
     return matrix[tuple(matrix_indexing)]
 
 
-def verbose_callback():
-    """ Provide a verbose callback function
+class Checkpoint(object):
+    """ On-disk store of the partial results of long component separations
+
+    :func:`multi_comp_sep` stores the result of each patch as soon as it is
+    fitted and, if it is run again with the same checkpoint, it loads the
+    patches already completed instead of fitting them.
+    :func:`fgbuster.separation_recipes.multi_res_comp_sep` periodically stores
+    the parameters of the minimizer and restarts from them.
+
+    Parameters
+    ----------
+    directory: str
+        Where the entries are stored, one file each. It is created if it does
+        not exist. Use a different directory for each run: the entries are
+        not validated against the inputs of the component separation.
 
-    NOTE
+    Note
     ----
-    Currently, tested for the bfgs method. It can raise `KeyError` for other
-    methods.
+    Writes are atomic (the entry is written to a temporary file and then
+    renamed), therefore a job interrupted while writing leaves no corrupted
+    entry.
     """
-    start = time()
-    old_old_time = [start]
-    old_old_fval = [None]
-    def callback(xk):
-        k = _get_from_caller('k') + 1
-        func_calls = _get_from_caller('func_calls')[0]
-        old_fval = _get_from_caller('old_fval')
-        old_time = time()
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.pkl')
+
+    def load(self, name):
+        """ Load an entry
+
+        Returns
+        -------
+        obj: object or None
+            ``None`` if *name* is not stored.
+        """
         try:
-            logL_message = 'Delta(-logL) = %f' % (old_fval - old_old_fval[0])
-        except TypeError:
-            logL_message = 'First -logL = %f' % old_fval
+            with open(self._path(name), 'rb') as f:
+                return pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def store(self, name, obj):
+        """ Store an entry, replacing the previous one with the same name
+        """
+        atomic_write(self._path(name), lambda f: pickle.dump(
+            obj, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def clear(self):
+        """ Delete all the entries
+        """
+        for path in glob.glob(os.path.join(self.directory, '*.pkl')):
+            remove_if_exists(path)  # Possibly cleared by another job
+
+
+class Profiler(object):
+    """ Counters and timers of the stages of :func:`comp_sep`
+
+    Pass an instance to :func:`comp_sep` through the *profiler* keyword (also
+    the functions that forward their keyword arguments to :func:`comp_sep`,
+    e.g. :func:`multi_comp_sep` and the recipes in
+    :mod:`fgbuster.separation_recipes`, accept it). The stages are
+
+    - ``'sed'`` and ``'sed_dB'``: evaluation of the mixing matrix and of its
+      derivatives
+    - ``'prewhiten'``: Cholesky factorization of *invN* and prewhitening with
+      its factor
+    - ``'svd'``: SVD of the (prewhitened) mixing matrix
+    - ``'logL'`` and ``'logL_dB'``: spectral likelihood and its gradient
+    - ``'maps'``: separated components, residuals and their projections
+    - ``'fisher'``: Fisher matrix of the spectral parameters
+
+    Parameters
+    ----------
+    callback: callable
+        It is called at every iteration of the minimizer with the record of
+        the iteration (see *records*) as only argument.
+    logger: logging.Logger
+        If provided, every iteration is summarized in a message logged at the
+        ``INFO`` level.
+
+    Attributes
+    ----------
+    counts: dict
+        Number of executions of each stage
+    times: dict
+        Time spent in each stage (in seconds)
+    records: list
+        One dictionary for every iteration of the minimizer. The keys are
+        *iteration*, *x*, *fun* (-logL at *x*, ``None`` if it is not
+        available), *time* (seconds since the start of the minimization),
+        *counts* and *times* (copies of the attributes at that iteration)
+
+    Note
+    ----
+    The same profiler can be used for several calls of :func:`comp_sep`:
+    *counts* and *times* accumulate, while *iteration* and *time* restart at
+    every call.
+    """
+
+    def __init__(self, callback=None, logger=None):
+        self.callback = callback
+        self.logger = logger
+        self.counts = {}
+        self.times = {}
+        self.records = []
+        self._last_logL = (None, None)
+        self._start()
+
+    @contextmanager
+    def stage(self, name):
+        """ Count and time the execution of the block as the stage *name* """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.) + perf_counter() - start
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def iteration(self, x):
+        """ Record an iteration of the minimizer that reached *x* """
+        previous = self.records[-1] if self._n_iter else None
+        self._n_iter += 1
+        x_logL, logL = self._last_logL
+        if x_logL is None or not np.array_equal(x, x_logL):
+            logL = None
+        record = dict(iteration=self._n_iter, x=np.array(x), fun=logL,
+                      time=time() - self._start_time,
+                      counts=dict(self.counts), times=dict(self.times))
+        self.records.append(record)
+        if self.logger is not None:
+            self.logger.info(_record_message(record, previous))
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        """ Counts and times of the stages, number of iterations recorded """
+        return dict(counts=dict(self.counts), times=dict(self.times),
+                    n_iter=len(self.records))
+
+    def _start(self):
+        self._n_iter = 0
+        self._start_time = time()
+
+    def _callback(self, callback=None):
+        # Callback for the minimizer: record the iteration and call *callback*
+        return _chain_callback(self.iteration, callback)
+
+
+def _chain_callback(on_iteration, callback=None):
+    # Callback for scipy.optimize.minimize that calls on_iteration(x) and then
+    # *callback*. scipy passes an OptimizeResult to the callbacks whose only
+    # argument is called intermediate_result and x (possibly followed by other
+    # arguments) to the others: the wrapper has the same signature as
+    # *callback*, so that it receives what *callback* expects
+    if callback is not None and _takes_intermediate_result(callback):
+        def wrapped_callback(intermediate_result):
+            on_iteration(intermediate_result.x)
+            return callback(intermediate_result)
+    else:
+        def wrapped_callback(xk, *args):
+            on_iteration(xk)
+            if callback is not None:
+                return callback(xk, *args)
+    return wrapped_callback
+
+
+def _takes_intermediate_result(callback):
+    # Same check as scipy.optimize.minimize
+    try:
+        parameters = inspect.signature(callback).parameters
+    except (TypeError, ValueError):  # Signature not available
+        return False
+    return set(parameters) == {'intermediate_result'}
+
+
+def _record_message(record, previous=None):
+    # One-line summary of a record of Profiler
+    if record['fun'] is None:
+        logL_message = '-logL = n/a'
+    elif previous is None or previous['fun'] is None:
+        logL_message = 'First -logL = %f' % record['fun']
+    else:
+        logL_message = 'Delta(-logL) = %f' % (record['fun'] - previous['fun'])
+    old_time = 0. if previous is None else previous['time']
+    message = [
+        'Iter %i' % record['iteration'],
+        'x = %s' % np.array2string(record['x']),
+        logL_message,
+        'N Eval = %i' % record['counts'].get('logL', 0),
+        'Iter sec = %.2f' % (record['time'] - old_time),
+        'Cum sec = %.2f' % record['time'],
+        ]
+    return '\t'.join(message)
+
+
+def verbose_callback():
+    """ Provide a verbose callback function for `scipy.optimize.minimize`
+
+    It prints the iteration number, the parameters and the time spent at
+    every iteration. For the likelihood and the number of its evaluations,
+    use a :class:`Profiler` with :func:`verbose_record_callback`.
+    """
+    start = time()
+    old_time = [start]
+    n_iter = [0]
+    def callback(xk, *args):
+        n_iter[0] += 1
+        now = time()
         message = [
-            'Iter %i' % k,
-            'x = %s' % np.array2string(xk),
-            logL_message,
-            'N Eval = %i' % func_calls,
-            'Iter sec = %.2f' % (old_time - old_old_time[0]),
-            'Cum sec = %.2f' % (old_time - start),
+            'Iter %i' % n_iter[0],
+            'x = %s' % np.array2string(np.asarray(xk)),
+            'Iter sec = %.2f' % (now - old_time[0]),
+            'Cum sec = %.2f' % (now - start),
             ]
         print('\t'.join(message))
-        old_old_fval[0] = old_fval
-        old_old_time[0] = old_time
+        old_time[0] = now
 
-    print('Minimization started')
     return callback
 
 
-def _get_from_caller(name):
-    """ Get the *name* variable from the scope immediately above
+def verbose_record_callback():
+    """ Provide a verbose callback function for :class:`Profiler`
 
-    NOTE
-    ----
-    Kludge for retrieving information from inside scipy.optimize.minimize
+    It prints a summary of every iteration.
     """
-    caller = inspect.currentframe().f_back.f_back
-    return caller.f_locals[name]
+    previous = [None]
+    def callback(record):
+        print(_record_message(record, previous[0]))
+        previous[0] = record
+
+    print('Minimization started')
+    return callback
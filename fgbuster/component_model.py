@@ -21,10 +21,14 @@ Unified API for evaluating SEDs, see :class:`Component`.
 This module also provides a handy way of generating a :class:`Component` from
 analytic expressions, see the :class:`AnalyticComponent`. For components
 frequently used (e.g. power law, gray body, CMB) these are already
-prepared.
+prepared. If the SED is only available as a `numpy` function, the
+:class:`AutodiffComponent` computes its derivatives automatically. SEDs that
+are expensive to evaluate can be tabulated with the
+:class:`InterpolatedComponent`.
 """
 
 import os.path as op
+from itertools import product
 import numpy as np
 import sympy
 from sympy.parsing.sympy_parser import parse_expr
@@ -36,6 +40,8 @@ from astropy.cosmology import Planck15
 __all__ = [
     'Component',
     'AnalyticComponent',
+    'AutodiffComponent',
+    'InterpolatedComponent',
     'CMB',
     'ThermalSZ',
     'Dust',
@@ -104,6 +110,181 @@ def bandpass_integration(f):
     return integrated_f
 
 
+def _lift(x, ndim, n_lead):
+    # x has n_lead leading derivative axes followed by the value axes. Prepend
+    # to the value axes as many 1s as needed to have ndim of them
+    n_missing = ndim - (x.ndim - n_lead)
+    if n_missing <= 0:
+        return x
+    return x.reshape(x.shape[:n_lead] + (1,) * n_missing + x.shape[n_lead:])
+
+
+class _Dual(object):
+    """ Forward-mode automatic differentiation
+
+    Value of a function together with its gradient and, optionally, Hessian
+    with respect to n variables. The derivatives are stored along the leading
+    axes: *grad* has shape *(n, ...)* and *hess* has shape *(n, n, ...)*,
+    where *...* is (broadcastable to) the shape of *val*.
+
+    Arithmetic operators and the `numpy` ufuncs in ``_DUAL_UFUNCS`` propagate
+    the derivatives exactly. Any other `numpy` function raises ``TypeError``.
+    """
+    __array_priority__ = 1000
+
+    def __init__(self, val, grad, hess=None):
+        self.val = np.asarray(val)
+        self.grad = np.asarray(grad)
+        self.hess = None if hess is None else np.asarray(hess)
+
+    @classmethod
+    def variables(cls, values, order=1):
+        """ Independent variables, seeded with unit derivatives """
+        values = [np.asarray(v, dtype=float) for v in values]
+        n = len(values)
+        res = []
+        for i, val in enumerate(values):
+            grad = np.zeros((n,) + val.shape)
+            grad[i] = 1.
+            hess = np.zeros((n, n) + val.shape) if order > 1 else None
+            res.append(cls(val, grad, hess))
+        return res
+
+    @property
+    def shape(self):
+        return self.val.shape
+
+    @property
+    def ndim(self):
+        return self.val.ndim
+
+    def _with_val(self, val, d1, d2=None):
+        # Chain rule: self is the argument of a function with value val,
+        # first derivative d1 and second derivative d2
+        grad = _lift(self.grad, val.ndim, 1)
+        res_grad = d1 * grad
+        if self.hess is None:
+            return _Dual(val, res_grad)
+        res_hess = d1 * _lift(self.hess, val.ndim, 2)
+        if d2 is not None:
+            res_hess = res_hess + d2 * grad[:, np.newaxis] * grad[np.newaxis]
+        return _Dual(val, res_grad, res_hess)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        if method != '__call__' or kwargs or ufunc not in _DUAL_UFUNCS:
+            raise TypeError(
+                "numpy.%s is not supported by the automatic differentiation"
+                % ufunc.__name__)
+        return _DUAL_UFUNCS[ufunc](*inputs)
+
+    def __array__(self, *args, **kwargs):
+        raise TypeError("Functions that are not numpy ufuncs are not "
+                        "supported by the automatic differentiation")
+
+    __add__ = __radd__ = lambda self, other: np.add(self, other)
+    __sub__ = lambda self, other: np.subtract(self, other)
+    __rsub__ = lambda self, other: np.subtract(other, self)
+    __mul__ = __rmul__ = lambda self, other: np.multiply(self, other)
+    __truediv__ = lambda self, other: np.true_divide(self, other)
+    __rtruediv__ = lambda self, other: np.true_divide(other, self)
+    __pow__ = lambda self, other: np.power(self, other)
+    __rpow__ = lambda self, other: np.power(other, self)
+    __neg__ = lambda self: np.negative(self)
+    __pos__ = lambda self: self
+
+
+def _dual_add(a, b, sign=1.):
+    if not isinstance(b, _Dual):
+        return _Dual(a.val + sign * b, a.grad, a.hess)
+    if not isinstance(a, _Dual):
+        return _Dual(a + sign * b.val, sign * b.grad,
+                     None if b.hess is None else sign * b.hess)
+    val = a.val + sign * b.val
+    grad = _lift(a.grad, val.ndim, 1) + sign * _lift(b.grad, val.ndim, 1)
+    if a.hess is None or b.hess is None:
+        return _Dual(val, grad)
+    hess = _lift(a.hess, val.ndim, 2) + sign * _lift(b.hess, val.ndim, 2)
+    return _Dual(val, grad, hess)
+
+
+def _dual_multiply(a, b):
+    if not isinstance(a, _Dual):
+        a, b = b, a
+    if not isinstance(b, _Dual):
+        b = np.asarray(b)
+        val = a.val * b
+        hess = None if a.hess is None else _lift(a.hess, val.ndim, 2) * b
+        return _Dual(val, _lift(a.grad, val.ndim, 1) * b, hess)
+    val = a.val * b.val
+    a_grad = _lift(a.grad, val.ndim, 1)
+    b_grad = _lift(b.grad, val.ndim, 1)
+    grad = a_grad * b.val + a.val * b_grad
+    if a.hess is None or b.hess is None:
+        return _Dual(val, grad)
+    hess = (_lift(a.hess, val.ndim, 2) * b.val
+            + a.val * _lift(b.hess, val.ndim, 2)
+            + a_grad[:, np.newaxis] * b_grad[np.newaxis]
+            + b_grad[:, np.newaxis] * a_grad[np.newaxis])
+    return _Dual(val, grad, hess)
+
+
+def _dual_reciprocal(x):
+    inv = 1. / x.val
+    return x._with_val(inv, - inv**2, 2. * inv**3)
+
+
+def _dual_true_divide(a, b):
+    if isinstance(b, _Dual):
+        return _dual_multiply(a, _dual_reciprocal(b))
+    return _dual_multiply(a, 1. / np.asarray(b))
+
+
+def _dual_power(a, b):
+    if isinstance(b, _Dual):
+        # a**b = exp(b log(a))
+        return np.exp(b * np.log(a))
+    b = np.asarray(b)
+    val = a.val**b
+    return a._with_val(val, b * a.val**(b - 1.), b * (b - 1.) * a.val**(b - 2.))
+
+
+def _dual_unary(f, d1, d2):
+    # d1 and d2 take the argument and the value of f
+    return lambda x: x._with_val(f(x.val), d1(x.val, f(x.val)),
+                                 d2(x.val, f(x.val)))
+
+
+_DUAL_UFUNCS = {
+    np.add: _dual_add,
+    np.subtract: lambda a, b: _dual_add(a, b, -1.),
+    np.multiply: _dual_multiply,
+    np.true_divide: _dual_true_divide,
+    np.power: _dual_power,
+    np.negative: lambda x: _dual_multiply(x, -1.),
+    np.reciprocal: _dual_reciprocal,
+    np.square: lambda x: _dual_multiply(x, x),
+    np.sqrt: _dual_unary(np.sqrt, lambda x, f: 0.5 / f,
+                         lambda x, f: -0.25 / (x * f)),
+    np.exp: _dual_unary(np.exp, lambda x, f: f, lambda x, f: f),
+    np.expm1: _dual_unary(np.expm1, lambda x, f: f + 1., lambda x, f: f + 1.),
+    np.log: _dual_unary(np.log, lambda x, f: 1. / x, lambda x, f: -1. / x**2),
+    np.log1p: _dual_unary(np.log1p, lambda x, f: 1. / (1. + x),
+                          lambda x, f: -1. / (1. + x)**2),
+    np.log10: _dual_unary(np.log10, lambda x, f: 1. / (x * np.log(10.)),
+                          lambda x, f: -1. / (x**2 * np.log(10.))),
+    np.sin: _dual_unary(np.sin, lambda x, f: np.cos(x), lambda x, f: -f),
+    np.cos: _dual_unary(np.cos, lambda x, f: -np.sin(x), lambda x, f: -f),
+    np.sinh: _dual_unary(np.sinh, lambda x, f: np.cosh(x), lambda x, f: f),
+    np.cosh: _dual_unary(np.cosh, lambda x, f: np.sinh(x), lambda x, f: f),
+    np.tanh: _dual_unary(np.tanh, lambda x, f: 1. - f**2,
+                         lambda x, f: -2. * f * (1. - f**2)),
+    np.arctan: _dual_unary(np.arctan, lambda x, f: 1. / (1. + x**2),
+                           lambda x, f: -2. * x / (1. + x**2)**2),
+    np.absolute: _dual_unary(np.absolute, lambda x, f: np.sign(x),
+                             lambda x, f: 0.),
+}
+
+
 class Component(object):
     """ Abstract class for SED evaluation
 
@@ -213,7 +394,7 @@ class Component(object):
 
         res = []
         for i_p in range(self.n_param):
-            res.append([self._lambda_diff[i_p][j_p](nu, *new_params)
+            res.append([self._lambda_diff_diff[i_p][j_p](nu, *new_params)
                         for j_p in range(self.n_param)])
         return res
 
@@ -360,6 +541,214 @@ class AnalyticComponent(Component):
         return repr(self._expr)
 
 
+class AutodiffComponent(Component):
+    """ Component whose derivatives are computed automatically
+
+    The SED is provided as a `numpy` function. Its first and second
+    derivatives are computed exactly (to machine precision), in forward mode:
+    the SED is evaluated once on dual numbers that carry all the derivatives
+    with respect to the free parameters. No symbolic expression nor finite
+    differences are involved.
+
+    Parameters
+    ----------
+    sed: callable
+        ``sed(nu, *params)`` evaluates the SED at the frequencies *nu* (an
+        array, never a bandpass: bandpass integration is handled by the
+        class). It should follow the broadcasting rules of :meth:`eval`
+        and use only arithmetic operators and `numpy` ufuncs, e.g.
+        ``np.exp``, ``np.log``, ``np.expm1``, ``np.sqrt``
+        (see ``component_model._DUAL_UFUNCS`` for the full list).
+    params: list of str
+        Names of the free parameters, in the order they are passed to *sed*
+    defaults: list of float
+        Default values of the free parameters. If not provided, they are ones
+        (as for :class:`AnalyticComponent`)
+
+    Example
+    -------
+    >>> synchrotron = AutodiffComponent(
+    ...     lambda nu, beta_pl: (nu / 70.)**beta_pl, ['beta_pl'], [-3.])
+    """
+
+    def __init__(self, sed, params, defaults=None):
+        self._sed = sed
+        self._params = list(params)
+        self._lambda = bandpass_integration(sed)
+        self._defaults = []
+        if defaults is not None:
+            self.defaults = list(defaults)
+
+    def _derivatives(self, nu, params, order):
+        # Gradient (order 1) or Hessian (order 2) of the SED, the derivative
+        # axes are the leading ones
+        if isinstance(nu, (list, tuple)):
+            # Bandpass integration of the derivatives
+            res = [np.trapz(self._derivatives(band_nu, params, order) * band_w,
+                            band_nu * 1e9)
+                   for band_nu, band_w in nu]
+            return np.stack(np.broadcast_arrays(*res), axis=-1)
+
+        res = self._sed(nu, *_Dual.variables(params, order))
+        if not isinstance(res, _Dual):  # The SED does not depend on params
+            return np.zeros((self.n_param,) * order + np.shape(res))
+        if order == 1:
+            return _lift(res.grad, res.ndim, 1)
+        return _lift(res.hess, res.ndim, 2)
+
+    def _params_for_sed(self, params):
+        # Same broadcasting rules as in Component.eval
+        if np.broadcast(*params).ndim == 0:
+            return params
+        return [self._add_last_dimension_if_ndarray(p) for p in params]
+
+    def diff(self, nu, *params):
+        assert len(params) == self.n_param
+        if not params:
+            return []
+        return list(self._derivatives(nu, self._params_for_sed(params), 1))
+
+    def diff_diff(self, nu, *params):
+        assert len(params) == self.n_param
+        if not params:
+            return [[]]
+        hess = self._derivatives(nu, self._params_for_sed(params), 2)
+        return [list(hess_i) for hess_i in hess]
+
+
+def _is_uniform(grid):
+    step = np.diff(grid)
+    return np.allclose(step, step[0])
+
+
+class InterpolatedComponent(Component):
+    """ Component tabulated on a grid of parameters
+
+    The SED of *component* and its first and second derivatives are evaluated
+    once, at construction, on a regular grid of parameter values and for the
+    frequencies (or bandpasses) *nu*. After that, evaluations for the same
+    *nu* are multilinear interpolations of these tables. Their cost does not
+    depend on the complexity of the SED, which is handy when the SED has to be
+    evaluated for many parameter values (e.g. in
+    :func:`fgbuster.separation_recipes.multi_res_comp_sep`).
+
+    Parameters
+    ----------
+    component: Component
+        The component to tabulate. It must have free parameters
+    nu: array, tuple or list
+        Frequencies or bandpasses of the instrument.
+        See the result of :func:`bandpass_integration`.
+    grid: list of arrays
+        ``grid[i]`` contains the (strictly ascending) values of the i-th free
+        parameter at which the SED is tabulated. At least two values for each
+        parameter.
+
+    Note
+    ----
+    * Parameters outside the grid are linearly extrapolated
+    * Evaluations for frequencies (or bandpasses) different from *nu* are
+      performed with *component*, which is exact but not faster
+    * The derivatives are interpolated from tables of the exact derivatives,
+      they are not the derivative of the interpolated SED
+    """
+
+    def __init__(self, component, nu, grid):
+        if not component.n_param:
+            raise ValueError("The component has no free parameters")
+        if len(grid) != component.n_param:
+            raise ValueError("Provide a grid for each of the parameters %s"
+                             % component.params)
+        if any(len(g) < 2 or np.any(np.diff(g) <= 0) for g in grid):
+            raise ValueError("The grids must contain at least two values and "
+                             "be strictly ascending")
+        self._component = component
+        self._params = list(component.params)
+        self.defaults = component.defaults
+        self._nu = nu
+        self._grid = [np.asarray(g, dtype=float) for g in grid]
+        self._uniform = [_is_uniform(g) for g in self._grid]
+
+        # Tabulate the SED and its derivatives. The last axis of the tables is
+        # the flattened derivative and frequency axis
+        mesh = np.meshgrid(*self._grid, indexing='ij')
+        shape = mesh[0].shape
+        n_nu = np.shape(component.eval(nu, *[g[0] for g in self._grid]))[-1]
+        sed = component.eval(nu, *mesh)
+        diff = component.diff(nu, *mesh)
+        diff_diff = component.diff_diff(nu, *mesh)
+        tables = [
+            np.broadcast_to(sed, shape + (n_nu,)),
+            np.stack([np.broadcast_to(d, shape + (n_nu,)) for d in diff], -2),
+            np.stack([np.broadcast_to(d, shape + (n_nu,))
+                      for diff_diff_i in diff_diff for d in diff_diff_i], -2)
+        ]
+        # Rows: flattened grid index
+        self._tables = [t.reshape(-1, t[(0,) * len(shape)].size)
+                        for t in tables]
+        self._grid_strides = np.cumprod((shape + (1,))[:0:-1])[::-1]
+
+    def _is_tabulated_nu(self, nu):
+        if isinstance(self._nu, (list, tuple)):
+            return (isinstance(nu, (list, tuple)) and len(nu) == len(self._nu)
+                    and all(np.array_equal(n, s_n) and np.array_equal(w, s_w)
+                            for (n, w), (s_n, s_w) in zip(nu, self._nu)))
+        return (not isinstance(nu, (list, tuple))
+                and np.array_equal(nu, self._nu))
+
+    def _interpolate(self, order, params):
+        # Multilinear interpolation of the table of the order-th derivative.
+        # Output shape: np.broadcast(*params).shape + (n_param,) * order + (n_nu,)
+        params = np.broadcast_arrays(*params)
+        # Lower node and fractional position in the cell along each dimension
+        # Outside the grid, the fraction is < 0 or > 1: linear extrapolation
+        idx = []
+        frac = []
+        for grid, uniform, param in zip(self._grid, self._uniform, params):
+            param = param.ravel()
+            if uniform:  # Skip the binary search
+                i = np.floor((param - grid[0]) / (grid[1] - grid[0]))
+                i = np.clip(i, 0, len(grid) - 2).astype(int)
+            else:
+                i = np.searchsorted(grid, param, side='right') - 1
+                i = np.clip(i, 0, len(grid) - 2)
+            idx.append(i)
+            frac.append((param - grid[i]) / (grid[i+1] - grid[i]))
+
+        # Weighted sum over the 2^n_param vertices of the cells
+        table = self._tables[order]
+        res = 0.
+        for vertex in product((0, 1), repeat=len(params)):
+            weight = 1.
+            row = 0
+            for v, i, f, stride in zip(vertex, idx, frac, self._grid_strides):
+                weight = weight * (f if v else 1. - f)
+                row = row + (i + v) * stride
+            res = res + weight[:, np.newaxis] * np.take(table, row, axis=0)
+        return res.reshape(params[0].shape + (self.n_param,) * order + (-1,))
+
+    def eval(self, nu, *params):
+        assert len(params) == self.n_param
+        if not self._is_tabulated_nu(nu):
+            return self._component.eval(nu, *params)
+        return self._interpolate(0, params)
+
+    def diff(self, nu, *params):
+        assert len(params) == self.n_param
+        if not self._is_tabulated_nu(nu):
+            return self._component.diff(nu, *params)
+        res = self._interpolate(1, params)
+        return [res[..., i, :] for i in range(self.n_param)]
+
+    def diff_diff(self, nu, *params):
+        assert len(params) == self.n_param
+        if not self._is_tabulated_nu(nu):
+            return self._component.diff_diff(nu, *params)
+        res = self._interpolate(2, params)
+        return [[res[..., i, j, :] for j in range(self.n_param)]
+                for i in range(self.n_param)]
+
+
 class ModifiedBlackBody(AnalyticComponent):
     """ Modified Black body
 
@@ -0,0 +1,68 @@
+# FGBuster
+# Copyright (C) 2019 Davide Poletti, Josquin Errard and the FGBuster developers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" 
+File helpers shared by the on-disk stores (checkpoints and caches)
+"""
+import os
+import tempfile
+
+
+__all__ = [
+    'atomic_write',
+    'remove_if_exists',
+]
+
+
+def atomic_write(path, write):
+    """ Write a file atomically
+
+    ``write(f)`` fills a temporary file in the directory of *path*, which
+    then replaces *path*. Therefore concurrent readers see either the old or
+    the new file, never a partial one.
+
+    Parameters
+    ----------
+    path: str
+        Destination of the file
+    write: callable
+        It takes the temporary file, opened in binary mode, and writes to it.
+
+    Note
+    ----
+    If *write* (or anything else) fails, the temporary file is deleted and
+    the exception is re-raised.
+    """
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp',
+                                    delete=False)
+    try:
+        with f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f.name, path)
+    except BaseException:
+        remove_if_exists(f.name)
+        raise
+
+
+def remove_if_exists(path):
+    """ Delete a file, if it was not already deleted (e.g. by another job)
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -18,13 +18,19 @@
 Handy access to instrument configuration, map generation
 and other pysm3 functionalities
 """
+import os
+import json
+import glob
 import types
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import pandas as pd
 import healpy as hp
 import pysm3
 import pysm3.units as u
 from cmbdb import cmbdb
+from .fileio import atomic_write, remove_if_exists
 
 
 __all__ = [
@@ -32,6 +38,8 @@ __all__ = [
     'get_instrument',
     'get_observation',
     'get_noise_realization',
+    'ObservationCache',
+    'PartialMaps',
 ]
 
 INSTRUMENT_STD_ATTR = 'frequency depth_i depth_p fwhm'.split()
@@ -98,7 +106,8 @@ def get_instrument(tag=''):
 
 
 def get_observation(instrument='', sky=None,
-                    noise=False, nside=None, unit='uK_CMB'):
+                    noise=False, nside=None, unit='uK_CMB',
+                    n_jobs=1, executor=None, cache=None, dtype=None):
     """ Get a pre-defined instrumental configuration
 
     Parameters
@@ -110,10 +119,13 @@ def get_observation(instrument='', sky=None,
         - **frequency** (required)
         - **depth_p** (required if ``noise=True``)
         - **depth_i** (required if ``noise=True``)
+        - **bandpass** (optional, see :func:`standardize_instrument`)
 
         They can be anything that is convertible to a float numpy array.
         If only one of ``depth_p`` or ``depth_i`` is provided, the other is
         inferred assuming that the former is sqrt(2) higher than the latter.
+        If **bandpass** is provided, the emission is integrated over the
+        bandpasses instead of being evaluated at the frequencies.
     sky: str of pysm3.Sky
         Sky to observe. It can be a `pysm3.Sky` or a tag to create one.
     noise: bool
@@ -123,6 +135,22 @@ def get_observation(instrument='', sky=None,
         and required if it is a `str` or ``None``.
     unit: str
         Unit of the output. Only K_CMB and K_RJ (and multiples) are supported.
+    n_jobs: int
+        Number of frequencies whose emission is computed concurrently in a
+        pool of threads. Most of the work in `pysm3` is done by numpy and
+        numba routines that release the GIL.
+    executor: concurrent.futures.Executor
+        If provided, the emission of the frequencies is computed by this
+        executor (e.g. a ``ProcessPoolExecutor``) and *n_jobs* is ignored.
+        The executor is not shut down.
+    cache: ObservationCache or str
+        If provided and *sky* is a `str`, the sky emission is loaded from (or,
+        the first time, stored into) this cache. If `str`, it is the
+        directory of an :class:`ObservationCache`. The noise, if any, is never
+        cached.
+    dtype: data-type
+        Floating point type of the output. By default, it is ``np.float64``
+        or, if *cache* is used, the dtype of the cache.
 
     Returns
     -------
@@ -131,8 +159,7 @@ def get_observation(instrument='', sky=None,
     """
     if isinstance(instrument, str):
         instrument = get_instrument(instrument)
-    else:
-        instrument = standardize_instrument(instrument)
+    instrument = standardize_instrument(instrument)
     if nside is None:
         nside = sky.nside
     elif not isinstance(sky, str):
@@ -144,10 +171,30 @@ def get_observation(instrument='', sky=None,
             raise ValueError("Either provide a pysm3.Sky as sky argument "
                              " or specify the nside argument.")
 
+    if cache is not None and isinstance(sky, str) and sky:
+        if isinstance(cache, str):
+            cache = ObservationCache(cache)
+        key = cache.key(sky, nside, instrument, unit)
+        res = cache.load(key)
+        if res is None:
+            res = cache.store(key, get_observation(
+                instrument, sky, nside=nside, unit=unit,
+                n_jobs=n_jobs, executor=executor))
+        if dtype is not None:
+            res = res.astype(dtype, copy=False)
+        if noise:
+            res = res + get_noise_realization(nside, instrument, unit,
+                                              res.dtype)
+        return res
+
+    if dtype is None:
+        dtype = np.float64
+
     if noise:
-        res = get_noise_realization(nside, instrument, unit)
+        res = get_noise_realization(nside, instrument, unit, dtype)
     else:
-        res = np.zeros((len(instrument.frequency), 3, hp.nside2npix(nside)))
+        res = np.zeros((len(instrument.frequency), 3, hp.nside2npix(nside)),
+                       dtype)
 
     if sky is None or sky == '':
         return res
@@ -155,16 +202,290 @@ def get_observation(instrument='', sky=None,
     if isinstance(sky, str):
         sky = get_sky(nside, sky)
 
-    for res_freq, freq in zip(res, instrument.frequency):
-        emission = sky.get_emission(freq * u.GHz).to(
-            getattr(u, unit),
-            equivalencies=u.cmb_equivalencies(freq * u.GHz))
-        res_freq += emission.value
+    bandpasses = getattr(instrument, 'bandpass',
+                         [None] * len(instrument.frequency))
+    channels = list(zip(instrument.frequency, bandpasses))
+
+    if executor is None and n_jobs == 1:
+        for res_freq, (freq, bandpass) in zip(res, channels):
+            res_freq += _get_emission(sky, freq, bandpass, unit)
+        return res
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(n_jobs)
+    try:
+        futures = {executor.submit(_get_emission, sky, freq, bandpass, unit): i
+                   for i, (freq, bandpass) in enumerate(channels)}
+        # Accumulate as soon as a frequency is ready, so that only the
+        # emissions still in flight are kept in memory
+        for future in as_completed(futures):
+            res[futures[future]] += future.result()
+    finally:
+        if own_executor:
+            executor.shutdown()
 
     return res
 
 
-def get_noise_realization(nside, instrument, unit='uK_CMB'):
+def _get_emission(sky, freq, bandpass, unit):
+    """ Emission of the sky in a frequency channel
+
+    Parameters
+    ----------
+    sky: pysm3.Sky
+    freq: float
+        Frequency of the channel (GHz). Used only if *bandpass* is ``None``
+    bandpass: tuple or None
+        Pair of arrays (frequencies (GHz), weights) over which the emission is
+        integrated.
+    unit: str
+        Unit of the output.
+
+    Returns
+    -------
+    emission: ndarray
+        Shape is ``(3, n_pix)``
+    """
+    unit = getattr(u, unit)
+    if bandpass is None:
+        emission = sky.get_emission(freq * u.GHz)
+        factor = (1. * emission.unit).to_value(
+            unit, equivalencies=u.cmb_equivalencies(freq * u.GHz))
+    else:
+        band_nu, band_w = bandpass
+        emission = sky.get_emission(band_nu * u.GHz, band_w)
+        factor = pysm3.bandpass_unit_conversion(
+            band_nu * u.GHz, band_w, unit, input_unit=emission.unit).value
+
+    # Convert the units of the bare array instead of the Quantity: pysm3
+    # allocates a new array for the emission, which can be safely overwritten
+    emission = emission.value
+    emission *= factor
+    return emission
+
+
+class ObservationCache(object):
+    """ On-disk cache of sky emissions
+
+    The emissions are stored as ``.npy`` files, which are loaded as memory
+    maps. They are identified by a key derived from the sky tag, the nside,
+    the frequencies (and bandpasses) of the instrument and the unit.
+
+    Parameters
+    ----------
+    directory: str
+        Where the maps are stored. It is created if it does not exist.
+    max_size: int
+        Maximum size (in bytes) of the cache. When it is exceeded, the least
+        recently used maps are deleted. If ``None``, the size is not bounded.
+    dtype: dtype
+        Precision of the maps stored. Using ``np.float32`` halves the size of
+        the cache.
+    mmap_mode: str
+        Memory-map mode of the maps loaded (see `numpy.load`). The default
+        (``'c'``, copy-on-write) returns maps that can be modified in memory
+        without affecting the cache.
+
+    Note
+    ----
+    Writes are atomic (the map is written to a temporary file and then
+    renamed), therefore concurrent jobs can safely share the same directory.
+    """
+
+    def __init__(self, directory, max_size=None, dtype=np.float64,
+                 mmap_mode='c'):
+        self.directory = directory
+        self.max_size = max_size
+        self.dtype = np.dtype(dtype)
+        self.mmap_mode = mmap_mode
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, tag, nside, instrument, unit):
+        """ Key identifying an emission
+
+        Parameters
+        ----------
+        tag: str
+            Sky tag (see :func:`get_sky`)
+        nside: int
+        instrument:
+            See :func:`standardize_instrument`
+        unit: str
+
+        Returns
+        -------
+        key: str
+        """
+        instrument = standardize_instrument(instrument)
+        bandpass = getattr(instrument, 'bandpass', None)
+        if bandpass is not None:
+            bandpass = [(b_nu.tolist(), b_w.tolist()) for b_nu, b_w in bandpass]
+        description = dict(
+            tag=tag, nside=int(nside), unit=unit, dtype=self.dtype.str,
+            frequency=instrument.frequency.tolist(), bandpass=bandpass,
+            pysm3=pysm3.__version__)
+        description = json.dumps(description, sort_keys=True)
+        return hashlib.sha256(description.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def load(self, key):
+        """ Load an emission
+
+        Returns
+        -------
+        maps: ndarray or None
+            ``None`` if *key* is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            maps = np.load(path, mmap_mode=self.mmap_mode)
+            os.utime(path)  # Mark as recently used
+        except (OSError, ValueError):  # Missing, evicted or corrupted
+            return None
+        return maps
+
+    def store(self, key, maps):
+        """ Store an emission
+
+        Returns
+        -------
+        maps: ndarray
+            The maps just stored, loaded from the cache.
+        """
+        atomic_write(self._path(key),
+                     lambda f: np.save(f, np.asarray(maps, dtype=self.dtype)))
+        self._evict(keep=self._path(key))
+        return np.load(self._path(key), mmap_mode=self.mmap_mode)
+
+    def clear(self):
+        """ Delete all the maps in the cache
+        """
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            remove_if_exists(path)
+
+    def _evict(self, keep):
+        # Delete the least recently used maps until the size is below max_size
+        if self.max_size is None:
+            return
+        entries = []
+        for path in glob.glob(os.path.join(self.directory, '*.npy')):
+            try:
+                stat = os.stat(path)
+            except OSError:  # Deleted by a concurrent job
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        size = sum(e[1] for e in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            remove_if_exists(path)
+            size -= entry_size
+
+
+class PartialMaps(object):
+    """ HEALPix maps known only in a subset of the pixels
+
+    Only the observed pixels are stored, so memory and computing time scale
+    with their number rather than with ``12 * nside**2``. The recipes in
+    :mod:`fgbuster.separation_recipes` accept these maps in place of full-sky
+    maps and return their own maps in the same form.
+
+    Parameters
+    ----------
+    nside: int
+        HEALPix nside of the maps
+    pixels: array
+        Indices (RING ordering) of the observed pixels, without repetitions
+    values: ndarray or MaskedArray
+        Shape *(..., n_obs)*, ``values[..., i]`` is the value in
+        ``pixels[i]``. As for full-sky maps, values equal to `hp.UNSEEN` or,
+        if `MaskedArray`, masked values are neglected by the recipes.
+
+    Attributes
+    ----------
+    nside, pixels, values:
+        Same as the parameters
+    """
+
+    def __init__(self, nside, pixels, values):
+        self.nside = int(nside)
+        self.pixels = np.asarray(pixels, dtype=np.int64)
+        if hp.pixelfunc.is_ma(values):
+            self.values = values
+        else:
+            self.values = np.asarray(values)
+        if self.pixels.ndim != 1 or self.values.shape[-1:] != self.pixels.shape:
+            raise ValueError("values has shape %s, its last dimension has to "
+                             "match the %i pixels" % (self.values.shape,
+                                                      len(self.pixels)))
+        if np.any(self.pixels < 0) or np.any(
+                self.pixels >= hp.nside2npix(self.nside)):
+            raise ValueError("Pixel indices out of range for nside %i"
+                             % self.nside)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def dtype(self):
+        return self.values.dtype
+
+    @classmethod
+    def from_full(cls, maps, pixels=None):
+        """ Restrict full-sky maps to a subset of their pixels
+
+        Parameters
+        ----------
+        maps: ndarray or MaskedArray
+            Full-sky maps, shape *(..., n_pix)*
+        pixels: array
+            Indices of the pixels to keep. By default, the pixels in which at
+            least one of the maps is neither `hp.UNSEEN` nor masked.
+
+        Returns
+        -------
+        partial_maps: PartialMaps
+        """
+        nside = hp.npix2nside(maps.shape[-1])
+        if pixels is None:
+            if hp.pixelfunc.is_ma(maps):
+                unseen = np.ma.getmaskarray(maps)
+            else:
+                unseen = maps == hp.UNSEEN
+            pixels = np.flatnonzero(
+                ~np.all(unseen, axis=tuple(range(maps.ndim - 1))))
+        return cls(nside, pixels, maps[..., pixels])
+
+    def to_full(self, fill_value=hp.UNSEEN):
+        """ Full-sky maps, *fill_value* in the pixels not observed
+
+        Returns
+        -------
+        maps: ndarray
+            Shape *(..., n_pix)*
+        """
+        maps = np.full(self.shape[:-1] + (hp.nside2npix(self.nside),),
+                       fill_value, dtype=self.dtype)
+        maps[..., self.pixels] = hp.pixelfunc.ma_to_array(self.values)
+        return maps
+
+    def with_values(self, values):
+        """ Maps with the same nside and pixels but different values """
+        return PartialMaps(self.nside, self.pixels, values)
+
+    def same_footprint(self, other):
+        """ Whether *other* has the same nside and pixels """
+        return (isinstance(other, PartialMaps) and self.nside == other.nside
+                and np.array_equal(self.pixels, other.pixels))
+
+
+def get_noise_realization(nside, instrument, unit='uK_CMB', dtype=np.float64):
     """ Generate noise maps for the instrument
 
     Parameters
@@ -183,10 +504,8 @@ def get_noise_realization(nside, instrument, unit='uK_CMB'):
         inferred assuming that the former is sqrt(2) higher than the latter.
     unit: str
         Unit of the output. Only K_CMB and K_RJ (and multiples) are supported.
-    sky: str of pysm3.Sky
-        Sky to observe. It can be a `pysm3.Sky` or a tag to create one.
-    noise: bool
-        If true, add Gaussian, uncorrelated, isotropic noise.
+    dtype: data-type
+        Floating point type of the output.
 
     Returns
     -------
@@ -210,7 +529,7 @@ def get_noise_realization(nside, instrument, unit='uK_CMB'):
         getattr(u, unit) * u.arcmin,
         equivalencies=u.cmb_equivalencies(instrument.frequency * u.GHz))
     res *= depth.value / hp.nside2resol(nside, True)
-    return res.T
+    return res.T.astype(dtype, copy=False)
 
 
 def standardize_instrument(instrument):
@@ -224,12 +543,15 @@ def standardize_instrument(instrument):
     {_NL.join(['    * '+attr for attr in INSTRUMENT_STD_ATTR]) }
 
         as keys or attributes, including `pandas.DataFrame`.
+        Optionally, it can have also a **bandpass** key or attribute: a
+        sequence with a pair of arrays (frequencies, weights) for each channel.
 
     Returns
     -------
     std_instr: SimpleNamespace
         It contains the properties above as attributes. They are converted to a
-        float array.
+        float array. **bandpass**, if present, is converted into a list of
+        pairs of float arrays.
     """
     std_instr = types.SimpleNamespace()
     for attr in INSTRUMENT_STD_ATTR:
@@ -242,6 +564,18 @@ def standardize_instrument(instrument):
         except (TypeError, KeyError):  # Not subscriptable or missing key
             pass
 
+    try:
+        try:
+            bandpass = getattr(instrument, 'bandpass')
+        except AttributeError:
+            bandpass = instrument['bandpass']
+        std_instr.bandpass = [
+            (np.array(band_nu, dtype=np.float64),
+             np.array(band_w, dtype=np.float64))
+            for band_nu, band_w in bandpass]
+    except (TypeError, KeyError):  # Not subscriptable or missing key
+        pass
+
     return std_instr
 
 
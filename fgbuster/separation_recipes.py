@@ -18,16 +18,21 @@
 
 """
 import logging
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 from scipy.optimize import OptimizeResult
 import healpy as hp
 from . import algebra as alg
 from .mixingmatrix import MixingMatrix
-from .observation_helpers import standardize_instrument
+from .observation_helpers import standardize_instrument, PartialMaps
 
 
 __all__ = [
     'basic_comp_sep',
+    'SeparationPlan',
+    'ensemble_comp_sep',
     'weighted_comp_sep',
     'ilc',
     'harmonic_ilc',
@@ -37,6 +42,7 @@ __all__ = [
 
 
 def weighted_comp_sep(components, instrument, data, cov, nside=0,
+                      dtype=np.float64, outputs=None, partial_coverage=False,
                       **minimize_kwargs):
     """ Weighted component separation
 
@@ -55,8 +61,12 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
         also absent.
         Values equal to `hp.UNSEEN` or, if `MaskedArray`, masked values are
         neglected during the component separation process.
+        It can be also :class:`PartialMaps`: all the output maps are then
+        :class:`PartialMaps` with the same pixels.
     cov: ndarray or MaskedArray
         Covariance maps. It has to be broadcastable to *data*.
+        If *data* is :class:`PartialMaps`, *cov* can be either
+        :class:`PartialMaps` with the same pixels or full-sky maps.
         Notice that you can not pass a pixel independent covariance as an array
         with shape *(n_freq,)*: it has to be *(n_freq, ..., 1)* in order to be
         broadcastable (consider using :func:`basic_comp_sep`, in this case).
@@ -68,6 +78,22 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
     patch_ids: array
         For each pixel, the array stores the id of the region over which to
         perform component separation independently.
+    dtype: data-type
+        Floating point type of the data during the separation and of the
+        output maps (*s* and *chi*). Use ``np.float32`` to halve their memory
+        footprint. The spectral likelihood is always evaluated in double
+        precision.
+    outputs: str or list of str
+        Per-pixel products to compute, among ``'s'``, ``'invAtNA'``,
+        ``'chi'`` and ``'chi_dB'`` (see :func:`fgbuster.algebra.comp_sep`).
+        By default, all of them.
+    partial_coverage: bool
+        If true, a pixel is used as long as it observes at least as many
+        frequencies as there are components: only its masked frequencies are
+        neglected. The pixels with the same frequencies observed and the same
+        *cov* are fitted together (see *group_by_coverage* in
+        :func:`fgbuster.algebra.comp_sep`), so combining maps with different
+        sky coverage costs about as much as if all of them were full-sky.
 
     Returns
     -------
@@ -83,15 +109,21 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
           *cov* is the true covariance of the data
         - **s**: *(ndarray)* - Component amplitude maps
         - **mask_good**: *(ndarray)* - mask of the entries actually used in the
-          component separation
+          component separation (of the observed pixels, for
+          :class:`PartialMaps`)
 
     Note
     ----
     During the component separation, a pixel is masked if at least one of
-    its frequencies is masked, either in *data* or in *cov*.
+    its frequencies is masked, either in *data* or in *cov* (unless
+    *partial_coverage* is true).
 
     """
     instrument = standardize_instrument(instrument)
+    footprint = data if isinstance(data, PartialMaps) else None
+    if footprint is not None:
+        data = footprint.values
+        cov = _footprint_values(cov, footprint)
     # Make sure that cov has the frequency dimension and is equal to n_freq
     cov_shape = list(np.broadcast(cov, data).shape)
     if cov.ndim < 2 or (data.ndim == 3 and cov.shape[-2] == 1):
@@ -100,8 +132,20 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
 
     # Prepare mask and set to zero all the frequencies in the masked pixels:
     # NOTE: mask are good pixels
-    mask = ~(_intersect_mask(data) | _intersect_mask(cov))
+    if partial_coverage:
+        # Null weight to the masked frequencies, mask only the pixels that
+        # observe too few of them
+        unseen = _masked_entries(data) | _masked_entries(cov)
+        n_observed = np.sum(~unseen, axis=0)
+        mask = np.all(n_observed >= len(components),
+                      axis=tuple(range(n_observed.ndim - 1)))
+        cov = np.where(unseen, np.inf, hp.pixelfunc.ma_to_array(cov))
+        data = np.where(unseen, 0., hp.pixelfunc.ma_to_array(data))
+    else:
+        mask = ~(_intersect_mask(data) | _intersect_mask(cov))
 
+    # Store invN only for the pixels and Stokes where cov actually changes
+    cov = alg._unbroadcast(cov.T, 1).T
     invN = np.zeros(cov.shape[:1] + cov.shape)
     for i in range(cov.shape[0]):
         invN[i, i] = 1. / cov[i]
@@ -109,23 +153,29 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
     if invN.shape[0] != 1:
         invN = invN[mask]
 
-    data_cs = hp.pixelfunc.ma_to_array(data).T[mask]
+    data_cs = hp.pixelfunc.ma_to_array(data).T[mask].astype(dtype, copy=False)
     assert not np.any(hp.ma(data_cs).mask)
 
     A_ev, A_dB_ev, comp_of_param, x0, params = _A_evaluator(components,
                                                             instrument)
     if len(x0) == 0:
         A_ev = A_ev()
+    minimize_kwargs.setdefault('group_by_coverage', partial_coverage)
 
     # Component separation
     if nside:
-        patch_ids = hp.ud_grade(np.arange(hp.nside2npix(nside)),
-                                hp.npix2nside(data.shape[-1]))[mask]
+        if footprint is None:
+            patch_index = _healpix_patch_index(
+                nside, hp.npix2nside(data.shape[-1]), mask)
+        else:
+            patch_index = _healpix_patch_index(
+                nside, footprint.nside, mask, footprint.pixels)
         res = alg.multi_comp_sep(A_ev, data_cs, invN, A_dB_ev, comp_of_param,
-                                 patch_ids, x0, **minimize_kwargs)
+                                 patch_index, x0, outputs=outputs,
+                                 **minimize_kwargs)
     else:
         res = alg.comp_sep(A_ev, data_cs, invN, A_dB_ev, comp_of_param, x0,
-                           **minimize_kwargs)
+                           outputs=outputs, **minimize_kwargs)
 
     # Craft output
     res.params = params
@@ -133,7 +183,8 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
     def craft_maps(maps):
         # Unfold the masked maps
         # Restore the ordering of the input data (pixel dimension last)
-        result = np.full(data.shape[-1:] + maps.shape[1:], hp.UNSEEN)
+        result = np.full(data.shape[-1:] + maps.shape[1:], hp.UNSEEN,
+                         maps.dtype)
         result[mask] = maps
         return result.T
 
@@ -153,15 +204,20 @@ def weighted_comp_sep(components, instrument, data, cov, nside=0,
             res.x = craft_params(res.x)
             res.Sigma = craft_params(res.Sigma)
 
-    res.s = craft_maps(res.s)
-    res.chi = craft_maps(res.chi)
-    res.invAtNA = craft_maps(res.invAtNA)
+    for name in ('s', 'chi', 'invAtNA'):
+        if name in res:
+            res[name] = craft_maps(res[name])
+    if partial_coverage and 'chi' in res:
+        res.chi[np.broadcast_to(unseen, res.chi.shape)] = hp.UNSEEN
+    if footprint is not None:
+        _to_footprint(res, footprint, ('s', 'chi', 'invAtNA', 'chi_dB'))
     res.mask_good = mask
 
     return res
 
 
-def basic_comp_sep(components, instrument, data, nside=0, **minimize_kwargs):
+def basic_comp_sep(components, instrument, data, nside=0, dtype=np.float64,
+                   outputs=None, fit_nside=0, **minimize_kwargs):
     """ Basic component separation
 
     Parameters
@@ -186,9 +242,29 @@ def basic_comp_sep(components, instrument, data, nside=0, **minimize_kwargs):
 
         Values equal to `hp.UNSEEN` or, if `MaskedArray`, masked values are
         neglected during the component separation process.
+        It can be also :class:`PartialMaps`: all the output maps are then
+        :class:`PartialMaps` with the same pixels.
     nside:
         For each pixel of a HEALPix map with this nside, the non-linear
         parameters are estimated independently
+    dtype: data-type
+        Floating point type of the data during the separation and of the
+        output maps (*s* and *chi*). Use ``np.float32`` to halve their memory
+        footprint. The spectral likelihood is always evaluated in double
+        precision.
+    outputs: str or list of str
+        Per-pixel products to compute, among ``'s'``, ``'invAtNA'``,
+        ``'chi'`` and ``'chi_dB'`` (see :func:`fgbuster.algebra.comp_sep`).
+        By default, all of them.
+    fit_nside: int
+        If non-zero, the parameters are fitted on the data downgraded to this
+        nside, which has to be lower than the one of the data and not lower
+        than *nside*. The maps are averaged with inverse-noise weights and
+        the noise level of the downgraded maps is set accordingly. The
+        components are then separated at full resolution with the best-fit
+        parameters. For foregrounds that are smooth on the scale of the
+        downgraded pixels, the cost of the fit drops by the square of the
+        downgrade factor. *chi_dB* is not available in this mode.
 
     Returns
     -------
@@ -204,7 +280,10 @@ def basic_comp_sep(components, instrument, data, nside=0, **minimize_kwargs):
           *cov* is the true covariance of the data
         - **s**: *(ndarray)* - Component amplitude maps
         - **mask_good**: *(ndarray)* - mask of the entries actually used in the
-          component separation
+          component separation (of the observed pixels, for
+          :class:`PartialMaps`)
+        - **fit_res**: *(dict)* - Only if *fit_nside* is non-zero. Result of
+          the fit on the downgraded data
 
     Note
     ----
@@ -219,64 +298,441 @@ def basic_comp_sep(components, instrument, data, nside=0, **minimize_kwargs):
       >>> res_T = basic_comp_sep(component_T, instrument, data[:, 0], **kwargs)
       >>> res_P = basic_comp_sep(component_P, instrument, data[:, 1:], **kwargs)
 
+    """
+    footprint = data if isinstance(data, PartialMaps) else None
+    values = data if footprint is None else data.values
+    plan = SeparationPlan(components, instrument, values.shape, nside,
+                          _intersect_mask(values), dtype, footprint, fit_nside)
+    return plan.run(data, outputs, **minimize_kwargs)
+
+
+class SeparationPlan(object):
+    """ Reusable setup of :func:`basic_comp_sep`
+
+    Everything that depends only on the components, the instrument, the shape
+    of the data, the mask and the patches is computed at construction time.
+    Calling :meth:`run` on new data with the same geometry skips all this
+    setup work.
+
+    Parameters
+    ----------
+    components: list
+        List storing the :class:`Component` s of the mixing matrix
+    instrument:
+        Object that provides the following as a key or an attribute.
+
+        - **frequency**
+        - **depth_i** or **depth_p** (optional, frequencies are inverse-noise
+          weighted according to these noise levels)
+
+        They can be anything that is convertible to a float numpy array.
+    data_shape: tuple
+        Shape of the data to be separated, *(n_freq, ..., n_pix)*. See
+        :func:`basic_comp_sep`. For :class:`PartialMaps`, the shape of their
+        values.
+    nside:
+        For each pixel of a HEALPix map with this nside, the non-linear
+        parameters are estimated independently
+    mask: ndarray
+        Boolean array of length *n_pix*, true for the pixels that are
+        excluded from the component separation. If ``None``, all the pixels
+        are used.
+    dtype: data-type
+        Floating point type of the data during the separation and of the
+        output maps. See :func:`basic_comp_sep`.
+    footprint: PartialMaps
+        If the data are :class:`PartialMaps`, any of them: only their nside
+        and pixels are used. *mask* refers to these pixels.
+    fit_nside: int
+        If non-zero, the parameters are fitted on the data downgraded to this
+        nside. See :func:`basic_comp_sep`.
+
+    Attributes
+    ----------
+    x0: ndarray
+        Starting point of the fit. By default, the defaults of the components.
+        When separating a stream of similar data sets, you can set it to the
+        best-fit of the last run.
+
+    Example
+    -------
+    >>> plan = SeparationPlan(components, instrument, data.shape, mask=mask)
+    >>> for data in stream:
+    ...     res = plan.run(data)
+    """
+
+    def __init__(self, components, instrument, data_shape, nside=0,
+                 mask=None, dtype=np.float64, footprint=None, fit_nside=0):
+        instrument = standardize_instrument(instrument)
+        self.data_shape = tuple(data_shape)
+        self.nside = nside
+        self.dtype = np.dtype(dtype)
+        self.footprint = footprint
+        if mask is None:
+            mask = np.zeros(self.data_shape[-1], dtype=bool)
+        # NOTE: mask are bad pixels
+        self.mask = mask
+
+        if footprint is not None:
+            data_nside = footprint.nside
+        else:
+            try:
+                data_nside = hp.npix2nside(self.data_shape[-1])
+            except (TypeError, ValueError):
+                # Not a healpix map
+                data_nside = 0
+        self.prewhiten_factors = _get_prewhiten_factors(
+            instrument, self.data_shape, data_nside)
+        (self.A_ev, self.A_dB_ev, self.comp_of_param,
+         self.x0, self.params) = _A_evaluator(
+            components, instrument, prewhiten_factors=self.prewhiten_factors)
+        if len(self.x0) == 0:
+            self.A_ev = self.A_ev()
+
+        if nside and footprint is not None:
+            self.patch_index = _healpix_patch_index(
+                nside, data_nside, pixels=footprint.pixels)
+            # The patches with no good pixel are masked
+            x_good = np.zeros(hp.nside2npix(nside), dtype=bool)
+            x_good[_healpix_patch_ids(
+                nside, data_nside, footprint.pixels[~mask])] = True
+            self.x_mask = ~x_good
+        elif nside:
+            self.patch_index = _healpix_patch_index(nside, data_nside)
+            self.x_mask = hp.ud_grade(mask.astype(float), nside) == 1.
+
+        self.fit_nside = fit_nside
+        if fit_nside:
+            if not nside <= fit_nside < data_nside:
+                raise ValueError(
+                    "fit_nside (%i) has to be lower than the nside of the data "
+                    "(%i) and not lower than nside (%i)"
+                    % (fit_nside, data_nside, nside))
+            pixels = None if footprint is None else footprint.pixels
+            # Pixel at fit_nside of each pixel of the data
+            self._fit_ids = _healpix_patch_ids(fit_nside, data_nside, pixels)
+            self._n_good = np.bincount(self._fit_ids[~mask],
+                                       minlength=hp.nside2npix(fit_nside))
+            self._n_sub = (data_nside // fit_nside)**2
+            self.fit_plan = SeparationPlan(
+                components, instrument,
+                self.data_shape[:-1] + (len(self._n_good),), nside,
+                self._n_good == 0)
+
+    def run(self, data, outputs=None, **minimize_kwargs):
+        """ Separate the components
+
+        Parameters
+        ----------
+        data: ndarray, MaskedArray or PartialMaps
+            Data vector to be separated. Its shape must be the *data_shape* of
+            the plan. Values equal to `hp.UNSEEN` or, if `MaskedArray`, masked
+            values are allowed only in the pixels masked by the plan.
+            :class:`PartialMaps` must have the pixels of the *footprint* of
+            the plan.
+        outputs: str or list of str
+            Per-pixel products to compute. See :func:`basic_comp_sep`.
+        minimize_kwargs: dict
+            Keyword arguments to be passed to `scipy.optimize.minimize`.
+
+        Returns
+        -------
+        result: dict
+            Same as :func:`basic_comp_sep`
+        """
+        if self.footprint is not None:
+            data = _footprint_values(data, self.footprint)
+        if data.shape != self.data_shape:
+            raise ValueError("The plan was prepared for data with shape %s, "
+                             "got %s" % (self.data_shape, data.shape))
+        mask = self.mask
+        if np.any(_intersect_mask(data) & ~mask):
+            raise ValueError("The data have masked values outside of the mask "
+                             "of the plan")
+
+        # Set to zero all the frequencies in the masked pixels
+        data = np.array(hp.pixelfunc.ma_to_array(data), dtype=self.dtype)
+        data[..., mask] = 0  # Thus no contribution to the spectral likelihood
+        if self.fit_nside:
+            low_res_data = self._downgrade(data)
+        prewhitened_data = data.T
+        if self.prewhiten_factors is not None:
+            prewhitened_data *= self.prewhiten_factors
+
+        # Component separation
+        if self.fit_nside:
+            res = self._fit_low_res(low_res_data, prewhitened_data, outputs,
+                                    **minimize_kwargs)
+        elif self.nside:
+            res = alg.multi_comp_sep(
+                self.A_ev, prewhitened_data, None, self.A_dB_ev,
+                self.comp_of_param, self.patch_index, self.x0,
+                outputs=outputs, **minimize_kwargs)
+        else:
+            res = alg.comp_sep(
+                self.A_ev, prewhitened_data, None, self.A_dB_ev,
+                self.comp_of_param, self.x0, outputs=outputs,
+                **minimize_kwargs)
+
+        # Craft output
+        # 1) Apply the mask, if any
+        # 2) Restore the ordering of the input data (pixel dimension last)
+        res.params = self.params
+        for name in ('s', 'chi'):
+            if name in res:
+                res[name] = res[name].T
+                res[name][..., mask] = hp.UNSEEN
+        if 'chi_dB' in res:
+            for i in range(len(res.chi_dB)):
+                res.chi_dB[i] = res.chi_dB[i].T
+                res.chi_dB[i][..., mask] = hp.UNSEEN
+        if self.nside and len(self.x0) > 0 and not self.fit_nside:
+            if self.footprint is not None:
+                # The last patches are missing if none of their pixels is
+                # observed
+                res.x = _append_missing_patches(res.x, self.nside)
+                res.Sigma = _append_missing_patches(res.Sigma, self.nside)
+            res.x[self.x_mask] = hp.UNSEEN
+            res.Sigma[self.x_mask] = hp.UNSEEN
+            res.x = res.x.T
+            res.Sigma = res.Sigma.T
+        if self.footprint is not None:
+            _to_footprint(res, self.footprint, ('s', 'chi', 'chi_dB'))
+
+        res.mask_good = ~mask
+        return res
+
+    def _fit_low_res(self, low_res_data, prewhitened_data, outputs,
+                     **minimize_kwargs):
+        # Fit the parameters at fit_nside, then separate the components at
+        # full resolution with the best-fit mixing matrix
+        fit_res = self.fit_plan.run(low_res_data, (), **minimize_kwargs)
+        if len(self.x0) == 0:
+            A = self.A_ev
+        elif self.nside:
+            # Masked patches are empty: any mixing matrix would do
+            x = fit_res.x.T.copy()
+            x[np.any(x == hp.UNSEEN, -1)] = self.x0
+            A = [self.A_ev(x_patch) for x_patch in x]
+        else:
+            A = self.A_ev(fit_res.x)
+
+        if self.nside:
+            res = alg.multi_comp_sep(A, prewhitened_data, None, None, None,
+                                     self.patch_index, outputs=outputs)
+        else:
+            res = alg.comp_sep(A, prewhitened_data, None, None, None,
+                               outputs=outputs)
+        if len(self.x0) > 0:
+            res.x = fit_res.x
+            res.Sigma = fit_res.Sigma
+        res.fit_res = fit_res
+        return res
+
+    def _downgrade(self, data):
+        # Inverse-noise weighted average of the data at fit_nside. All the
+        # pixels have the same noise, so the weights are one in the good
+        # pixels and zero in the masked ones (already zero in data). A
+        # downgraded pixel made of n_good good pixels has the noise variance
+        # of a fully observed one times n_sub / n_good: multiplying it by
+        # sqrt(n_good / n_sub) makes the noise of the downgraded maps
+        # uniform, as fit_plan expects.
+        n_fit_pix = len(self._n_good)
+        rows = data.reshape(-1, data.shape[-1])
+        low_res = np.empty((len(rows), n_fit_pix))
+        for low_res_row, row in zip(low_res, rows):
+            low_res_row[:] = np.bincount(self._fit_ids, weights=row,
+                                         minlength=n_fit_pix)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            low_res /= np.sqrt(self._n_good * self._n_sub)
+        low_res[:, self._n_good == 0] = 0.
+        return low_res.reshape(data.shape[:-1] + (n_fit_pix,))
+
+
+def ensemble_comp_sep(components, instrument, data, stacked=False, n_jobs=1,
+                      return_maps=False, **minimize_kwargs):
+    """ Component separation of many realizations of the same sky
+
+    Equivalent to calling :func:`basic_comp_sep` (with ``nside=0``) on each
+    realization, but the mixing matrix, the prewhitening and the mask are set
+    up only once. Moreover, since the spectral parameters are the same in all
+    the pixels, the spectral likelihood depends on each realization only
+    through its (*n_freq*, *n_freq*) sample covariance: the realizations are
+    compressed to it before the fit, whose cost does not depend on the number
+    of pixels.
+
+    Parameters
+    ----------
+    components: list
+        List storing the :class:`Component` s of the mixing matrix
+    instrument:
+        Object that provides the following as a key or an attribute.
+
+        - **frequency**
+        - **depth_i** or **depth_p** (optional, frequencies are inverse-noise
+          weighted according to these noise levels)
+
+        They can be anything that is convertible to a float numpy array.
+    data: ndarray or MaskedArray
+        Stack of realizations. Shape *(n_sims, n_freq, ..., n_pix)*. See
+        :func:`basic_comp_sep` for the meaning of *...*.
+        Values equal to `hp.UNSEEN` or, if `MaskedArray`, masked values are
+        neglected during the component separation process.
+        It can be also :class:`PartialMaps`: *s* and *chi* are then
+        :class:`PartialMaps` with the same pixels.
+    stacked: bool
+        If true, all the realizations are fitted at once, minimizing the sum of
+        their (independent) likelihoods with a single call to
+        `scipy.optimize.minimize`. The mixing matrices of all the realizations
+        are evaluated with a single call. Otherwise, each realization is
+        fitted independently.
+    n_jobs: int
+        Number of realizations fitted concurrently in a pool of threads.
+        Ignored if *stacked* is true.
+    return_maps: bool
+        If true, compute also the component maps and the residuals of each
+        realization. They require memory proportional to the size of *data*.
+
+    Returns
+    -------
+    result: dict
+	It includes
+
+	- **param**: *(list)* - Names of the parameters fitted
+	- **x**: *(ndarray)* - ``x[k]`` is the best-fit of the *k*-th
+          realization. Shape *(n_sims, n_param)*
+        - **Sigma**: *(ndarray)* - ``Sigma[k]`` is the semi-analytic covariance
+          of the best-fit parameters of the *k*-th realization.
+          Shape *(n_sims, n_param, n_param)*
+        - **fun**, **nit**, **success**: *(ndarray)* - -logL at the
+          best-fit, number of iterations and success of the fit of each
+          realization. If *stacked*, **nit** and **success** refer to the
+          joint fit.
+        - **x_mean**, **x_std**: *(ndarray)* - Empirical mean and standard
+          deviation of the best-fit parameters across the realizations
+        - **Sigma_mean**: *(ndarray)* - Average of the semi-analytic
+          covariances
+        - **s**, **chi**: *(ndarray)* - Only if *return_maps*. Component maps
+          and residuals. Shape *(n_sims, ...)*, where *...* is the shape of the
+          corresponding output of :func:`basic_comp_sep`
+        - **mask_good**: *(ndarray)* - mask of the entries actually used in the
+          component separation
+
+    Note
+    ----
+    A pixel is masked if at least one of its frequencies is masked in at least
+    one of the realizations.
     """
     instrument = standardize_instrument(instrument)
-    # Prepare mask and set to zero all the frequencies in the masked pixels:
-    # NOTE: mask are bad pixels
+    footprint = data if isinstance(data, PartialMaps) else None
+    if footprint is not None:
+        data = footprint.values
+    n_sims = len(data)
     mask = _intersect_mask(data)
-    data = hp.pixelfunc.ma_to_array(data).copy()
-    data[..., mask] = 0  # Thus no contribution to the spectral likelihood
-
-    try:
-        data_nside = hp.get_nside(data[0])
-    except TypeError:
-        data_nside = 0
-    prewhiten_factors = _get_prewhiten_factors(instrument, data.shape,
+    if footprint is not None:
+        data_nside = footprint.nside
+    else:
+        try:
+            data_nside = hp.get_nside(data[0, 0])
+        except TypeError:
+            data_nside = 0
+    prewhiten_factors = _get_prewhiten_factors(instrument, data.shape[1:],
                                                data_nside)
+    if prewhiten_factors is None:
+        prewhiten_factors = np.ones(1)
     A_ev, A_dB_ev, comp_of_param, x0, params = _A_evaluator(
         components, instrument, prewhiten_factors=prewhiten_factors)
-    if len(x0) == 0:
-        A_ev = A_ev()
-    if prewhiten_factors is None:
-        prewhitened_data = data.T
-    else:
-        prewhitened_data = prewhiten_factors * data.T
+    assert len(x0), "The mixing matrix has no free parameter"
 
-    # Component separation
-    if nside:
-        patch_ids = hp.ud_grade(np.arange(hp.nside2npix(nside)),
-                                hp.npix2nside(data.shape[-1]))
-        res = alg.multi_comp_sep(
-            A_ev, prewhitened_data, None, A_dB_ev, comp_of_param, patch_ids,
-            x0, **minimize_kwargs)
+    def prewhitened_data(k):
+        return prewhiten_factors * hp.pixelfunc.ma_to_array(data[k]).T
+
+    # Compress each realization: only the unmasked pixels are considered
+    compressed_data = [alg._compress_pixels(prewhitened_data(k)[~mask])
+                       for k in range(n_sims)]
+
+    res = OptimizeResult()
+    if stacked:
+        _stacked_comp_sep(res, components, instrument, prewhiten_factors,
+                          np.stack(compressed_data), x0, **minimize_kwargs)
     else:
-        res = alg.comp_sep(A_ev, prewhitened_data, None, A_dB_ev, comp_of_param,
-                           x0, **minimize_kwargs)
+        def fit(compressed_d):
+            return alg.comp_sep(A_ev, compressed_d, None, A_dB_ev,
+                                comp_of_param, x0, **minimize_kwargs)
+
+        with ThreadPoolExecutor(n_jobs) as executor:
+            sims_res = list(executor.map(fit, compressed_data))
+        for key in ['x', 'Sigma', 'fun', 'nit', 'success']:
+            res[key] = np.array([r[key] for r in sims_res])
+
+    res.x_mean = res.x.mean(0)
+    res.x_std = res.x.std(0)
+    res.Sigma_mean = res.Sigma.mean(0)
+
+    if return_maps:
+        res.s = []
+        res.chi = []
+        for k in range(n_sims):
+            pw_d = prewhitened_data(k)
+            pw_d[mask] = 0.
+            sim_res = alg.comp_sep(A_ev(res.x[k]), pw_d, None, None, None)
+            res.s.append(sim_res.s.T)
+            res.s[-1][..., mask] = hp.UNSEEN
+            res.chi.append(sim_res.chi.T)
+            res.chi[-1][..., mask] = hp.UNSEEN
+        res.s = np.array(res.s)
+        res.chi = np.array(res.chi)
+        if footprint is not None:
+            _to_footprint(res, footprint, ('s', 'chi'))
 
-    # Craft output
-    # 1) Apply the mask, if any
-    # 2) Restore the ordering of the input data (pixel dimension last)
     res.params = params
-    res.s = res.s.T
-    res.s[..., mask] = hp.UNSEEN
-    res.chi = res.chi.T
-    res.chi[..., mask] = hp.UNSEEN
-    if 'chi_dB' in res:
-        for i in range(len(res.chi_dB)):
-            res.chi_dB[i] = res.chi_dB[i].T
-            res.chi_dB[i][..., mask] = hp.UNSEEN
-    if nside and len(x0) > 0:
-        x_mask = hp.ud_grade(mask.astype(float), nside) == 1.
-        res.x[x_mask] = hp.UNSEEN
-        res.Sigma[x_mask] = hp.UNSEEN
-        res.x = res.x.T
-        res.Sigma = res.Sigma.T
-
     res.mask_good = ~mask
     return res
 
 
-def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
+def _stacked_comp_sep(res, components, instrument, prewhiten_factors,
+                      data, x0, **minimize_kwargs):
+    # Fit the realizations stacked in the first dimension of data at once.
+    # The parameter vector is x0 repeated for each realization: the parameter
+    # of the same kind are next to each other.
+    n_sims = data.shape[0]
+    n_param = len(x0)
+    extra_dim = [1] * (data.ndim - 2)
+    unpack = lambda x: x.reshape(n_param, n_sims, *extra_dim)
+    A_ev, A_dB_ev, comp_of_param, _, _ = _A_evaluator(
+        components, instrument, prewhiten_factors=prewhiten_factors,
+        unpack=unpack)
+
+    # Each parameter is fitted independently on each realization
+    sim_ids = np.arange(n_sims).reshape(n_sims, *extra_dim)
+    comp_of_dB = [(c_db, sim_ids) for c_db in comp_of_param]
+    stacked_res = alg.comp_sep(A_ev, data, None, A_dB_ev, comp_of_dB,
+                               np.repeat(x0, n_sims), **minimize_kwargs)
+
+    # Per-realization quantities
+    res.x = stacked_res.x.reshape(n_param, n_sims).T
+    u_e_v = np.linalg.svd(A_ev(stacked_res.x), full_matrices=False)
+    A_dB = A_dB_ev(stacked_res.x)
+    res.fun = - 0.5 * np.sum(alg._mtv(u_e_v[0], data)**2,
+                             axis=tuple(range(1, data.ndim)))
+    _, comp_of_param = alg._A_dB_and_comp_of_dB_as_compatible_list(
+        A_dB, comp_of_param)
+    res.Sigma = np.empty((n_sims, n_param, n_param))
+    for k in range(n_sims):
+        fisher = alg._fisher_logL_dB_dB_svd(
+            [m[k] for m in u_e_v], stacked_res.s[k],
+            [A_dB_i[k] for A_dB_i in A_dB], comp_of_param)
+        try:
+            res.Sigma[k] = np.linalg.inv(fisher)
+        except np.linalg.LinAlgError:
+            res.Sigma[k] = np.nan
+    res.nit = np.full(n_sims, stacked_res.nit)
+    res.success = np.full(n_sims, stacked_res.success)
+
+
+def multi_res_comp_sep(components, instrument, data, nsides, outputs=None,
+                       checkpoint=None, checkpoint_every=10,
+                       **minimize_kwargs):
     """ Basic component separation
 
     Parameters
@@ -301,8 +757,21 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
 
         Values equal to `hp.UNSEEN` or, if `MaskedArray`, masked values are
         neglected during the component separation process.
+        It can be also :class:`PartialMaps`: the output maps are then
+        :class:`PartialMaps` with the same pixels. Notice however that, unless
+        all the *nsides* are zero, the separation itself is carried out on the
+        full sky.
     nsides: seq
         Specify the ``nside`` for each free parameter of the components
+    outputs: str or list of str
+        Per-pixel products to compute. See :func:`basic_comp_sep`.
+    checkpoint: fgbuster.algebra.Checkpoint
+        If provided, the parameters of the minimizer are stored every
+        *checkpoint_every* iterations (entry ``'x'``). If the checkpoint
+        already contains them (e.g. the run was interrupted), the minimization
+        starts from there. Ignored if all the *nsides* are zero.
+    checkpoint_every: int
+        Number of iterations between two stores of the parameters.
 
     Returns
     -------
@@ -337,7 +806,14 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
     instrument = standardize_instrument(instrument)
     max_nside = max(nsides)
     if max_nside == 0:
-        return basic_comp_sep(components, instrument, data, **minimize_kwargs)
+        return basic_comp_sep(components, instrument, data, outputs=outputs,
+                              **minimize_kwargs)
+
+    # The pixels sharing the same parameters are stacked in blocks of equal
+    # size, which requires the full sky
+    footprint = data if isinstance(data, PartialMaps) else None
+    if footprint is not None:
+        data = footprint.to_full()
 
     # Prepare mask and set to zero all the frequencies in the masked pixels:
     # NOTE: mask are bad pixels
@@ -363,14 +839,11 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
         return maps
 
     extra_dim = [1]*(data.ndim-1)
-    unpack = lambda x: [
-        _my_ud_grade(m, max_nside).reshape(-1, *extra_dim)
-        for m in array2maps(x)]
 
     # Traspose the the data and put the pixels that share the same spectral
     # indices next to each other
     n_pix_max_nside = hp.nside2npix(max_nside)
-    pix_ids = np.argsort(hp.ud_grade(np.arange(n_pix_max_nside), data_nside))
+    pix_ids = _healpix_patch_index(max_nside, data_nside).pixels
     data = data.T[pix_ids].reshape(
         n_pix_max_nside, (data_nside // max_nside)**2, *data.T.shape[1:])
     back_pix_ids = np.argsort(pix_ids)
@@ -378,8 +851,9 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
     A = MixingMatrix(*components)
     assert A.n_param == len(nsides), (
         "%i free parameters but %i nsides" % (len(A.defaults), len(nsides)))
-    A_ev = A.evaluator(instrument.frequency, unpack)
-    A_dB_ev = A.diff_evaluator(instrument.frequency, unpack)
+    A_ev, A_dB_ev = _multi_res_evaluators(
+        components, instrument.frequency, nsides, max_nside, extra_dim,
+        array2maps)
     x0 = [x for c in components for x in c.defaults]
     x0 = [np.full(_my_nside2npix(nside), px0) for nside, px0 in zip(nsides, x0)]
     x0 = np.concatenate(x0)
@@ -388,12 +862,29 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
         A_ev = A_ev()
 
     comp_of_dB = [
-        (c_db, _my_ud_grade(np.arange(_my_nside2npix(p_nside)), max_nside))
+        (c_db, _healpix_patch_ids(p_nside, max_nside))
         for p_nside, c_db in zip(nsides, A.comp_of_dB)]
 
+    if checkpoint is not None and len(x0) > 0:
+        # Resume from the last parameters stored, store them periodically
+        x_stored = checkpoint.load('x')
+        if x_stored is not None:
+            x0 = x_stored
+        n_iter = [0]
+
+        def store_x(xk):
+            n_iter[0] += 1
+            if n_iter[0] % checkpoint_every == 0:
+                checkpoint.store('x', np.array(xk))
+
+        minimize_kwargs['callback'] = alg._chain_callback(
+            store_x, minimize_kwargs.get('callback'))
+
     # Component separation
     res = alg.comp_sep(A_ev, data, invN, A_dB_ev, comp_of_dB, x0,
-                       **minimize_kwargs)
+                       outputs=outputs, **minimize_kwargs)
+    if checkpoint is not None and len(x0) > 0:
+        checkpoint.store('x', res.x)
 
     # Craft output
     # 1) Apply the mask, if any
@@ -404,8 +895,9 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
         return x.T
 
     res.params = A.params
-    res.s = restore_index_mask_transpose(res.s)
-    res.chi = restore_index_mask_transpose(res.chi)
+    for name in ('s', 'chi'):
+        if name in res:
+            res[name] = restore_index_mask_transpose(res[name])
     if 'chi_dB' in res:
         for i in range(len(res.chi_dB)):
             res.chi_dB[i] = restore_index_mask_transpose(res.chi_dB[i])
@@ -418,6 +910,14 @@ def multi_res_comp_sep(components, instrument, data, nsides, **minimize_kwargs):
             x[x_mask] = hp.UNSEEN
 
     res.mask_good = ~mask
+    if footprint is not None:
+        res.mask_good = res.mask_good[footprint.pixels]
+        for name in ('s', 'chi'):
+            if name in res:
+                res[name] = res[name][..., footprint.pixels]
+        if 'chi_dB' in res:
+            res.chi_dB = [c[..., footprint.pixels] for c in res.chi_dB]
+        _to_footprint(res, footprint, ('s', 'chi', 'chi_dB'))
     return res
 
 
@@ -441,12 +941,16 @@ def harmonic_ilc(components, instrument, data, lbins=None, weights=None, iter=3)
 	fot T, E and B.
         Values equal to hp.UNSEEN or, if MaskedArray, masked values are
         neglected during the component separation process.
+        It can be also :class:`PartialMaps` (the alms are computed on the
+        full sky anyway): *s* is then :class:`PartialMaps` with the same
+        pixels.
     lbins: array
         It stores the edges of the bins that will have the same ILC weights.
         If a multipole is not in a bin but is the alms, an independent bin
 	will be assigned to it
     weights: array
-        If provided data are multiplied by the weights map before computing alms
+        If provided data are multiplied by the weights map before computing
+        alms. If *data* is :class:`PartialMaps`, it can be :class:`PartialMaps` too.
 
     Returns
     -------
@@ -471,6 +975,11 @@ def harmonic_ilc(components, instrument, data, lbins=None, weights=None, iter=3)
 
     """
     instrument = standardize_instrument(instrument)
+    footprint = data if isinstance(data, PartialMaps) else None
+    if footprint is not None:
+        data = footprint.to_full()
+        if isinstance(weights, PartialMaps):
+            weights = weights.to_full(0.)
     nside = hp.get_nside(data[0])
     lmax = 3 * nside - 1
     lmax = min(lmax, lbins.max())
@@ -501,6 +1010,8 @@ def harmonic_ilc(components, instrument, data, lbins=None, weights=None, iter=3)
     res.s = np.empty((n_comp,) + data.shape[1:], dtype=data.dtype)
     for c in range(n_comp):
         res.s[c] = hp.alm2map(alms[c], nside)
+    if footprint is not None:
+        res.s = footprint.with_values(res.s[..., footprint.pixels])
 
     return res
 
@@ -676,9 +1187,13 @@ def ilc(components, instrument, data, patch_ids=None):
         ``...`` can be also absent.
         Values equal to hp.UNSEEN or, if MaskedArray, masked values are
         neglected during the component separation process.
+        It can be also :class:`PartialMaps`: *s* is then
+        :class:`PartialMaps` with the same pixels.
     patch_ids: array
         It stores the id of the region over which the ILC weights are computed
-        independently. It must be broadcast-compatible with data.
+        independently. It must be broadcast-compatible with data. If *data*
+        is :class:`PartialMaps`, it can be either full-sky or restricted to
+        the observed pixels.
 
     Returns
     -------
@@ -697,6 +1212,11 @@ def ilc(components, instrument, data, patch_ids=None):
     """
     # Checks
     instrument = standardize_instrument(instrument)
+    footprint = data if isinstance(data, PartialMaps) else None
+    if footprint is not None:
+        data = footprint.values
+        if patch_ids is not None:
+            patch_ids = _footprint_values(patch_ids, footprint)
     np.broadcast(data, patch_ids)
     n_freq = data.shape[0]
     assert len(instrument.frequency) == n_freq,\
@@ -749,11 +1269,15 @@ def ilc(components, instrument, data, patch_ids=None):
         res.W = np.full((n_id, n_comp, n_freq), hp.UNSEEN)
         patch_ids_bak = patch_ids.copy().T
         patch_ids_bak[~mask] = -1
-        for i in range(n_id):
-            ids_i = np.where(patch_ids_bak == i)
-            ilc_patch(ids_i, i)
+        # Shift the ids by one: masked entries are in the (neglected) patch 0
+        patch_index = alg.PatchIndex(patch_ids_bak + 1)
+        for i in range(1, patch_index.n_patch):
+            if not patch_index.is_empty(i):
+                ilc_patch(patch_index.indexing(i), i - 1)
 
     res.s = res.s.T
+    if footprint is not None:
+        _to_footprint(res, footprint, ('s',))
     res.components = mm.components
 
     return res
@@ -800,10 +1324,11 @@ def _get_prewhiten_factors(instrument, data_shape, nside):
         return 12**0.5 * hp.nside2resol(1, arcmin=True) / sens
 
 
-def _A_evaluator(components, instrument, prewhiten_factors=None):
+def _A_evaluator(components, instrument, prewhiten_factors=None, unpack=None):
     A = MixingMatrix(*components)
-    A_ev = A.evaluator(instrument.frequency)
-    A_dB_ev = A.diff_evaluator(instrument.frequency)
+    unpack_kwargs = {} if unpack is None else dict(unpack=unpack)
+    A_ev = A.evaluator(instrument.frequency, **unpack_kwargs)
+    A_dB_ev = A.diff_evaluator(instrument.frequency, **unpack_kwargs)
     comp_of_dB = A.comp_of_dB
     x0 = np.array([x for c in components for x in c.defaults])
     params = A.params
@@ -822,6 +1347,65 @@ def _A_evaluator(components, instrument, prewhiten_factors=None):
     return pw_A_ev, pw_A_dB_ev, comp_of_dB, x0, params
 
 
+def _multi_res_evaluators(components, nu, nsides, max_nside, extra_dim,
+                          array2maps):
+    """ Evaluators of the mixing matrix and its derivatives for multi_res
+
+    Every component is evaluated at the highest nside of its parameters and
+    the result is then indexed up to *max_nside*. The returned arrays have
+    shape *(n_pix_max_nside, *extra_dim, n_freq, ...)*
+    """
+    comp_params = []  # Indices of the parameters of each component
+    for c in components:
+        first = sum(len(p) for p in comp_params)
+        comp_params.append(list(range(first, first + c.n_param)))
+    comp_nsides = [max([nsides[i] for i in params], default=0)
+                   for params in comp_params]
+    # For each component, pixel at comp_nside of every pixel at max_nside
+    comp_ids = [_healpix_patch_ids(nside, max_nside) for nside in comp_nsides]
+    # For each parameter, pixel at nside of every pixel at comp_nside
+    param_ids = [[_upgrade_ids(nsides[i], comp_nside) for i in params]
+                 for params, comp_nside in zip(comp_params, comp_nsides)]
+
+    def unpack(x):
+        # Parameters of each component, at the nside of the component
+        maps = array2maps(x)
+        return [[maps[i][p_id].reshape(-1, *extra_dim)
+                 for i, p_id in zip(params, p_ids)]
+                for params, p_ids in zip(comp_params, param_ids)]
+
+    n_pix = hp.nside2npix(max_nside)
+
+    def A_ev(x):
+        res = np.empty((n_pix, *extra_dim, len(nu), len(components)))
+        for i_c, (c, ids, c_params) in enumerate(
+                zip(components, comp_ids, unpack(x))):
+            sed = c.eval(nu, *c_params)
+            if c_params:
+                shape = (len(c_params[0]), *extra_dim, len(nu))
+                sed = np.broadcast_to(sed, shape)[ids]
+            res[..., i_c] = sed
+        return res
+
+    def A_dB_ev(x):
+        res = []
+        for c, ids, c_params in zip(components, comp_ids, unpack(x)):
+            if c_params:
+                shape = (len(c_params[0]), *extra_dim, len(nu))
+                res += [np.broadcast_to(sed_dB, shape)[ids][..., np.newaxis]
+                        for sed_dB in c.diff(nu, *c_params)]
+        return res
+
+    return A_ev, A_dB_ev
+
+
+def _upgrade_ids(nside, nside_out):
+    # Indices that upgrade a map from nside to nside_out (0 means one value)
+    if nside_out == 0:
+        return np.zeros(1, dtype=int)
+    return _healpix_patch_ids(nside, nside_out)
+
+
 def _my_nside2npix(nside):
     if nside:
         return hp.nside2npix(nside)
@@ -829,6 +1413,68 @@ def _my_nside2npix(nside):
         return 1
 
 
+def _healpix_patch_ids(nside, data_nside, pixels=None):
+    """ Patch of each pixel of a map with *data_nside*
+
+    The patches are the pixels of a map with *nside* (RING ordering, like the
+    data). The result is equal to
+    ``hp.ud_grade(np.arange(hp.nside2npix(nside)), data_nside)``, but it is
+    computed with the arithmetic of the NESTED ordering: the parent of a
+    NESTED pixel is obtained by integer division.
+    ``nside = 0`` means a single patch.
+    If *pixels* is provided, only their patches are computed.
+    """
+    if pixels is None:
+        pixels = np.arange(hp.nside2npix(data_nside))
+    if nside == 0:
+        return np.zeros(len(pixels), dtype=int)
+    if nside > data_nside:
+        raise ValueError("The nside of the patches (%i) is higher than the one "
+                         "of the data (%i)" % (nside, data_nside))
+    nest_ids = hp.ring2nest(data_nside, pixels)
+    return hp.nest2ring(nside, nest_ids // (data_nside // nside)**2)
+
+
+_PATCH_INDEX_CACHE = OrderedDict()
+_PATCH_INDEX_CACHE_SIZE = 8
+
+
+def _healpix_patch_index(nside, data_nside, good=None, pixels=None):
+    """ Cached :class:`PatchIndex` of :func:`_healpix_patch_ids`
+
+    If *pixels* is provided, only they are indexed (see
+    :func:`_healpix_patch_ids`). If *good* (boolean, one entry for each of
+    the pixels) is provided, only its true entries are indexed, in the same
+    order as ``patch_ids[good]``.
+    The least recently used indices are dropped from the cache when it holds
+    more than ``_PATCH_INDEX_CACHE_SIZE`` of them.
+    """
+    if good is None:
+        key = (nside, data_nside, None)
+    else:
+        good_hash = hashlib.sha1(np.packbits(good)).hexdigest()
+        key = (nside, data_nside, good.size, good_hash)
+    if pixels is not None:
+        pixels = np.ascontiguousarray(pixels)
+        key += (pixels.size, hashlib.sha1(pixels).hexdigest())
+
+    try:
+        _PATCH_INDEX_CACHE.move_to_end(key)
+        return _PATCH_INDEX_CACHE[key]
+    except KeyError:
+        pass
+
+    patch_ids = _healpix_patch_ids(nside, data_nside, pixels)
+    if good is not None:
+        patch_ids = patch_ids[good]
+    patch_index = alg.PatchIndex(patch_ids)
+
+    _PATCH_INDEX_CACHE[key] = patch_index
+    if len(_PATCH_INDEX_CACHE) > _PATCH_INDEX_CACHE_SIZE:
+        _PATCH_INDEX_CACHE.popitem(last=False)
+    return patch_index
+
+
 def _my_ud_grade(map_in, nside_out, **kwargs):
     # As healpy.ud_grade, but it accepts map_in of nside = 0 and nside_out = 0,
     # which in this module means a single float or lenght-1 array
@@ -857,11 +1503,43 @@ def _my_ud_grade(map_in, nside_out, **kwargs):
         return hp.ud_grade(map_in, nside_out, **kwargs)
 
 
-def _intersect_mask(maps):
+def _masked_entries(maps):
     if hp.pixelfunc.is_ma(maps):
-        mask = maps.mask
-    else:
-        mask = maps == hp.UNSEEN
+        return np.ma.getmaskarray(maps)
+    return maps == hp.UNSEEN
 
+
+def _intersect_mask(maps):
     # Mask entire pixel if any of the frequencies in the pixel is masked
-    return np.any(mask, axis=tuple(range(maps.ndim-1)))
+    return np.any(_masked_entries(maps), axis=tuple(range(maps.ndim-1)))
+
+
+def _footprint_values(maps, footprint):
+    # Values of maps in the pixels of footprint (PartialMaps). maps can be
+    # PartialMaps with the same pixels, full-sky maps or anything broadcastable
+    # to the values of footprint
+    if isinstance(maps, PartialMaps):
+        if not footprint.same_footprint(maps):
+            raise ValueError("The partial maps do not have the same pixels")
+        return maps.values
+    if np.ndim(maps) and np.shape(maps)[-1] == hp.nside2npix(footprint.nside):
+        return maps[..., footprint.pixels]
+    return maps
+
+
+def _to_footprint(res, footprint, names):
+    # Turn the maps in res[name] into PartialMaps on the pixels of footprint
+    for name in names:
+        if name not in res:
+            continue
+        if name == 'chi_dB':
+            res.chi_dB = [footprint.with_values(c) for c in res.chi_dB]
+        else:
+            res[name] = footprint.with_values(res[name])
+
+
+def _append_missing_patches(par_array, nside):
+    # Pad with NaN the patches missing at the end of par_array
+    missing_ids = hp.nside2npix(nside) - par_array.shape[0]
+    extra_dims = np.full((missing_ids,) + par_array.shape[1:], np.nan)
+    return np.concatenate((par_array, extra_dims))
@@ -1,14 +1,19 @@
 #!/usr/bin/env python
+import io
+import os
+import tempfile
+from contextlib import contextmanager, redirect_stdout
 import unittest
 import numpy as np
 from numpy.random import uniform
 from numpy.testing import assert_array_almost_equal as aaae
 from numpy.testing import assert_allclose as aac
 import fgbuster.component_model as cm
+import fgbuster.algebra as alg
 from fgbuster.mixingmatrix import MixingMatrix
 from fgbuster.algebra import (W, Wd, invAtNA, W_dB, W_dBdB, _mv, _mtm, _mm, _T,
-                              _mmm, D, comp_sep, multi_comp_sep, _mtmm, P,
-                              P_dBdB)
+                              _mtv, _mmm, D, comp_sep, multi_comp_sep, _mtmm, P,
+                              P_dBdB, PatchIndex)
 
 class TestAlgebraRandom(unittest.TestCase):
 
@@ -67,6 +72,15 @@ class TestAlgebraRandom(unittest.TestCase):
         res = np.linalg.inv(_mtm(self.A, _mm(self.invN, self.A)))
         aaae(res, invAtNA(self.A, self.invN))
 
+    def test_broadcast_invN(self):
+        invN = np.broadcast_to(self.invN[:1, :1], self.invN.shape)
+        L = alg._cholesky_invN(invN)
+        self.assertEqual(L.shape, (1, 1, self.n_freq, self.n_freq))
+        aaae(L[0, 0], np.linalg.cholesky(self.invN[0, 0]))
+        res = comp_sep(self.A, self.d, invN, None, None)
+        aaae(self.s, res.s)
+        aaae(res.invAtNA[0, 0], invAtNA(self.A, self.invN[0, 0]))
+
     def test_Wd_is_s(self):
         aaae(self.s, Wd(self.A, self.d))
 
@@ -77,6 +91,22 @@ class TestAlgebraRandom(unittest.TestCase):
         res = comp_sep(self.A, self.d, None, None, None)
         aaae(self.s, res.s)
 
+    def test_comp_sep_float32(self):
+        res = comp_sep(self.A, self.d.astype(np.float32), self.invN,
+                       None, None)
+        self.assertEqual(res.s.dtype, np.float32)
+        self.assertEqual(res.chi.dtype, np.float32)
+        self.assertEqual(res.invAtNA.dtype, np.float64)
+        aaae(self.s, res.s, 5)
+
+    def test_comp_sep_outputs(self):
+        res = comp_sep(self.A, self.d, None, None, None, outputs=['s'])
+        aaae(self.s, res.s)
+        self.assertNotIn('chi', res)
+        self.assertNotIn('invAtNA', res)
+        with self.assertRaises(ValueError):
+            comp_sep(self.A, self.d, None, None, None, outputs='sigma')
+
     def test_multi_comp_sep_no_par(self):
         patch_ids = np.arange(self.d.shape[0]) // 2
         np.random.shuffle(patch_ids)
@@ -84,6 +114,620 @@ class TestAlgebraRandom(unittest.TestCase):
         aaae(self.s, res.s)
 
 
+    def test_multi_comp_sep_patch_index(self):
+        patch_ids = np.arange(self.d.shape[0]) // 2
+        np.random.shuffle(patch_ids)
+        res = multi_comp_sep(self.A, self.d, self.invN, None, None,
+                             PatchIndex(patch_ids))
+        res_ids = multi_comp_sep(self.A, self.d, self.invN, None, None,
+                                 patch_ids)
+        aaae(self.s, res.s)
+        aaae(res_ids.invAtNA, res.invAtNA)
+
+    def test_multi_comp_sep_compact_invN(self):
+        patch_ids = np.arange(self.d.shape[0]) // 2
+        np.random.shuffle(patch_ids)
+        invN = self.invN[0, 0]
+        ref = multi_comp_sep(self.A, self.d,
+                             np.broadcast_to(invN, self.invN.shape),
+                             None, None, patch_ids)
+        for compact_invN in [invN, invN[np.newaxis],
+                             np.broadcast_to(invN, self.invN.shape[1:])]:
+            res = multi_comp_sep(self.A, self.d, compact_invN, None, None,
+                                 patch_ids)
+            aaae(self.s, res.s)
+            aaae(ref.invAtNA, res.invAtNA)
+
+
+class TestStackA_dB(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        n_pix, n_stokes, n_freq, n_comp = 10, 2, 6, 3
+        self.A = uniform(size=(n_freq, n_comp))
+        self.s = uniform(size=(n_pix, n_stokes, n_comp))
+        self.d = _mv(self.A, self.s) + uniform(size=(n_pix, n_stokes, n_freq))
+        self.invN = np.diag(uniform(1., 2., size=n_freq))
+        # Different number of columns for each parameter, pixel-dependent
+        # derivatives and not
+        self.comp_of_dB = [(np.s_[1:],), (2,), (np.s_[:],)]
+        self.A_dB = [uniform(size=(n_pix, 1, n_freq, 2)),
+                     uniform(size=(n_freq, 1)),
+                     uniform(size=(n_stokes, n_freq, n_comp))]
+        # Reference: derivatives with respect to all the columns of A
+        self.A_dB_full = []
+        for A_dB_i, (c_i,) in zip(self.A_dB, self.comp_of_dB):
+            shape = np.broadcast_shapes(A_dB_i.shape[:-2],
+                                        (n_pix, n_stokes))
+            A_dB_full_i = np.zeros(shape + (n_freq, n_comp))
+            A_dB_full_i[..., np.atleast_1d(np.arange(n_comp)[c_i])] = A_dB_i
+            self.A_dB_full.append(A_dB_full_i)
+
+    def test_stack(self):
+        comp_of_dB = alg._A_dB_and_comp_of_dB_as_compatible_list(
+            self.A_dB, self.comp_of_dB)[1]
+        A_dB, cols = alg._stack_A_dB(self.A_dB, comp_of_dB, 3)
+        self.assertEqual(A_dB.shape, (3, 10, 2, 6, 3))
+        aac(cols, [[1, 2, 0], [2, 0, 0], [0, 1, 2]])
+        for A_dB_i, cols_i, A_dB_full_i in zip(A_dB, cols, self.A_dB_full):
+            k_i = len(set(cols_i.tolist()))
+            aac(A_dB_i[..., k_i:], 0.)  # Padding
+            aac(A_dB_i[..., :k_i], A_dB_full_i[..., cols_i[:k_i]])
+
+    def test_W_dB(self):
+        res = W_dB(self.A, self.A_dB, self.comp_of_dB, self.invN)
+        for res_i, A_dB_full_i in zip(res, self.A_dB_full):
+            aac(res_i, W_dB(self.A, A_dB_full_i, np.s_[:], self.invN)[0])
+
+    def test_logL_dB(self):
+        res = alg.logL_dB(self.A, self.d, self.invN, self.A_dB,
+                          self.comp_of_dB)
+        for res_i, A_dB_full_i in zip(res, self.A_dB_full):
+            aac(res_i, alg.logL_dB(self.A, self.d, self.invN, A_dB_full_i))
+
+    def test_fisher(self):
+        res = alg.fisher_logL_dB_dB(self.A, self.s, self.A_dB,
+                                    self.comp_of_dB, self.invN)
+        # D A_dB s, prewhitened, for each parameter
+        L = np.linalg.cholesky(self.invN)
+        pw_A = _mtm(L, self.A)
+        D_pw = np.eye(6) - _mmm(pw_A, np.linalg.inv(_mtm(pw_A, pw_A)), pw_A.T)
+        D_A_dB_s = [_mv(D_pw, _mtv(L, _mv(A_dB_full_i, self.s))).ravel()
+                    for A_dB_full_i in self.A_dB_full]
+        aac(res, np.dot(D_A_dB_s, np.transpose(D_A_dB_s)))
+
+
+class TestPatchIndex(unittest.TestCase):
+
+    def test_indexing(self):
+        np.random.seed(0)
+        for shape in [(20,), (4, 5)]:
+            patch_ids = np.random.randint(0, 7, size=shape)
+            patch_ids[patch_ids == 3] = 4  # Empty patch
+            patch_index = PatchIndex(patch_ids)
+            self.assertEqual(len(patch_index), patch_ids.max() + 1)
+            array = np.random.normal(size=shape+(3,))
+            for i in range(len(patch_index)):
+                aaae(array[patch_index.indexing(i)], array[patch_ids == i])
+                self.assertEqual(patch_index.is_empty(i),
+                                 not np.any(patch_ids == i))
+            aaae(patch_index.patch_ids(), patch_ids)
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.m = uniform(size=(10, 1, 6, 4))
+        self.w = uniform(size=(3, 4, 4))
+        self.n = uniform(size=(10, 3, 4, 5))
+        self.v = uniform(size=(10, 3, 4))
+        self.u = uniform(size=(10, 1, 6))
+        self.dispatch = alg.DISPATCH
+
+    def tearDown(self):
+        alg.DISPATCH = self.dispatch
+
+    def _products(self):
+        return [alg._mv(self.m, self.v),
+                alg._mtv(self.m, self.u),
+                alg._mm(self.m, self.w),
+                alg._mtm(self.m, self.m),
+                alg._mm(self.m, np.ones((1, 1))),  # Matrix dims broadcasting
+                alg._utmv(self.u, self.m, self.v),
+                alg._mmv(self.m, self.w, self.v),
+                alg._mtmv(self.m, self.m, self.v),
+                alg._mmm(self.m, self.w, self.n),
+                alg._mmm(self.m, np.ones((1, 1)), self.n[..., :1, :]),
+                alg._mtmm(self.m, self.m, self.n)]
+
+    def test_dispatch_matches_einsum(self):
+        alg.DISPATCH = False
+        ref = self._products()
+        alg.DISPATCH = True
+        for _ in range(2):  # The second time the cached paths are used
+            for res, res_ref in zip(self._products(), ref):
+                aac(res, res_ref)
+
+
+class _RecordingNumpy(object):
+    """ numpy namespace that records the functions that are called """
+
+    def __init__(self, module=np, calls=None):
+        self._module = module
+        self.calls = set() if calls is None else calls
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        if name == 'linalg':
+            return _RecordingNumpy(attr, self.calls)
+        if callable(attr) and not isinstance(attr, type):
+            self.calls.add(name)
+        return attr
+
+
+class _ImmutableNumpy(object):
+    """ numpy namespace with JAX-like semantics
+
+    The arrays returned are read-only and a failed Cholesky factorization
+    returns NaN instead of raising.
+    """
+
+    def __init__(self, module=np):
+        self._module = module
+
+    def __getattr__(self, name):
+        attr = getattr(self._module, name)
+        if name == 'linalg':
+            return _ImmutableNumpy(attr)
+        if name == 'cholesky':
+            return self._cholesky
+        if callable(attr) and not isinstance(attr, type):
+            return lambda *args, **kwargs: _read_only(attr(*args, **kwargs))
+        return attr
+
+    def _cholesky(self, a):
+        try:
+            return _read_only(np.linalg.cholesky(a))
+        except np.linalg.LinAlgError:
+            return _read_only(np.full(np.shape(a), np.nan))
+
+
+def _read_only(res):
+    if isinstance(res, np.ndarray):
+        res = res.view()
+        res.flags.writeable = False
+    elif isinstance(res, tuple):
+        res = type(res)(*[_read_only(r) for r in res])
+    return res
+
+
+class _ThreeComponentCase(unittest.TestCase):
+    """ CMB, dust and synchrotron in 20 pixels, six frequencies, white noise """
+
+    def setUp(self):
+        np.random.seed(0)
+        self.mm = MixingMatrix(cm.CMB(), cm.Dust(150.), cm.Synchrotron(150.))
+        self.freqs = np.array([30., 70., 100., 150., 220., 340.])
+        self.x = np.array([1.5, 20., -3.])
+        A = self.mm.eval(self.freqs, *self.x)
+        self.d = _mv(A, np.random.normal(size=(20, 3)))
+        self.d += np.random.normal(size=self.d.shape)
+        self.invN = np.diag(uniform(1., 2., size=len(self.freqs)))
+
+    def _comp_sep(self, **kwargs):
+        return comp_sep(self.mm.evaluator(self.freqs), self.d, self.invN,
+                        self.mm.diff_evaluator(self.freqs), self.mm.comp_of_dB,
+                        self.x, **kwargs)
+
+
+class _PartialCoverageCase(unittest.TestCase):
+    """ Two Stokes parameters of 200 pixels at eight frequencies. The first
+    two frequencies are missing in half of the pixels
+    """
+
+    def setUp(self):
+        np.random.seed(0)
+        self.mm = MixingMatrix(cm.CMB(), cm.Dust(150., temp=20.),
+                               cm.Synchrotron(150.))
+        self.freqs = np.array([30., 40., 70., 100., 150., 220., 280., 340.])
+        self.x = np.array([1.5, -3.])
+        n_pix = 200
+        A = self.mm.eval(self.freqs, *self.x)
+        s = np.random.normal(size=(n_pix, 2, 3)) * [1., 10., 10.]
+        self.d = _mv(A, s) + np.random.normal(size=(n_pix, 2, 8))
+        # Transposed, as built by weighted_comp_sep
+        invN = np.diag(uniform(1., 2., size=8))[..., np.newaxis, np.newaxis]
+        self.invN = np.array(np.broadcast_to(invN, (8, 8, 2, n_pix))).T
+        # The first two frequencies are not observed in half of the pixels
+        self.invN[:n_pix // 2, :, :2] = 0.
+        self.invN[:n_pix // 2, :, :, :2] = 0.
+        self.d[:n_pix // 2, :, :2] = -1.6375e30
+
+
+class TestArrayBackend(_ThreeComponentCase):
+
+    def tearDown(self):
+        alg.set_array_backend()
+
+    def _run(self):
+        A = self.mm.eval(self.freqs, *self.x)
+        A_dB = self.mm.diff(self.freqs, *self.x)
+        A_dBdB = self.mm.diff_diff(self.freqs, *self.x)
+        res = comp_sep(self.mm.evaluator(self.freqs), self.d, self.invN,
+                       self.mm.diff_evaluator(self.freqs), self.mm.comp_of_dB,
+                       self.x)
+        return [res.x, res.s, res.Sigma,
+                alg.logL(A, self.d, self.invN),
+                alg.logL_dB(A, self.d, self.invN, A_dB, self.mm.comp_of_dB),
+                W_dB(A, A_dB, self.mm.comp_of_dB, self.invN),
+                W_dBdB(A, A_dB, A_dBdB, self.mm.comp_of_dB, self.invN)]
+
+    def test_namespace(self):
+        ref = self._run()
+        namespace = _RecordingNumpy()
+        self.assertIs(alg.set_array_backend(namespace), np)
+        res = self._run()
+        self.assertIs(alg.set_array_backend(), namespace)
+        for name in ['svd', 'cholesky', 'einsum']:
+            self.assertIn(name, namespace.calls)
+        for r, r_ref in zip(res, ref):
+            aac(r, r_ref)
+
+
+class TestProfiler(_ThreeComponentCase):
+
+    def test_profile(self):
+        ref = self._comp_sep()
+        records = []
+        profiler = alg.Profiler(callback=records.append)
+        res = self._comp_sep(profiler=profiler)
+        aac(res.x, ref.x)
+        aac(res.Sigma, ref.Sigma)
+        self.assertEqual(res.profile['n_iter'], res.nit)
+        self.assertEqual(records, profiler.records)
+        for stage in ['sed', 'sed_dB', 'prewhiten', 'svd', 'logL', 'logL_dB',
+                      'maps', 'fisher']:
+            self.assertGreater(res.profile['counts'][stage], 0)
+            self.assertGreaterEqual(res.profile['times'][stage], 0.)
+        self.assertEqual(res.profile['counts']['logL'], res.nfev)
+        self.assertEqual(res.profile['counts']['logL_dB'], res.njev)
+        self.assertEqual([r['iteration'] for r in records],
+                         list(range(1, res.nit + 1)))
+        aac(records[-1]['x'], res.x)
+
+    def test_user_callback(self):
+        iterates = []
+        profiler = alg.Profiler()
+        res = self._comp_sep(profiler=profiler, method='Nelder-Mead',
+                             callback=iterates.append)
+        self.assertEqual(len(iterates), res.nit)
+        self.assertEqual(len(profiler.records), res.nit)
+
+    def test_verbose_callback(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            res = self._comp_sep(callback=alg.verbose_callback())
+        self.assertNotIn('profile', res)
+        self.assertEqual(len(output.getvalue().splitlines()), res.nit)
+
+    def test_disp(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            res = self._comp_sep(options=dict(disp=True))
+        self.assertNotIn('profile', res)
+        self.assertIn('First -logL', output.getvalue())
+
+    def test_user_callback_intermediate_result(self):
+        funs = []
+        def callback(intermediate_result):
+            funs.append(intermediate_result.fun)
+        profiler = alg.Profiler()
+        res = self._comp_sep(profiler=profiler, callback=callback)
+        self.assertEqual(len(funs), res.nit)
+        self.assertEqual(len(profiler.records), res.nit)
+        aac(profiler.records[-1]['x'], res.x)
+        aac(funs[-1], res.fun)
+
+    def test_fixed_A(self):
+        # The Cholesky factorization of invN is timed as prewhitening
+        profiler = alg.Profiler()
+        open_stages = []
+        cholesky_stages = []
+        profiler_stage = profiler.stage
+        cholesky_invN = alg._cholesky_invN
+
+        @contextmanager
+        def stage(name):
+            open_stages.append(name)
+            with profiler_stage(name):
+                yield
+            open_stages.pop()
+
+        def recording_cholesky_invN(invN):
+            cholesky_stages.append(list(open_stages))
+            return cholesky_invN(invN)
+
+        profiler.stage = stage
+        alg._cholesky_invN = recording_cholesky_invN
+        try:
+            A = self.mm.eval(self.freqs, *self.x)
+            ref = comp_sep(A, self.d, self.invN, None, None)
+            res = comp_sep(A, self.d, self.invN, None, None,
+                           profiler=profiler)
+        finally:
+            alg._cholesky_invN = cholesky_invN
+        aac(res.s, ref.s)
+        self.assertEqual(cholesky_stages, [[], ['prewhiten']])
+        self.assertEqual(res.profile['counts'],
+                         {'prewhiten': 1, 'svd': 1, 'maps': 1})
+
+
+class TestIncremental(_ThreeComponentCase):
+
+    def test_logL(self):
+        A_ev = self.mm.evaluator(self.freqs)
+        columns_of_x = alg._columns_of_x(self.mm.comp_of_dB, len(self.x))
+        ref = alg._build_bound_inv_logL_and_logL_dB(A_ev, self.d, self.invN)[0]
+        fun = alg._build_bound_inv_logL_and_logL_dB(
+            A_ev, self.d, self.invN, columns_of_x=columns_of_x)[0]
+        for dx in [[0., 0., 0.], [0.1, 0., 0.], [0., 0., 0.1], [0.1, 1., 0.],
+                   [0.1, 1., 0.1]]:
+            x = self.x + np.array(dx)
+            aac(fun(x), ref(x), rtol=1e-10)
+
+    def test_comp_sep(self):
+        ref = self._comp_sep(method='Powell')
+        profiler = alg.Profiler()
+        res = self._comp_sep(method='Powell', incremental=True,
+                             profiler=profiler)
+        aac(res.x, ref.x, rtol=1e-5)
+        aac(res.s, ref.s, rtol=1e-5)
+        aac(res.Sigma, ref.Sigma, rtol=1e-4)
+        self.assertLess(profiler.summary()['counts']['sed_dB'], ref.nfev)
+
+
+class TestCoverage(_PartialCoverageCase):
+
+    def test_cholesky(self):
+        L = alg._cholesky_invN(self.invN)
+        aac(_mm(L, _T(L)), self.invN)
+        aac(L[0, 0, 2:, 2:], np.linalg.cholesky(self.invN[0, 0, 2:, 2:]))
+
+    def test_immutable_backend(self):
+        # Partial coverage does not rely on in-place assignments or LinAlgError
+        invN = self.invN.copy()
+        invN[:10] = 0.  # Not observed at all
+        invN[10:20, :, -1] = invN[10:20, :, :, -1] = 0.  # Another pattern
+        ref = alg._cholesky_invN(invN)
+        ref_res = comp_sep(self.mm.evaluator(self.freqs), self.d, invN,
+                           self.mm.diff_evaluator(self.freqs),
+                           self.mm.comp_of_dB, self.x)
+        alg.set_array_backend(_ImmutableNumpy())
+        try:
+            L = alg._cholesky_invN(invN)
+            res = comp_sep(self.mm.evaluator(self.freqs), self.d, invN,
+                           self.mm.diff_evaluator(self.freqs),
+                           self.mm.comp_of_dB, self.x)
+        finally:
+            alg.set_array_backend()
+        aac(L, ref)
+        aac(_mm(L, _T(L)), invN)
+        aac(res.x, ref_res.x)
+        aac(res.s, ref_res.s)
+
+    def test_comp_sep(self):
+        A_ev = self.mm.evaluator(self.freqs)
+        A_dB_ev = self.mm.diff_evaluator(self.freqs)
+        shape = self.invN.shape[:2]
+        # Pixel-dependent mixing matrix: the pixels are not grouped
+        A_ev_pix = lambda x: np.broadcast_to(A_ev(x), shape + (8, 3))
+        A_dB_ev_pix = lambda x: [np.broadcast_to(A_dB, shape + A_dB.shape)
+                                 for A_dB in A_dB_ev(x)]
+        self.assertIsNotNone(alg._group_by_coverage(self.d, self.invN))
+        res = comp_sep(A_ev, self.d, self.invN, A_dB_ev, self.mm.comp_of_dB,
+                       self.x, group_by_coverage=True)
+        ref = comp_sep(A_ev_pix, self.d, self.invN, A_dB_ev_pix,
+                       self.mm.comp_of_dB, self.x, group_by_coverage=True)
+        ref_default = comp_sep(A_ev, self.d, self.invN, A_dB_ev,
+                               self.mm.comp_of_dB, self.x)
+        for r in [ref, ref_default]:
+            aac(res.x, r.x, rtol=1e-6)
+            aac(res.fun, r.fun)
+            aac(res.Sigma, r.Sigma, rtol=1e-6)
+            aac(res.s, r.s, rtol=1e-6, atol=1e-8)
+
+    def test_profile_sed(self):
+        # Every evaluation of the mixing matrix is counted
+        A_ev = self.mm.evaluator(self.freqs)
+        n_eval = [0]
+        def counting_A_ev(x):
+            n_eval[0] += 1
+            return A_ev(x)
+        profiler = alg.Profiler()
+        res = comp_sep(counting_A_ev, self.d, self.invN,
+                       self.mm.diff_evaluator(self.freqs), self.mm.comp_of_dB,
+                       self.x, profiler=profiler, group_by_coverage=True)
+        self.assertEqual(res.profile['counts']['sed'], n_eval[0])
+
+
+class TestLogLGrid(_PartialCoverageCase):
+
+    def _ref(self, invN, x_grid):
+        return np.array([-alg.logL(self.mm.eval(self.freqs, *x), self.d, invN)
+                         for x in x_grid.reshape(-1, 2)]
+                        ).reshape(x_grid.shape[:-1])
+
+    def test_logL_grid(self):
+        A_ev = self.mm.evaluator(self.freqs, unpack=lambda x: x.T)
+        x_grid = np.stack(np.meshgrid(np.linspace(1.4, 1.6, 5),
+                                      np.linspace(-3.1, -2.9, 4),
+                                      indexing='ij'), -1)
+        for invN in [self.invN, self.invN * uniform(1., 2., (200, 1, 1, 1))]:
+            res, x_best = alg.logL_grid(A_ev, self.d, invN, x_grid,
+                                        batch_size=3)
+            ref = self._ref(invN, x_grid)
+            self.assertEqual(res.shape, (5, 4))
+            aac(res, ref)
+            aac(x_best, x_grid.reshape(-1, 2)[np.argmin(ref)])
+
+        self.d = self.d[100:]  # Fully observed pixels
+        res = alg.logL_grid(A_ev, self.d, self.invN[0, 0], x_grid)[0]
+        aac(res, self._ref(self.invN[0, 0], x_grid))
+        res = alg.logL_grid(A_ev, self.d, None, x_grid)[0]
+        aac(res, self._ref(None, x_grid))
+
+    def test_float32(self):
+        # The likelihood of single precision data is computed in double
+        A_ev = self.mm.evaluator(self.freqs, unpack=lambda x: x.T)
+        x_grid = np.stack(np.meshgrid(np.linspace(1.4, 1.6, 3),
+                                      np.linspace(-3.1, -2.9, 3),
+                                      indexing='ij'), -1)
+        self.d = self.d[100:].astype(np.float32)
+        res = alg.logL_grid(A_ev, self.d, self.invN[0, 0], x_grid)[0]
+        self.d = self.d.astype(np.float64)
+        aac(res, self._ref(self.invN[0, 0], x_grid), rtol=1e-10)
+        compressed_d = alg._compress_pixels(self.d.astype(np.float32))
+        self.assertEqual(compressed_d.dtype, np.float64)
+
+
+class TestSampleLogL(_PartialCoverageCase):
+
+    def setUp(self):
+        super().setUp()
+        self.d = self.d[100:]
+        self.invN = self.invN[0, 0]
+        self.A_ev = self.mm.evaluator(self.freqs, unpack=lambda x: x.T)
+        self.res = comp_sep(self.mm.evaluator(self.freqs), self.d, self.invN,
+                            self.mm.diff_evaluator(self.freqs),
+                            self.mm.comp_of_dB, self.x)
+
+    def test_posterior(self):
+        res = alg.sample_logL(self.A_ev, self.d, self.invN, self.res.x, 1000,
+                              Sigma=self.res.Sigma, rng=0)
+        self.assertEqual(res.chain.shape, (1000, 8, 2))
+        self.assertTrue(np.all(res.acceptance_fraction > 0.2))
+        ref = alg.logL_grid(self.A_ev, self.d, self.invN, res.chain[-1])[0]
+        aac(res.inv_logL[-1], ref)
+        samples = res.chain[200:].reshape(-1, 2)
+        sigma = self.res.Sigma.diagonal()**0.5
+        aac((samples.mean(0) - self.res.x) / sigma, 0., atol=0.5)
+        aac(samples.std(0), sigma, rtol=0.2)
+
+    def test_prior(self):
+        bound = self.res.x[0]
+        log_prior = lambda x: np.where(x[:, 0] < bound, 0., -np.inf)
+        walkers = self.res.x - uniform(0., 1e-3, (10, 2))
+        res = alg.sample_logL(self.A_ev, self.d, self.invN, walkers, 200,
+                              log_prior=log_prior, rng=0)
+        self.assertTrue(np.all(res.chain[..., 0] < bound))
+        with self.assertRaises(ValueError):
+            alg.sample_logL(self.A_ev, self.d, self.invN, walkers[:3], 10)
+
+    def test_rng(self):
+        state = np.random.get_state()
+        res = [alg.sample_logL(self.A_ev, self.d, self.invN, self.res.x, 20,
+                               rng=np.random.default_rng(1))
+               for _ in range(2)]
+        self.assertEqual(np.random.get_state()[1].tolist(), state[1].tolist())
+        aac(res[0].chain, res[1].chain)
+        other = alg.sample_logL(self.A_ev, self.d, self.invN, self.res.x, 20,
+                                rng=2)
+        self.assertFalse(np.allclose(other.chain, res[0].chain))
+
+
+class TestCheckpoint(_ThreeComponentCase):
+
+    def test_multi_comp_sep(self):
+        patch_ids = np.arange(len(self.d)) % 3
+        A_ev = self.mm.evaluator(self.freqs)
+        args = (self.invN, self.mm.diff_evaluator(self.freqs),
+                self.mm.comp_of_dB, patch_ids, self.x)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = alg.Checkpoint(directory)
+            res = multi_comp_sep(A_ev, self.d, *args, checkpoint=checkpoint)
+            for patch_id in range(3):
+                self.assertIsNotNone(checkpoint.load('patch_%i' % patch_id))
+
+            def A_ev_fail(x):
+                raise AssertionError('The patches should not be fitted')
+
+            res_resumed = multi_comp_sep(A_ev_fail, self.d, *args,
+                                         checkpoint=checkpoint)
+            checkpoint.clear()
+            self.assertIsNone(checkpoint.load('patch_0'))
+        aac(res_resumed.x, res.x)
+        aac(res_resumed.Sigma, res.Sigma)
+        aac(res_resumed.s, res.s)
+
+    def test_failed_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = alg.Checkpoint(directory)
+            checkpoint.store('x', self.x)
+            with self.assertRaises(Exception):
+                checkpoint.store('x', lambda: None)  # Not picklable
+            self.assertEqual(os.listdir(directory), ['x.pkl'])
+            aac(checkpoint.load('x'), self.x)
+
+
+class TestPatchResults(_ThreeComponentCase):
+
+    def _multi_comp_sep(self, d, invN, patch_ids):
+        return multi_comp_sep(self.mm.evaluator(self.freqs), d, invN,
+                              self.mm.diff_evaluator(self.freqs),
+                              self.mm.comp_of_dB, patch_ids, self.x)
+
+    def test_columns(self):
+        patch_ids = np.arange(len(self.d)) % 4
+        patch_ids[patch_ids == 2] = 1  # Empty patch
+        res = self._multi_comp_sep(self.d, self.invN, patch_ids)
+        self.assertIsInstance(res.patch_res, alg.PatchResults)
+        self.assertEqual(len(res.patch_res), 4)
+        self.assertIsNone(res.patch_res[2])
+        self.assertTrue(np.all(np.isnan(res.x[2])))
+        self.assertFalse(res.patch_res.success[2])
+        for patch_id in [0, 1, 3]:
+            ref = comp_sep(self.mm.evaluator(self.freqs),
+                           self.d[patch_ids == patch_id], self.invN,
+                           self.mm.diff_evaluator(self.freqs),
+                           self.mm.comp_of_dB, self.x)
+            patch_res = res.patch_res[patch_id]
+            for name in alg.PatchResults.COLUMNS:
+                if name == 'message':
+                    self.assertEqual(patch_res[name], ref[name])
+                    continue
+                aac(getattr(res.patch_res, name)[patch_id], ref[name])
+                aac(patch_res[name], ref[name])
+            aac(res.s[patch_ids == patch_id], ref.s)
+            aac(res.chi_dB[0][patch_ids == patch_id], ref.chi_dB[0])
+        self.assertEqual(len([r for r in res.patch_res if r is not None]), 3)
+
+    def test_shared_invAtNA(self):
+        d = np.stack([self.d, 2 * self.d], 1)  # Extra dimension
+        patch_ids = np.arange(len(d)) % 3
+        res = self._multi_comp_sep(d, self.invN, patch_ids)
+        self.assertIn('invAtNA', res.patch_res.shared)
+        self.assertEqual(res.patch_res.shared['invAtNA'].shape, (3, 3, 3))
+        self.assertIn('invAtNA', res.keys())
+        self.assertIs(res.get('invAtNA'), res.invAtNA)
+        # Broadcast view: nothing is copied along the extra dimension
+        self.assertFalse(res.invAtNA.flags.writeable)
+        self.assertEqual(res.invAtNA.strides[1], 0)
+        self.assertEqual(res.invAtNA.shape, (len(d), 2, 3, 3))
+        for patch_id in range(3):
+            aac(res.invAtNA[patch_ids == patch_id],
+                np.broadcast_to(res.patch_res[patch_id].invAtNA,
+                                (np.sum(patch_ids == patch_id), 2, 3, 3)))
+
+    def test_not_shared_invAtNA(self):
+        invN = self.invN * uniform(1., 2., size=(len(self.d), 1, 1))
+        patch_ids = np.arange(len(self.d)) % 3
+        res = self._multi_comp_sep(self.d, invN, patch_ids)
+        self.assertNotIn('invAtNA', res.patch_res.shared)
+        self.assertEqual(res.invAtNA.shape, (len(self.d), 3, 3))
+        A = self.mm.eval(self.freqs, *res.x[patch_ids].T)
+        aac(res.invAtNA, invAtNA(A, invN))
+
 
 class TestAlgebraPhysical(unittest.TestCase):
 
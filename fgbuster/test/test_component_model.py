@@ -4,7 +4,9 @@ from itertools import product
 from parameterized import parameterized
 import scipy
 import numpy as np
-from fgbuster.component_model import AnalyticComponent, Dust
+from fgbuster.component_model import (AnalyticComponent, AutodiffComponent,
+                                      InterpolatedComponent, Dust, H_OVER_K)
+from fgbuster.mixingmatrix import MixingMatrix
 from fgbuster.observation_helpers import get_sky, get_instrument, _jysr2rj
 import pysm3
 import pysm3.units as u
@@ -30,17 +32,14 @@ class TestModifiedBlackBody(unittest.TestCase):
             x, self.dust.eval(self.freqs))
 
 
-class TestAnalyticComponent(unittest.TestCase):
-    
+class _TwoParamComponentCase(unittest.TestCase):
+    """ Reference SED nu * param0 + nu**param1 + 100 and its inputs """
+
     funcs = ['eval', 'diff']
     vals = ['float', 'scal', 'vec', 'vecbcast']
     bands = ['centers', 'bandpass']
     tags = ['__'.join(args) for args in product(funcs, vals, vals, bands)]
 
-    def setUp(self):
-        self.analitic_expr = 'nu * param0 + nu**param1 + hundred'
-        self.comp = AnalyticComponent(self.analitic_expr, hundred=100)
-
     def hard_eval(self, nu, param0, param1):
         param0 = self._add_dim_if_ndarray(param0)
         param1 = self._add_dim_if_ndarray(param1)
@@ -112,7 +111,14 @@ class TestAnalyticComponent(unittest.TestCase):
             return np.linspace(1.5, 2., 5)[:, np.newaxis, np.newaxis]
         raise ValueError(tag)
 
-    @parameterized.expand(tags)
+
+class TestAnalyticComponent(_TwoParamComponentCase):
+
+    def setUp(self):
+        self.analitic_expr = 'nu * param0 + nu**param1 + hundred'
+        self.comp = AnalyticComponent(self.analitic_expr, hundred=100)
+
+    @parameterized.expand(_TwoParamComponentCase.tags)
     def test(self, tag):
         func, val0, val1, nu_type = tag.split('__')
         param0 = self._get_param0(val0)
@@ -147,5 +153,138 @@ class TestAnalyticComponent(unittest.TestCase):
         np.testing.assert_allclose(pysm_map, fgb_map, rtol=1e-6)
 
 
+class TestAutodiffComponent(_TwoParamComponentCase):
+    # Same checks of TestAnalyticComponent, derivatives computed automatically
+
+    def setUp(self):
+        self.comp = AutodiffComponent(
+            lambda nu, param0, param1: nu * param0 + nu**param1 + 100.,
+            ['param0', 'param1'])
+
+    @parameterized.expand(_TwoParamComponentCase.tags)
+    def test(self, tag):
+        func, val0, val1, nu_type = tag.split('__')
+        param0 = self._get_param0(val0)
+        param1 = self._get_param1(val1)
+        nu = self._get_nu(nu_type)
+
+        res = getattr(self.comp, func)(nu, param0, param1)
+
+        ref = getattr(self, 'hard_'+func)(nu, param0, param1)
+
+        if not isinstance(res, list):
+            res = [res]
+            ref = [ref]
+
+        for res_i, ref_i in zip(res, ref):
+            # Derivatives are broadcast to the shape of the SED
+            np.testing.assert_allclose(
+                res_i, np.broadcast_to(ref_i, np.shape(res_i)))
+
+    def test_against_analytic_dust(self):
+        def mbb(nu, beta_d, temp):
+            return ((nu / 150.)**(beta_d + 1.) * np.expm1(H_OVER_K * 150. / temp)
+                    / np.expm1(H_OVER_K * nu / temp))
+        dust = Dust(150., units='K_RJ')
+        autodiff_dust = AutodiffComponent(mbb, ['beta_d', 'temp'], [1.5, 20.])
+        nu = np.array([30., 100., 353.])
+        for beta_d, temp in [(1.5, 20.), (np.array([1.4, 1.6]), 20.)]:
+            for res, ref in zip(autodiff_dust.diff(nu, beta_d, temp),
+                                dust.diff(nu, beta_d, temp)):
+                np.testing.assert_allclose(res, ref)
+        res = autodiff_dust.diff_diff(nu, 1.5, 20.)
+        ref = dust.diff_diff(nu, 1.5, 20.)
+        for i in range(2):
+            for j in range(2):
+                np.testing.assert_allclose(res[i][j], ref[i][j])
+
+    def test_diff_diff_shape(self):
+        param0 = np.arange(2, 7)[:, np.newaxis]
+        param1 = np.linspace(1.5, 2., 3)
+        nu = self._get_nu('centers')
+        res = self.comp.diff_diff(nu, param0, param1)
+        np.testing.assert_allclose(res[0][0], 0.)
+        np.testing.assert_allclose(res[0][1], 0.)
+        ref = np.log(nu)**2 * nu**param1[..., np.newaxis]
+        np.testing.assert_allclose(np.broadcast_to(res[1][1], (5, 3, 3)),
+                                   np.broadcast_to(ref, (5, 3, 3)))
+
+    def test_defaults(self):
+        self.assertEqual(self.comp.defaults, [1., 1.])  # As AnalyticComponent
+        self.assertEqual(MixingMatrix(self.comp).defaults, self.comp.defaults)
+        comp = AutodiffComponent(
+            lambda nu, param0, param1: nu * param0 + nu**param1,
+            ['param0', 'param1'], (2., 3.))
+        self.assertEqual(comp.defaults, [2., 3.])
+
+    def test_unsupported_function(self):
+        comp = AutodiffComponent(
+            lambda nu, beta: np.interp(nu, [10., 100.], [beta, 1.]), ['beta'])
+        with self.assertRaises(TypeError):
+            comp.diff(np.array([20., 30.]), 1.)
+
+
+class TestInterpolatedComponent(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.nu = np.array([30., 100., 353.])
+        self.dust = Dust(150.)
+        self.grid = [np.linspace(1., 2., 21), np.array([10., 15., 17., 20., 30.])]
+        self.interp = InterpolatedComponent(self.dust, self.nu, self.grid)
+
+    def test_nodes(self):
+        beta_d, temp = np.meshgrid(*self.grid, indexing='ij')
+        np.testing.assert_allclose(self.interp.eval(self.nu, beta_d, temp),
+                                   self.dust.eval(self.nu, beta_d, temp))
+        for res, ref in zip(self.interp.diff(self.nu, beta_d, temp),
+                            self.dust.diff(self.nu, beta_d, temp)):
+            np.testing.assert_allclose(res, ref)
+        res = self.interp.diff_diff(self.nu, beta_d, temp)
+        ref = self.dust.diff_diff(self.nu, beta_d, temp)
+        for i in range(2):
+            for j in range(2):
+                np.testing.assert_allclose(res[i][j], ref[i][j])
+
+    def test_between_nodes(self):
+        beta_d = np.random.uniform(1.2, 1.8, 10)[:, np.newaxis]
+        temp = np.random.uniform(18., 22., 7)
+        res = self.interp.eval(self.nu, beta_d, temp)
+        self.assertEqual(res.shape, (10, 7, 3))
+        np.testing.assert_allclose(
+            res, self.dust.eval(self.nu, beta_d, temp), rtol=1e-2)
+        res = self.interp.eval(self.nu, 1.5, 20.)
+        self.assertEqual(res.shape, (3,))
+
+    def test_linear_sed(self):
+        # Multilinear interpolation is exact, also outside the grid
+        comp = AnalyticComponent('nu * param0 + nu**2 * param1 + param0 * param1')
+        interp = InterpolatedComponent(comp, self.nu, [[0., 1.], [-1., 2.]])
+        param0 = np.linspace(-1., 2., 5)
+        param1 = np.linspace(-2., 3., 4)[:, np.newaxis]
+        shape = (4, 5, 3)
+        np.testing.assert_allclose(interp.eval(self.nu, param0, param1),
+                                   comp.eval(self.nu, param0, param1))
+        for res, ref in zip(interp.diff(self.nu, param0, param1),
+                            comp.diff(self.nu, param0, param1)):
+            np.testing.assert_allclose(res, np.broadcast_to(ref, shape))
+        for res_i, ref_i in zip(interp.diff_diff(self.nu, param0, param1),
+                                comp.diff_diff(self.nu, param0, param1)):
+            for res, ref in zip(res_i, ref_i):
+                np.testing.assert_allclose(res, np.broadcast_to(ref, shape),
+                                           atol=1e-10)
+
+    def test_other_frequencies(self):
+        nu = np.array([40., 50.])
+        np.testing.assert_allclose(self.interp.eval(nu, 1.55, 19.),
+                                   self.dust.eval(nu, 1.55, 19.))
+        bandpass = [(np.array([90., 100., 110.]), np.ones(3))]
+        interp = InterpolatedComponent(self.dust, bandpass, self.grid)
+        np.testing.assert_allclose(interp.eval(bandpass, 1.5, 20.),
+                                   self.dust.eval(bandpass, 1.5, 20.))
+        np.testing.assert_allclose(interp.eval(self.nu, 1.55, 19.),
+                                   self.dust.eval(self.nu, 1.55, 19.))
+
+
 if __name__ == '__main__':
     unittest.main()
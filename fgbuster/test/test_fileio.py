@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+import os
+import tempfile
+import unittest
+from fgbuster.fileio import atomic_write, remove_if_exists
+
+
+class TestAtomicWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, 'entry')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_write(self):
+        atomic_write(self.path, lambda f: f.write(b'old'))
+        atomic_write(self.path, lambda f: f.write(b'new'))
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['entry'])
+
+    def test_failed_write(self):
+        atomic_write(self.path, lambda f: f.write(b'old'))
+
+        def write(f):
+            f.write(b'partial')
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            atomic_write(self.path, write)
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['entry'])
+
+    def test_remove_if_exists(self):
+        atomic_write(self.path, lambda f: f.write(b'old'))
+        remove_if_exists(self.path)
+        remove_if_exists(self.path)  # E.g. already removed by another job
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
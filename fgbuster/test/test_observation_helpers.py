@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+import os
+import time
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from numpy.testing import assert_allclose as aac
+import healpy as hp
+import pysm3
+import pysm3.units as u
+import fgbuster.observation_helpers as observation_helpers
+from fgbuster.observation_helpers import (get_observation,
+                                          standardize_instrument,
+                                          ObservationCache,
+                                          PartialMaps)
+
+
+class _PowerLawSky(object):
+    """ Minimal sky: power law in K_RJ, no template download required """
+
+    def __init__(self, nside):
+        np.random.seed(0)
+        self.nside = nside
+        self.amp = np.random.uniform(size=(3, hp.nside2npix(nside)))
+
+    def get_emission(self, freq, weights=None):
+        freq = np.atleast_1d(freq.to_value(u.GHz))
+        if freq.size == 1:
+            return self.amp * (freq[0] / 100.)**-3 * u.uK_RJ
+        if weights is None:
+            weights = np.ones_like(freq)
+        weights = weights / np.trapz(weights, freq)
+        sed = np.trapz((freq / 100.)**-3 * weights, freq)
+        return self.amp * sed * u.uK_RJ
+
+
+class TestGetObservation(unittest.TestCase):
+
+    def setUp(self):
+        self.nside = 4
+        self.sky = _PowerLawSky(self.nside)
+        self.instrument = {'frequency': np.array([40., 90., 150., 280.])}
+
+    def test_threads_match_serial(self):
+        serial = get_observation(self.instrument, self.sky)
+        threads = get_observation(self.instrument, self.sky, n_jobs=3)
+        aac(threads, serial)
+
+    def test_executor_match_serial(self):
+        serial = get_observation(self.instrument, self.sky, unit='K_RJ')
+        with ThreadPoolExecutor(2) as executor:
+            pool = get_observation(self.instrument, self.sky, unit='K_RJ',
+                                   executor=executor)
+        aac(pool, serial)
+
+    def test_units(self):
+        res = get_observation(self.instrument, self.sky, unit='K_CMB')
+        for res_freq, freq in zip(res, self.instrument['frequency']):
+            ref = self.sky.get_emission(freq * u.GHz).to(
+                u.K_CMB, equivalencies=u.cmb_equivalencies(freq * u.GHz))
+            aac(res_freq, ref.value)
+
+    def test_bandpass(self):
+        instrument = dict(self.instrument)
+        instrument['bandpass'] = [
+            (np.linspace(0.9, 1.1, 11) * freq, np.ones(11))
+            for freq in instrument['frequency']]
+        serial = get_observation(instrument, self.sky)
+        threads = get_observation(instrument, self.sky, n_jobs=2)
+        aac(threads, serial)
+        for res_freq, (band_nu, band_w) in zip(serial,
+                                                instrument['bandpass']):
+            factor = pysm3.bandpass_unit_conversion(
+                band_nu * u.GHz, band_w, u.uK_CMB)
+            ref = self.sky.get_emission(band_nu * u.GHz, band_w) * factor
+            aac(res_freq, ref.value)
+
+
+class TestObservationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.instrument = {'frequency': np.array([40., 90., 150.])}
+        np.random.seed(0)
+        self.maps = np.random.normal(size=(3, 3, hp.nside2npix(2)))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_store_and_load(self):
+        cache = ObservationCache(self.tmp_dir.name)
+        key = cache.key('d0s0', 2, self.instrument, 'uK_CMB')
+        self.assertIsNone(cache.load(key))
+        cache.store(key, self.maps)
+        maps = cache.load(key)
+        aac(maps, self.maps)
+        maps[0] = 0.  # Copy-on-write: the cache is not modified
+        aac(cache.load(key), self.maps)
+
+    def test_float32(self):
+        cache = ObservationCache(self.tmp_dir.name, dtype=np.float32)
+        key = cache.key('d0s0', 2, self.instrument, 'uK_CMB')
+        maps = cache.store(key, self.maps)
+        self.assertEqual(maps.dtype, np.float32)
+        aac(maps, self.maps, rtol=1e-6)
+
+    def test_key(self):
+        cache = ObservationCache(self.tmp_dir.name)
+        key = cache.key('d0s0', 2, self.instrument, 'uK_CMB')
+        self.assertEqual(key, cache.key('d0s0', 2, self.instrument, 'uK_CMB'))
+        self.assertNotEqual(key, cache.key('d1s0', 2, self.instrument,
+                                           'uK_CMB'))
+        self.assertNotEqual(key, cache.key('d0s0', 4, self.instrument,
+                                           'uK_CMB'))
+        self.assertNotEqual(key, cache.key('d0s0', 2, self.instrument,
+                                           'K_RJ'))
+        instrument = dict(self.instrument)
+        instrument['bandpass'] = [([f-1, f+1], [1, 1])
+                                  for f in instrument['frequency']]
+        self.assertNotEqual(key, cache.key('d0s0', 2, instrument, 'uK_CMB'))
+
+    def test_eviction(self):
+        cache = ObservationCache(self.tmp_dir.name,
+                                 max_size=2.5 * self.maps.nbytes)
+        keys = [cache.key(tag, 2, self.instrument, 'uK_CMB')
+                for tag in ['d0', 's0', 'c1']]
+        now = time.time()
+        for i, key in enumerate(keys[:2]):
+            cache.store(key, self.maps)
+            path = os.path.join(self.tmp_dir.name, key + '.npy')
+            os.utime(path, (now - 10 + i, now - 10 + i))
+        cache.load(keys[0])  # Now keys[1] is the least recently used
+        cache.store(keys[2], self.maps)
+        self.assertIsNotNone(cache.load(keys[0]))
+        self.assertIsNone(cache.load(keys[1]))
+        self.assertIsNotNone(cache.load(keys[2]))
+
+    def test_failed_store(self):
+        cache = ObservationCache(self.tmp_dir.name)
+        key = cache.key('d0s0', 2, self.instrument, 'uK_CMB')
+        with self.assertRaises(ValueError):
+            cache.store(key, [['not a number']])
+        self.assertEqual(os.listdir(self.tmp_dir.name), [])
+
+    def test_get_observation(self):
+        # The second call is served from the cache
+        tags = []
+        def get_sky(nside, tag):
+            tags.append(tag)
+            return _PowerLawSky(nside)
+
+        original_get_sky = observation_helpers.get_sky
+        observation_helpers.get_sky = get_sky
+        try:
+            first = get_observation(self.instrument, 'd0', nside=2,
+                                    cache=self.tmp_dir.name)
+            second = get_observation(self.instrument, 'd0', nside=2,
+                                     cache=self.tmp_dir.name)
+        finally:
+            observation_helpers.get_sky = original_get_sky
+        self.assertEqual(tags, ['d0'])
+        aac(second, first)
+        aac(first, get_observation(self.instrument, _PowerLawSky(2)))
+
+
+class TestPartialMaps(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.maps = np.random.normal(size=(3, 2, hp.nside2npix(2)))
+        self.maps[..., 10:] = hp.UNSEEN
+        self.maps[0, 0, 3] = hp.UNSEEN  # Partially observed pixel
+
+    def test_round_trip(self):
+        partial = PartialMaps.from_full(self.maps)
+        aac(partial.pixels, np.arange(10))
+        self.assertEqual(partial.shape, (3, 2, 10))
+        aac(partial.to_full(), self.maps)
+
+    def test_masked_array(self):
+        partial = PartialMaps.from_full(hp.ma(self.maps))
+        aac(partial.pixels, np.arange(10))
+
+    def test_wrong_pixels(self):
+        with self.assertRaises(ValueError):
+            PartialMaps(2, [0, 1], self.maps[..., :3])
+        with self.assertRaises(ValueError):
+            PartialMaps(2, [0, 48], self.maps[..., :2])
+
+
+class TestStandardizeInstrument(unittest.TestCase):
+
+    def test_bandpass(self):
+        instrument = {'frequency': [10, 20],
+                      'bandpass': [([9, 10, 11], [1, 1, 1]),
+                                   ([19, 21], [1, 2])]}
+        std_instr = standardize_instrument(instrument)
+        self.assertEqual(len(std_instr.bandpass), 2)
+        for band_nu, band_w in std_instr.bandpass:
+            self.assertEqual(band_nu.dtype, np.float64)
+            self.assertEqual(band_w.dtype, np.float64)
+
+    def test_no_bandpass(self):
+        std_instr = standardize_instrument({'frequency': [10, 20]})
+        self.assertFalse(hasattr(std_instr, 'bandpass'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 import os
 import sys
+import tempfile
 from itertools import product
 import unittest
 from parameterized import parameterized
@@ -8,14 +9,20 @@ import numpy as np
 from numpy.testing import assert_allclose as aac
 from scipy.stats import kstest
 import healpy as hp
+import fgbuster.algebra as alg
 from fgbuster.algebra import _mv
 from fgbuster.mixingmatrix import MixingMatrix
-from fgbuster.observation_helpers import get_instrument, standardize_instrument
+from fgbuster.observation_helpers import (get_instrument, standardize_instrument,
+                                          PartialMaps)
 import fgbuster.component_model as cm
 from fgbuster.separation_recipes import (basic_comp_sep, weighted_comp_sep,
                                          multi_res_comp_sep,
+                                         ensemble_comp_sep,
+                                         SeparationPlan,
                                          _my_ud_grade,
                                          _my_nside2npix,
+                                         _healpix_patch_ids,
+                                         _multi_res_evaluators,
                                          ilc, harmonic_ilc,
                                          _empirical_harmonic_covariance)
 
@@ -219,6 +226,97 @@ class TestBasicCompSep(unittest.TestCase):
         aac(res.chi[data != hp.UNSEEN], 0, atol=0.05)
 
 
+    def test_not_healpix(self):
+        np.random.seed(0)
+        components = [cm.CMB(), cm.Dust(150.)]
+        instrument = {'frequency': np.array([30., 90., 150., 220., 340.]),
+                      'depth_p': np.ones(5)}
+        mm = MixingMatrix(*components)
+        A = mm.eval(instrument['frequency'], *mm.defaults)
+        s = np.random.normal(size=(2, 2, 100))
+        data = np.einsum('fc,csp->fsp', A, s)
+        x = np.array(mm.defaults)
+        components[1].defaults = [1.1 * d for d in components[1].defaults]
+        res = basic_comp_sep(components, instrument, data)
+        aac(res.x, x, rtol=1e-5)
+        aac(res.s, s, rtol=1e-4)
+
+
+class TestFitNside(unittest.TestCase):
+
+    def setUp(self):
+        np.random.seed(0)
+        self.nside = 8
+        self.components = [cm.CMB(), cm.Dust(150.), cm.Synchrotron(20.)]
+        freqs = np.array([30., 60., 100., 150., 250., 350.])
+        self.instrument = {'frequency': freqs, 'depth_p': np.linspace(3, 6, 6)}
+        mm = MixingMatrix(*self.components)
+        amp = np.random.normal(size=(3, 2, hp.nside2npix(self.nside)))
+        amp[1:] *= 10.
+        sigma = (self.instrument['depth_p']
+                 / hp.nside2resol(self.nside, arcmin=True))
+        self.data = np.einsum('fc,csp->fsp', mm.eval(freqs, *mm.defaults), amp)
+        self.data += (sigma[:, np.newaxis, np.newaxis]
+                      * np.random.normal(size=self.data.shape))
+        self.invN = np.diag(sigma**-2)
+
+    def _Wd(self, x):
+        A = MixingMatrix(*self.components).eval(
+            self.instrument['frequency'], *x)
+        return alg.Wd(A, self.data.T, self.invN).T
+
+    @parameterized.expand([(0,), (1,)])
+    def test_against_downgraded(self, nside):
+        res = basic_comp_sep(self.components, self.instrument, self.data,
+                             nside, fit_nside=2)
+        low_res_data = hp.ud_grade(self.data.reshape(-1, self.data.shape[-1]),
+                                   2).reshape(self.data.shape[:-1] + (-1,))
+        ref = basic_comp_sep(self.components, self.instrument, low_res_data,
+                             nside)
+        aac(res.x, ref.x, rtol=1e-5)
+        aac(res.Sigma, ref.Sigma, rtol=1e-3)
+        if nside:
+            patch_ids = _healpix_patch_ids(nside, self.nside)
+            for patch_id in range(hp.nside2npix(nside)):
+                in_patch = patch_ids == patch_id
+                aac(res.s[..., in_patch],
+                    self._Wd(res.x[:, patch_id])[..., in_patch], rtol=1e-5)
+        else:
+            aac(res.s, self._Wd(res.x), rtol=1e-5)
+        self.assertNotIn('chi_dB', res)
+
+    def test_mask(self):
+        # Mask all the pixel 0 at nside 2 and half of the pixel 1
+        low_res_ids = _healpix_patch_ids(2, self.nside)
+        mask = low_res_ids == 0
+        mask[np.flatnonzero(low_res_ids == 1)[::2]] = True
+        self.data[..., mask] = hp.UNSEEN
+        res = basic_comp_sep(self.components, self.instrument, self.data,
+                             fit_nside=2)
+        self.assertTrue(np.all(res.s[..., mask] == hp.UNSEEN))
+        self.assertTrue(np.all(res.s[..., ~mask] != hp.UNSEEN))
+        aac(res.s[..., ~mask], self._Wd(res.x)[..., ~mask], rtol=1e-5)
+        self.assertFalse(res.fit_res.mask_good[0])
+        self.assertTrue(np.all(res.fit_res.mask_good[1:]))
+
+        # Half-observed pixel: average of the good pixels, noise sqrt(2)
+        # times higher
+        low_res_data = hp.ud_grade(self.data.reshape(-1, self.data.shape[-1]),
+                                   2).reshape(self.data.shape[:-1] + (-1,))
+        low_res_data[..., 1] /= 2**0.5
+        ref = basic_comp_sep(self.components, self.instrument, low_res_data)
+        aac(res.x, ref.x, rtol=1e-5)
+
+    def test_wrong_fit_nside(self):
+        for fit_nside in [8, 16]:
+            with self.assertRaises(ValueError):
+                basic_comp_sep(self.components, self.instrument, self.data,
+                               fit_nside=fit_nside)
+        with self.assertRaises(ValueError):
+            basic_comp_sep(self.components, self.instrument, self.data, 4,
+                           fit_nside=2)
+
+
 class TestWeightedCompSep(unittest.TestCase):
     stokess = 'IPN'
     nsides = [2]
@@ -299,6 +397,42 @@ class TestWeightedCompSep(unittest.TestCase):
         assert p_value > 0.10
 
 
+    def test_broadcast_cov(self):
+        data, _, _ = _get_sky(
+            'P__nside_2__nsidepar_0__powerlaw_curvedpowerlaw__nomask__dict_vary')
+        components = _get_component('powerlaw_curvedpowerlaw')
+        instrument = _get_instrument('dict_vary', 2)
+        cov = np.linspace(1., 2., data.shape[0])[:, np.newaxis, np.newaxis]
+        full_cov = np.tile(cov, data.shape[-1])
+        for nsidepar in [0, 1]:
+            res = weighted_comp_sep(components, instrument, data, cov, nsidepar)
+            ref = weighted_comp_sep(components, instrument, data, full_cov,
+                                    nsidepar)
+            aac(res.x, ref.x)
+            aac(res.s, ref.s)
+            aac(res.invAtNA, ref.invAtNA)
+
+    def test_partial_coverage(self):
+        data, s, x = _get_sky(
+            'P__nside_2__nsidepar_0__powerlaw_curvedpowerlaw__nomask__dict_vary')
+        components = _get_component('powerlaw_curvedpowerlaw')
+        for c in components:
+            c.defaults = [1.1 * d for d in c.defaults]
+        instrument = _get_instrument('dict_vary', 2)
+        cov = np.linspace(1., 2., data.shape[0])[:, np.newaxis, np.newaxis]
+        # The first frequency is not observed in half of the sky
+        data = data.copy()
+        data[0, :, :data.shape[-1] // 2] = hp.UNSEEN
+
+        res = weighted_comp_sep(components, instrument, data, cov)
+        self.assertFalse(res.mask_good[0])
+        res = weighted_comp_sep(components, instrument, data, cov,
+                                partial_coverage=True)
+        self.assertTrue(np.all(res.mask_good))
+        aac(res.x, x, rtol=1e-5)
+        aac(res.s, s, rtol=1e-4)
+        aac(res.chi[data == hp.UNSEEN], hp.UNSEEN, rtol=0)
+
     def _get_cov(self, instrument, stokes, nside=None):
         cov_tag = 'Cov_%s' % stokes
         try:
@@ -420,6 +554,258 @@ class TestMultiResCompSep(unittest.TestCase):
             aac(res_x, xx, rtol=2e-5)
 
 
+    def test_checkpoint(self):
+        data, s, x = _get_sky(
+            'P__nside_2__nsidepar_1__powerlaw_curvedpowerlaw__nomask__dict_homo')
+        components = _get_component('powerlaw_curvedpowerlaw')
+        for c in components:
+            c.defaults = [1.1 * d for d in c.defaults]
+        instrument = _get_instrument('dict_homo')
+        nsides = [1, 0, 0]
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = alg.Checkpoint(directory)
+            iterates = []
+            res = multi_res_comp_sep(components, instrument, data, nsides,
+                                     checkpoint=checkpoint, checkpoint_every=1,
+                                     callback=iterates.append)
+            self.assertEqual(len(iterates), res.nit)
+            stored_x = checkpoint.load('x')
+            aac(np.concatenate(res.x), stored_x)
+
+            # Resume from the last parameters stored
+            checkpoint.store('x', iterates[res.nit // 2])
+            res_resumed = multi_res_comp_sep(components, instrument, data,
+                                             nsides, checkpoint=checkpoint)
+        self.assertLess(res_resumed.nit, res.nit)
+        for res_x, ref_x in zip(res_resumed.x, res.x):
+            aac(res_x, ref_x, rtol=1e-5)
+
+    def test_checkpoint_intermediate_result(self):
+        data, s, x = _get_sky(
+            'P__nside_2__nsidepar_1__powerlaw_curvedpowerlaw__nomask__dict_homo')
+        components = _get_component('powerlaw_curvedpowerlaw')
+        for c in components:
+            c.defaults = [1.1 * d for d in c.defaults]
+        instrument = _get_instrument('dict_homo')
+        funs = []
+        def callback(intermediate_result):
+            funs.append(intermediate_result.fun)
+        with tempfile.TemporaryDirectory() as directory:
+            checkpoint = alg.Checkpoint(directory)
+            res = multi_res_comp_sep(components, instrument, data, [1, 0, 0],
+                                     checkpoint=checkpoint, checkpoint_every=1,
+                                     callback=callback)
+        self.assertEqual(len(funs), res.nit)
+        aac(funs[-1], res.fun)
+
+
+class TestHealpixPatchIds(unittest.TestCase):
+
+    def test_against_ud_grade(self):
+        for nside, data_nside in [(1, 1), (1, 4), (2, 8), (4, 8)]:
+            ref = hp.ud_grade(np.arange(hp.nside2npix(nside)), data_nside)
+            aac(_healpix_patch_ids(nside, data_nside), ref)
+        aac(_healpix_patch_ids(0, 2), 0)
+
+    def test_pixels(self):
+        pixels = np.array([5, 0, 17, 42])
+        aac(_healpix_patch_ids(2, 4, pixels), _healpix_patch_ids(2, 4)[pixels])
+        aac(_healpix_patch_ids(0, 4, pixels), np.zeros(4))
+
+
+class TestMultiResEvaluators(unittest.TestCase):
+
+    @parameterized.expand([((0, 2, 1),), ((2, 4, 2),), ((4, 0, 1),)])
+    def test_against_mixing_matrix(self, nsides):
+        np.random.seed(0)
+        components = [cm.CMB(), cm.Dust(150.), cm.Synchrotron(70.)]
+        nu = np.array([30., 70., 150., 220., 340.])
+        max_nside = max(nsides)
+        extra_dim = [1, 1]
+
+        def array2maps(x):
+            bounds = np.cumsum([0] + [_my_nside2npix(n) for n in nsides])
+            return [x[i:j] for i, j in zip(bounds[:-1], bounds[1:])]
+
+        mm = MixingMatrix(*components)
+        unpack = lambda x: [_my_ud_grade(m, max_nside).reshape(-1, *extra_dim)
+                            for m in array2maps(x)]
+        x = np.concatenate([
+            d * np.random.uniform(0.9, 1.1, _my_nside2npix(n))
+            for n, d in zip(nsides, mm.defaults)])
+        A_ev, A_dB_ev = _multi_res_evaluators(
+            components, nu, nsides, max_nside, extra_dim, array2maps)
+        aac(A_ev(x), mm.evaluator(nu, unpack)(x))
+        for A_dB, A_dB_ref in zip(A_dB_ev(x), mm.diff_evaluator(nu, unpack)(x)):
+            aac(A_dB, A_dB_ref)
+
+
+class TestSeparationPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.data, self.s, self.x = _get_sky(
+            'P__nside_2__nsidepar_1__powerlaw_curvedpowerlaw__maskpole__pysm')
+        self.mask = self.data[0, 0] == hp.UNSEEN
+        self.instrument = _get_instrument('pysm')
+        self.components = _get_component('powerlaw_curvedpowerlaw')
+        for c in self.components:
+            c.defaults = [1.1 * d for d in c.defaults]
+
+    def test_run_twice(self):
+        plan = SeparationPlan(self.components, self.instrument,
+                              self.data.shape, 1, self.mask)
+        for _ in range(2):
+            res = plan.run(self.data)
+            aac(res.x, self.x, rtol=1e-5)
+            aac(res.s, self.s, rtol=1e-4)
+            self.assertTrue(np.all(res.mask_good == ~self.mask))
+
+    def test_float32(self):
+        res64 = SeparationPlan(self.components, self.instrument,
+                               self.data.shape, 1, self.mask).run(self.data)
+        plan = SeparationPlan(self.components, self.instrument,
+                              self.data.shape, 1, self.mask, np.float32)
+        res = plan.run(self.data)
+        self.assertEqual(res.s.dtype, np.float32)
+        self.assertEqual(res.chi.dtype, np.float32)
+        aac(res.x, res64.x, rtol=1e-5)
+        aac(res.s, res64.s, rtol=1e-5)
+        self.assertTrue(np.all(res.s[..., self.mask] == hp.UNSEEN))
+
+    def test_outputs(self):
+        plan = SeparationPlan(self.components, self.instrument,
+                              self.data.shape, 1, self.mask)
+        res = plan.run(self.data)
+        res_s = plan.run(self.data, outputs='s')
+        aac(res_s.x, res.x)
+        aac(res_s.Sigma, res.Sigma)
+        aac(res_s.s, res.s)
+        for name in ['chi', 'invAtNA', 'chi_dB']:
+            self.assertNotIn(name, res_s)
+            for patch_res in res_s.patch_res:
+                self.assertNotIn(name, patch_res)
+
+    def test_data_outside_mask(self):
+        plan = SeparationPlan(self.components, self.instrument,
+                              self.data.shape, 1)
+        with self.assertRaises(ValueError):
+            plan.run(self.data)
+
+    def test_wrong_shape(self):
+        plan = SeparationPlan(self.components, self.instrument,
+                              self.data.shape, 1, self.mask)
+        with self.assertRaises(ValueError):
+            plan.run(self.data[:, :1])
+
+
+class TestEnsembleCompSep(unittest.TestCase):
+
+    def setUp(self):
+        self.n_sims = 4
+        data, _, _ = _get_sky(
+            'P__nside_2__nsidepar_0__powerlaw_curvedpowerlaw__maskpole__pysm')
+        np.random.seed(0)
+        noise = np.random.normal(size=(self.n_sims,) + data.shape)
+        self.data = data + 0.1 * noise
+        self.data[:, data == hp.UNSEEN] = hp.UNSEEN
+        self.instrument = _get_instrument('pysm')
+
+    def _get_components(self):
+        components = _get_component('powerlaw_curvedpowerlaw')
+        for c in components:
+            c.defaults = [1.1 * d for d in c.defaults]
+        return components
+
+    @parameterized.expand([('independent', False), ('stacked', True)])
+    def test_against_basic_comp_sep(self, _, stacked):
+        res = ensemble_comp_sep(self._get_components(), self.instrument,
+                                self.data, stacked=stacked, n_jobs=2,
+                                return_maps=True)
+        for k in range(self.n_sims):
+            res_k = basic_comp_sep(self._get_components(), self.instrument,
+                                   self.data[k])
+            aac(res.x[k], res_k.x, rtol=1e-5)
+            aac(res.Sigma[k], res_k.Sigma, rtol=1e-3)
+            aac(res.s[k], res_k.s, rtol=1e-4)
+        aac(res.x_mean, res.x.mean(0))
+        self.assertEqual(res.Sigma_mean.shape, (len(res.params),) * 2)
+
+    def test_no_maps(self):
+        res = ensemble_comp_sep(self._get_components(), self.instrument,
+                                self.data)
+        self.assertNotIn('s', res)
+        self.assertNotIn('chi', res)
+
+
+class TestPartialMaps(unittest.TestCase):
+
+    def setUp(self):
+        self.data, _, _ = _get_sky(
+            'P__nside_2__nsidepar_1__powerlaw_curvedpowerlaw__maskpole__pysm')
+        self.partial = PartialMaps.from_full(self.data)
+        self.instrument = _get_instrument('pysm')
+
+    def _get_components(self):
+        components = _get_component('powerlaw_curvedpowerlaw')
+        for c in components:
+            c.defaults = [1.1 * d for d in c.defaults]
+        return components
+
+    def _assert_same_maps(self, partial, full):
+        self.assertIsInstance(partial, PartialMaps)
+        self.assertEqual(len(partial.pixels), len(self.partial.pixels))
+        atol = 1e-4 * np.abs(self.partial.values).max()
+        aac(partial.to_full(), full, atol=atol)
+
+    def test_footprint(self):
+        self.assertLess(len(self.partial.pixels), self.data.shape[-1])
+        aac(self.partial.to_full(), self.data)
+
+    @parameterized.expand([(0,), (1,)])
+    def test_basic_comp_sep(self, nside):
+        res = basic_comp_sep(self._get_components(), self.instrument,
+                             self.partial, nside)
+        res_full = basic_comp_sep(self._get_components(), self.instrument,
+                                  self.data, nside)
+        aac(res.x, res_full.x, rtol=1e-5)
+        for name in ['s', 'chi']:
+            self._assert_same_maps(res[name], res_full[name])
+        self.assertTrue(np.all(res.mask_good))
+
+    @parameterized.expand([(0,), (1,)])
+    def test_weighted_comp_sep(self, nside):
+        cov = np.full(self.data.shape, 0.1)
+        res = weighted_comp_sep(self._get_components(), self.instrument,
+                                self.partial, cov, nside)
+        res_full = weighted_comp_sep(self._get_components(), self.instrument,
+                                     self.data, cov, nside)
+        aac(res.x, res_full.x, rtol=1e-5)
+        for name in ['s', 'chi', 'invAtNA']:
+            self._assert_same_maps(res[name], res_full[name])
+
+    def test_ilc(self):
+        patch_ids = _healpix_patch_ids(1, 2)
+        res = ilc([cm.CMB()], self.instrument, self.partial, patch_ids)
+        res_full = ilc([cm.CMB()], self.instrument, self.data, patch_ids)
+        self._assert_same_maps(res.s, res_full.s)
+        # The last patches are not observed
+        aac(res.W, res_full.W[:len(res.W)])
+
+    def test_multi_res_comp_sep(self):
+        res = multi_res_comp_sep(self._get_components(), self.instrument,
+                                 self.partial, [1, 0, 0])
+        res_full = multi_res_comp_sep(self._get_components(), self.instrument,
+                                      self.data, [1, 0, 0])
+        self._assert_same_maps(res.s, res_full.s)
+
+    def test_wrong_pixels(self):
+        cov = PartialMaps(self.partial.nside, self.partial.pixels[::-1],
+                          np.ones(self.partial.shape))
+        with self.assertRaises(ValueError):
+            weighted_comp_sep(self._get_components(), self.instrument,
+                              self.partial, cov)
+
+
 class TestEmpiricalHarmonicCovariance(unittest.TestCase):
 
     def test_no_stokes(self):